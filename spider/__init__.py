@@ -15,20 +15,31 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 __package__ = __name__
 
+import analytics
 import callback
+import distributed
 import htmlextract
+import httpcache
 import lib
+import multiprocess
+from multiprocess import MultiprocessSpider
+import neardup
+import recrawl
+import replay
 import requestfactory
 import rule
 from spider import BlockingSpider, Spider
 import url
+import warc
 
 __doc__ = "simple web spidering"
 
 if __name__ == "__main__":
     import os
     import Queue
+    import shutil
     import sys
+    import tempfile
     
     def _help():
         """print help text"""
@@ -36,21 +47,70 @@ if __name__ == "__main__":
               "Usage: python spider.py [OPTIONS] URLS\n" \
               "OPTIONS\n" \
               "\t\t--bodies PATH\tstore response bodies to a database\n" \
+              "\t\t--dedup\tstore identical bodies only once (compressed)\n" \
+              "\t\t--graph PATH\tstore a compact webgraph\n" \
+              "\t\t\t(with integer node IDs) to a directory\n" \
               "\t-h, --help\tshow this text and exit\n" \
               "\t\t--headers PATH\tstore response headers to a database\n" \
+              "\t\t--http-cache\tuse the responses stored (with -r)\n" \
+              "\t\t\tas an HTTP cache, revalidating stale ones\n" \
+              "\t\t--local-nodes INT\trun a distributed crawl\n" \
+              "\t\t\tas local processes (for testing)\n" \
+              "\t\t--memory-limit INT\tthe octets of queue to keep\n" \
+              "\t\t\tin memory before spilling to disk\n" \
+              "\t\t--near-duplicates\tstore near-duplicate pages\n" \
+              "\t\t\t(by SimHash), but don't follow their links\n" \
+              "\t\t--node INT\tthis node's index in --nodes\n" \
+              "\t\t--nodes LIST\trun as a node of a distributed crawl,\n" \
+              "\t\t\twhere LIST is HOST:PORT,HOST:PORT,...\n" \
               "\t-n, --nthreads INT\tthe number of concurrent threads\n" \
+              "\t\t--parse LIST\tthe kinds of response to parse for links,\n" \
+              "\t\t\twhere LIST is KIND,KIND,... of html (the default),\n" \
+              "\t\t\tcss and sitemap\n" \
+              "\t-p, --processes INT\tthe number of crawler processes,\n" \
+              "\t\tsharing one queue and visited set\n" \
+              "\t\t--queue-compression SCHEME\tcompress the on-disk queue\n" \
+              "\t\t\t(front, zlib, or front+zlib)\n" \
+              "\t\t--recrawl\trevisit the pages stored (with -r)\n" \
+              "\t\t\tas they come due, by how often they change\n" \
+              "\t\t--replay PATH\tinstead of crawling, replay the\n" \
+              "\t\t\tresponses stored (with -r) at PATH\n" \
+              "\t\t\tthrough the storage options\n" \
               "\t-r, --responses PATH\tstore full responses to a database\n" \
+              "\t\t--segmented\tuse a log-structured database\n" \
               "\t-t, --timeout FLOAT\tthe timeout\n" \
+              "\t\t--unparseable POLICY\twhat to do with responses\n" \
+              "\t\t\twhich aren't parsed: store (the default), drop\n" \
+              "\t\t\t(read, but don't store), or abort (close unread)\n" \
               "\t\t--webgraph PATH\tstore webgraph to a database\n" \
+              "\t\t\t(storage options may be combined, each with\n" \
+              "\t\t\tits own PATH; the first also holds the queue)\n" \
+              "\t-w, --writers INT\tthe number of write-behind\n" \
+              "\t\tstorage threads (by default, storage is synchronous)\n" \
               "URLS\n" \
               "\ta list of URLs"
     
     i = 1
     _callback = callback.DEFAULT_CALLBACK
+    db_class = lib.db.DB
+    http_cache = False
+    local_nodes = 0
+    memory_limit = 67108864
+    near_duplicates = False
+    node = 0
+    nodes = None
+    nprocesses = 0
     nthreads = 0
+    nwriters = 0
+    parse = ("html", )
+    queue_compression = None
+    recrawling = False
+    replay_directory = None
     request_factory = None
     _spider = None
     timeout = None
+    storage = [] # [(callback class, database path), ...]
+    unparseable = "store"
     url_queue = Queue.Queue()
 
     if len(sys.argv) < 2:
@@ -69,19 +129,68 @@ if __name__ == "__main__":
                     _help()
                     sys.exit()
                 i += 1
-                _callback = callback.BodyStorageCallback(lib.db.DB(
-                    sys.argv[i]))
+                storage.append((callback.BodyStorageCallback, sys.argv[i]))
+            elif arg == "dedup":
+                db_class = lib.db.DedupDB
+            elif arg == "graph":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+                i += 1
+                storage.append((callback.GraphStorageCallback, sys.argv[i]))
             elif arg == "headers":
                 if i == len(sys.argv) - 1:
                     print "Missing argument."
                     _help()
                     sys.exit()
                 i += 1
-                _callback = callback.HeaderStorageCallback(lib.db.DB(
-                    sys.argv[i]))
+                storage.append((callback.HeaderStorageCallback, sys.argv[i]))
             elif arg == "help":
                 _help()
                 sys.exit()
+            elif arg == "http-cache":
+                http_cache = True
+            elif arg in ("local-nodes", "node"):
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+
+                try:
+                    if arg == "node":
+                        node = int(sys.argv[i + 1])
+                    else:
+                        local_nodes = int(sys.argv[i + 1])
+                except ValueError:
+                    pass
+                i += 1
+            elif arg == "memory-limit":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+
+                try:
+                    memory_limit = int(sys.argv[i + 1])
+                except ValueError:
+                    pass
+                i += 1
+            elif arg == "near-duplicates":
+                near_duplicates = True
+            elif arg == "nodes":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+
+                try:
+                    nodes = distributed.parse_nodes(sys.argv[i + 1])
+                except ValueError:
+                    print "Invalid node list."
+                    _help()
+                    sys.exit()
+                i += 1
             elif arg == "nthreads":
                 if i == len(sys.argv) - 1:
                     print "Missing argument."
@@ -93,13 +202,59 @@ if __name__ == "__main__":
                 except ValueError:
                     pass
                 i += 1
+            elif arg == "parse":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+                i += 1
+                parse = tuple(sys.argv[i].split(','))
+
+                if [k for k in parse if not k in ("css", "html", "sitemap")]:
+                    print "Invalid kind of response."
+                    _help()
+                    sys.exit()
+            elif arg == "processes":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+
+                try:
+                    nprocesses = int(sys.argv[i + 1])
+                except ValueError:
+                    pass
+                i += 1
+            elif arg == "queue-compression":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+                i += 1
+
+                if not sys.argv[i] in ("front", "zlib", "front+zlib"):
+                    print "Invalid compression scheme."
+                    _help()
+                    sys.exit()
+                queue_compression = sys.argv[i]
+            elif arg == "recrawl":
+                recrawling = True
+            elif arg == "replay":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+                i += 1
+                replay_directory = sys.argv[i]
             elif arg == "responses":
                 if i == len(sys.argv) - 1:
                     print "Missing argument."
                     _help()
                     sys.exit()
                 i += 1
-                _callback = callback.StorageCallback(lib.db.DB(sys.argv[i]))
+                storage.append((callback.StorageCallback, sys.argv[i]))
+            elif arg == "segmented":
+                db_class = lib.db.SegmentDB
             elif arg == "timeout":
                 if i == len(sys.argv) - 1:
                     print "Missing argument."
@@ -111,14 +266,36 @@ if __name__ == "__main__":
                 except ValueError:
                     pass
                 i += 1
+            elif arg == "unparseable":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+                i += 1
+
+                if not sys.argv[i] in ("abort", "drop", "store"):
+                    print "Invalid policy."
+                    _help()
+                    sys.exit()
+                unparseable = sys.argv[i]
             elif arg == "webgraph":
                 if i == len(sys.argv) - 1:
                     print "Missing argument."
                     _help()
                     sys.exit()
                 i += 1
-                _callback = callback.WebgraphStorageCallback(lib.db.DB(
-                    sys.argv[i]))
+                storage.append((callback.WebgraphStorageCallback, sys.argv[i]))
+            elif arg == "writers":
+                if i == len(sys.argv) - 1:
+                    print "Missing argument."
+                    _help()
+                    sys.exit()
+
+                try:
+                    nwriters = int(sys.argv[i + 1])
+                except ValueError:
+                    pass
+                i += 1
             else:
                 print "Invalid argument."
                 _help()
@@ -141,14 +318,24 @@ if __name__ == "__main__":
                     except ValueError:
                         pass
                     i += 1
+                elif c == 'p':
+                    if i == len(sys.argv) - 1:
+                        print "Missing argument."
+                        _help()
+                        sys.exit()
+
+                    try:
+                        nprocesses = int(sys.argv[i + 1])
+                    except ValueError:
+                        pass
+                    i += 1
                 elif c == 'r':
                     if i == len(sys.argv) - 1:
                         print "Missing argument."
                         _help()
                         sys.exit()
                     i += 1
-                    _callback = callback.StorageCallback(lib.db.DB(
-                        sys.argv[i]))
+                    storage.append((callback.StorageCallback, sys.argv[i]))
                 elif c == 't':
                     if i == len(sys.argv) - 1:
                         print "Missing argument."
@@ -160,6 +347,17 @@ if __name__ == "__main__":
                     except ValueError:
                         pass
                     i += 1
+                elif c == 'w':
+                    if i == len(sys.argv) - 1:
+                        print "Missing argument."
+                        _help()
+                        sys.exit()
+
+                    try:
+                        nwriters = int(sys.argv[i + 1])
+                    except ValueError:
+                        pass
+                    i += 1
                 else:
                     print "Invalid flag."
                     _help()
@@ -168,17 +366,150 @@ if __name__ == "__main__":
             url_queue.put(arg)
         i += 1
 
-    if isinstance(_callback, callback.StorageCallback):
-        _url_queue = url_queue
-        url_queue = lib.disque.Disque(os.path.join(_callback.db.directory,
-            "queue"), chunk_size = 2048) # for speed
+    def _make_callback(directory = None):
+        """construct the callback, optionally storing to directory instead"""
+        _callback = callback.Callback()
+        sinks = []
+
+        for callback_class, path in storage:
+            if directory and len(storage) == 1:
+                path = directory
+            elif directory: # a subdirectory per database
+                path = os.path.join(directory,
+                    os.path.basename(os.path.normpath(path)))
+
+            if callback_class == callback.GraphStorageCallback:
+                sinks.append(callback_class(lib.db.Webgraph(path)))
+            elif db_class == lib.db.DedupDB \
+                    and callback_class == callback.StorageCallback:
+                # keep the headers inline, so identical bodies are shared
+                sinks.append(callback_class(db_class(path,
+                    separator = "\r\n\r\n"), nwriters = nwriters))
+            else:
+                sinks.append(callback_class(db_class(path),
+                    nwriters = nwriters))
+
+        if recrawling: # (fingerprinting next to the first full responses)
+            scheduler = recrawl.RecrawlScheduler([s.db for s in sinks
+                if s.__class__ == callback.StorageCallback][0])
+            sinks.append(recrawl.RecrawlCallback(scheduler))
+
+        if len(sinks) == 1:
+            _callback = sinks[0]
+        elif sinks: # extract once, storing to each
+            _callback = callback.CompositeCallback(sinks)
+
+        if near_duplicates: # (shared by every process, with storage)
+            path = ":memory:"
+
+            if directory:
+                path = os.path.join(directory, "simhash.sqlite")
+            elif storage:
+                path = os.path.join(storage[0][1], "simhash.sqlite")
+            _callback.near_duplicates = neardup.SimHashIndex(path)
+
+        _callback.parse = parse
+        _callback.unparseable = unparseable
+
+        if recrawling: # skip (and don't queue) pages which aren't due
+            _callback.rules = tuple(_callback.rules) + (scheduler, )
+        return _callback
+
+    def _make_spider(url_queue, directory = None):
+        """
+        construct a spider (and its callback) around a queue,
+        optionally storing to directory instead
+        """
+        _callback = _make_callback(directory)
+        kwargs = {"timeout": timeout}
+
+        if http_cache: # (the first database of full responses)
+            kwargs["urlopen"] = httpcache.CachingOpener([s.db
+                for s in getattr(_callback, "sinks", [_callback])
+                if s.__class__ == callback.StorageCallback][0])
+
+        if nthreads:
+            return BlockingSpider(nthreads, url_queue, _callback, **kwargs)
+        return Spider(url_queue, _callback, **kwargs)
+    
+    if http_cache and not callback.StorageCallback in [s[0] for s in storage]:
+        print "--http-cache requires -r."
+        _help()
+        sys.exit()
+    elif recrawling \
+            and not callback.StorageCallback in [s[0] for s in storage]:
+        print "--recrawl requires -r."
+        _help()
+        sys.exit()
+    seeds = []
+
+    while not url_queue.empty():
+        seeds.append(url_queue.get())
+
+    if replay_directory:
+        print "%u responses replayed" % replay.Replayer(replay_directory,
+            _make_callback, nprocesses or 1, db_class)()
+        sys.exit()
 
-        while not _url_queue.empty():
-            url_queue.put(_url_queue.get())
+    if recrawling: # revisit the pages due, most overdue first
+        db = db_class([p for c, p in storage
+            if c == callback.StorageCallback][0], readonly = True)
+        seeds = recrawl.RecrawlScheduler(db).due() + seeds
+        db.__exit__()
     
-    if nthreads:
-        _spider = BlockingSpider(nthreads, url_queue, _callback,
-            timeout = timeout)
-    else:
-        _spider = Spider(url_queue, _callback, timeout = timeout)
-    _spider()
+    if local_nodes:
+        distributed.launch_local(local_nodes, _make_spider,
+            storage[0][1] if storage else "nodes", seeds,
+            compression = queue_compression)
+        sys.exit()
+    elif nodes:
+        if not 0 <= node < len(nodes):
+            print "Invalid node index."
+            _help()
+            sys.exit()
+        distributed.DistributedNode(nodes, node, _make_spider,
+            storage[0][1] if storage else "node", seeds,
+            compression = queue_compression)()
+        sys.exit()
+
+    if nprocesses:
+        queue_directory = "queue"
+
+        if storage:
+            queue_directory = os.path.join(storage[0][1], "queue")
+        seen_directory = None
+
+        if recrawling: # the pages due were seen by the previous crawl
+            seen_directory = os.path.join(queue_directory, "recrawl-seen")
+
+            if os.path.exists(seen_directory):
+                shutil.rmtree(seen_directory)
+        _spider = MultiprocessSpider(nprocesses, _make_spider,
+            queue_directory, seen_directory,
+            compression = queue_compression)
+
+        with lib.disque.Disque(queue_directory, chunk_size = 2048,
+                compression = queue_compression) as url_queue:
+            for seed in seeds:
+                url_queue.put(seed)
+        _spider()
+        sys.exit()
+
+    if storage: # resumable
+        url_queue = lib.disque.HybridDisque(os.path.join(storage[0][1],
+            "queue"), memory_limit, chunk_size = 2048,
+            compression = queue_compression)
+    else: # spill to a temporary directory
+        url_queue = lib.disque.HybridDisque(os.path.join(
+            tempfile.gettempdir(), "spider-%u" % os.getpid()), memory_limit,
+            False, chunk_size = 2048, compression = queue_compression)
+
+    for seed in seeds:
+        url_queue.put(seed)
+    _spider = _make_spider(url_queue)
+    _spider.__enter__()
+
+    try:
+        _spider()
+    finally:
+        _spider.__exit__() # sync the queue
@@ -0,0 +1,329 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import array
+import json
+import os
+
+from lib import db as _db
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__doc__ = "webgraph analytics"
+
+class Graph:
+    """
+    a directed graph as compressed sparse row arrays:
+    node i links to the nodes indices[indptr[i]:indptr[i + 1]]
+
+    with NumPy, the arrays are NumPy arrays (memory-mapped,
+    when loaded from an export) and every computation is vectorized,
+    working through the edges in blocks of about block_size,
+    so memory use beyond the arrays themselves stays proportional
+    to the number of nodes; without it, they're array.array instances,
+    and the same computations are plain (much slower) loops
+
+    url is a function mapping a node to its URL, if known
+    """
+
+    def __init__(self, indptr, indices, url = None, block_size = 16777216):
+        self.block_size = block_size
+
+        if numpy:
+            indptr, indices = [numpy.frombuffer(a, a.typecode)
+                if isinstance(a, array.array) else numpy.asarray(a)
+                for a in (indptr, indices)]
+        self.indices = indices
+        self.indptr = indptr
+        self.n = len(indptr) - 1
+        self._url = url
+
+    def _blocks(self):
+        """
+        generate (sources, targets) edge arrays in blocks
+        of whole nodes (NumPy only)
+        """
+        bounds = numpy.searchsorted(self.indptr, numpy.arange(0,
+            len(self.indices), self.block_size), "right") - 1
+        bounds = numpy.unique(numpy.append(bounds, self.n))
+        degrees = self.out_degrees()
+
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            start, end = self.indptr[a], self.indptr[b]
+
+            if start == end:
+                continue
+            yield numpy.repeat(numpy.arange(a, b), degrees[a:b]), \
+                numpy.asarray(self.indices[start:end], numpy.intp)
+
+    def components(self):
+        """
+        return each node's weakly connected component,
+        labeled by the smallest node in it
+        """
+        if numpy:
+            labels = numpy.arange(self.n)
+
+            while 1:
+                previous = labels.copy()
+
+                for sources, targets in self._blocks(): # hook roots
+                    a = labels[sources]
+                    b = labels[targets]
+                    lowest = numpy.minimum(a, b)
+                    numpy.minimum.at(labels, a, lowest)
+                    numpy.minimum.at(labels, b, lowest)
+
+                while 1: # shortcut to the roots
+                    jumped = labels[labels]
+
+                    if (jumped == labels).all():
+                        break
+                    labels = jumped
+
+                if (labels == previous).all():
+                    return labels
+        parents = array.array('L', xrange(self.n))
+
+        def find(i):
+            while not parents[i] == i:
+                parents[i] = parents[parents[i]] # path halving
+                i = parents[i]
+            return i
+
+        for i in xrange(self.n):
+            for k in xrange(self.indptr[i], self.indptr[i + 1]):
+                a, b = find(i), find(self.indices[k])
+
+                if a < b:
+                    parents[b] = a
+                elif b < a:
+                    parents[a] = b
+        return array.array('L', (find(i) for i in xrange(self.n)))
+
+    def in_degrees(self):
+        """return the number of links to each node"""
+        if numpy:
+            degrees = numpy.zeros(self.n, numpy.int64)
+
+            for start in xrange(0, len(self.indices), self.block_size):
+                block = self.indices[start:start + self.block_size]
+                degrees += numpy.bincount(numpy.asarray(block, numpy.intp),
+                    minlength = self.n)
+            return degrees
+        degrees = array.array('L', (0 for i in xrange(self.n)))
+
+        for i in self.indices:
+            degrees[i] += 1
+        return degrees
+
+    def out_degrees(self):
+        """return the number of links from each node"""
+        if numpy:
+            return numpy.diff(self.indptr).astype(numpy.int64)
+        return array.array('L', (self.indptr[i + 1] - self.indptr[i]
+            for i in xrange(self.n)))
+
+    def pagerank(self, damping = 0.85, tolerance = 1e-6,
+            max_iterations = 100):
+        """
+        return each node's PageRank, by power iteration until the ranks
+        change by less than tolerance (in total); the rank of nodes
+        without links is spread evenly over every node
+        """
+        if not self.n:
+            return numpy.zeros(0) if numpy else array.array('d')
+
+        if numpy:
+            degrees = self.out_degrees()
+            dangling = degrees == 0
+            rank = numpy.ones(self.n) / self.n
+
+            for iteration in xrange(max_iterations):
+                shares = numpy.where(dangling, 0, rank
+                    / numpy.maximum(degrees, 1))
+                new = numpy.zeros(self.n)
+
+                for sources, targets in self._blocks():
+                    new += numpy.bincount(targets, shares[sources],
+                        self.n)
+                new = (1 - damping) / self.n + damping * (new
+                    + rank[dangling].sum() / self.n)
+                change = numpy.abs(new - rank).sum()
+                rank = new
+
+                if change < tolerance:
+                    break
+            return rank
+        rank = array.array('d', (1.0 / self.n for i in xrange(self.n)))
+
+        for iteration in xrange(max_iterations):
+            dangling = 0.0
+            new = array.array('d', (0.0 for i in xrange(self.n)))
+
+            for i in xrange(self.n):
+                start, end = self.indptr[i], self.indptr[i + 1]
+
+                if start == end:
+                    dangling += rank[i]
+                    continue
+                share = rank[i] / (end - start)
+
+                for k in xrange(start, end):
+                    new[self.indices[k]] += share
+            base = (1 - damping) / self.n + damping * dangling / self.n
+            change = 0.0
+
+            for i in xrange(self.n):
+                new[i] = base + damping * new[i]
+                change += abs(new[i] - rank[i])
+            rank = new
+
+            if change < tolerance:
+                break
+        return rank
+
+    def top(self, scores, k = 10):
+        """return the k highest-scoring (node, score) pairs"""
+        if numpy:
+            scores = numpy.asarray(scores)
+            nodes = numpy.argsort(-scores, kind = "mergesort")[:k]
+            return [(int(i), scores[i]) for i in nodes]
+        return sorted(enumerate(scores), key = lambda p: -p[1])[:k]
+
+    def url(self, node):
+        """return a node's URL"""
+        if self._url is None:
+            raise KeyError(node)
+        return self._url(node)
+
+def load(source, block_size = 16777216):
+    """
+    load a Graph from a db.Webgraph, a directory containing one
+    (or its export_csr output, which is memory-mapped with NumPy),
+    or a db.DB of JSON lists, as stored by WebgraphStorageCallback
+    """
+    if isinstance(source, basestring):
+        if os.path.exists(os.path.join(source, "csr.json")):
+            return Graph(*_load_csr(source), block_size = block_size)
+        elif os.path.exists(os.path.join(source, "ids.sqlite")):
+            source = _db.Webgraph(source)
+        else:
+            source = _db.DB(source, readonly = True)
+
+    if isinstance(source, _db.Webgraph):
+        indptr, indices = source.csr()
+        return Graph(indptr, indices, source.url, block_size)
+    ids = {}
+    nodes = []
+    urls = []
+
+    def id(url):
+        if not url in ids:
+            ids[url] = len(urls)
+            urls.append(url)
+        return ids[url]
+
+    for name in source.iternames():
+        nodes.append((id(name[0]), sorted(set((id(str(l))
+            for l in json.loads(source[name]))))))
+    adjacency = dict(nodes)
+    indices = array.array('I')
+    indptr = array.array('L', (0, ))
+
+    for i in xrange(len(urls)):
+        indices.extend(adjacency.get(i, ()))
+        indptr.append(len(indices))
+    return Graph(indptr, indices, urls.__getitem__, block_size)
+
+def _load_csr(directory):
+    """load export_csr output, memory-mapped if possible"""
+    if not numpy:
+        return _db.webgraph.load_csr(directory)
+
+    with open(os.path.join(directory, "csr.json"), "rb") as fp:
+        description = json.load(fp)
+    arrays = []
+
+    for name, n in (("indptr", description["nodes"] + 1),
+            ("indices", description["edges"])):
+        if n:
+            arrays.append(numpy.memmap(os.path.join(directory, name),
+                numpy.dtype(str(description[name])), 'r', shape = (n, )))
+        else: # mmap can't map an empty file
+            arrays.append(numpy.zeros(0, numpy.dtype(str(description[name]))))
+    return tuple(arrays)
+
+if __name__ == "__main__":
+    import sys
+
+    def _help():
+        print "analyze a stored webgraph\n" \
+              "Usage: python analytics.py [OPTIONS] PATH\n" \
+              "OPTIONS\n" \
+              "\t-h, --help\tshow this text and exit\n" \
+              "\t-k INT\tthe number of top nodes to show (default 10)\n" \
+              "PATH\n" \
+              "\ta db.Webgraph directory, its CSR export,\n" \
+              "\tor a database of JSON webgraph nodes"
+
+    i = 1
+    k = 10
+    path = None
+
+    while i < len(sys.argv):
+        arg = sys.argv[i]
+
+        if arg in ("-h", "--help"):
+            _help()
+            sys.exit()
+        elif arg == "-k":
+            if i == len(sys.argv) - 1:
+                print "Missing argument."
+                _help()
+                sys.exit()
+
+            try:
+                k = int(sys.argv[i + 1])
+            except ValueError:
+                pass
+            i += 1
+        else:
+            path = arg
+        i += 1
+
+    if not path:
+        _help()
+        sys.exit()
+    graph = load(path)
+    components = graph.components()
+    print "%u nodes, %u edges, %u weakly connected components" % (graph.n,
+        len(graph.indices), len(numpy.unique(components)) if numpy
+        else len(set(components)))
+    in_degrees = graph.in_degrees()
+
+    for name, scores in (("PageRank", graph.pagerank()),
+            ("in-degree", in_degrees)):
+        print "top %u by %s:" % (k, name)
+
+        for node, score in graph.top(scores, k):
+            try:
+                node = graph.url(node)
+            except KeyError:
+                pass
+            print "\t%s\t%s" % (score, node)
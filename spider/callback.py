@@ -15,8 +15,9 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import csv
 import json
-import os
+import mimetools
 import StringIO
+import tempfile
 import threading
 
 import htmlextract
@@ -28,17 +29,69 @@ __doc__ = "spider callbacks"
 
 global DEFAULT_CALLBACK
 
+def read_stored_header(entry, buflen = 4096):
+    """
+    parse the header of a response stored by StorageCallback,
+    reading only as much of the entry (e.g. a db.DBEntry) as needed;
+    return (header as a mimetools.Message, the body's offset)
+    """
+    data = ""
+
+    for chunk in entry.chunks(0, buflen):
+        data += chunk
+        i = data.find("\r\n\r\n")
+
+        if i >= 0:
+            break
+    else:
+        raise ValueError("not a stored response")
+
+    if i == 0: # no header
+        header, offset = "", 4
+    elif data[i - 1] == '\n': # LF-terminated header lines
+        header, offset = data[:i], i + 4
+    else: # the last CRLF is part of the header
+        header, offset = data[:i + 2], i + 6
+    return mimetools.Message(StringIO.StringIO(header)), offset
+
 class Callback:
     """
     the base class for a callback, which both extracts links
     and tells the spider whether to continue (similarly to ftw and nftw in C)
+
+    responses are read (and parsed) in chunk_size chunks,
+    and only the depth counters are locked
+
+    if near_duplicates is set (to a neardup.SimHashIndex),
+    each response's SimHash is computed as it's parsed,
+    and a near-duplicate of a page already indexed yields no links:
+    it's still stored, but not expanded
+
+    only the kinds of response in parse (see htmlextract.KINDS)
+    are parsed, by their Content-Type (or lacking one, the first octets
+    of the body, as sniffed by htmlextract.sniff); by the unparseable
+    policy, any other response is:
+        "store": stored, but not parsed
+        "drop": read, but neither stored nor parsed
+        "abort": closed unread (where it has a Content-Type)
+    a dropped or aborted response raises Unparseable,
+    and (like a near-duplicate) yields no links
     """
     
-    def __init__(self, url_class = None, rules = (), depth = -1):
+    def __init__(self, url_class = None, rules = (), depth = -1,
+            chunk_size = 65536, near_duplicates = None, parse = ("html", ),
+            unparseable = "store"):
+        if not unparseable in ("abort", "drop", "store"):
+            raise ValueError("unparseable must be \"abort\", \"drop\""
+                " or \"store\"")
+        self.chunk_size = chunk_size
         self.depth = 0
         self.depth_remaining = depth
-        self._lock = threading.RLock() # automatically determines blocking
+        self._lock = threading.RLock() # for the depth counters
+        self.near_duplicates = near_duplicates
+        self.parse = parse
         self.rules = rules
+        self.unparseable = unparseable
         
         if not url_class:
             url_class = url.DEFAULT_URL_CLASS
@@ -46,17 +99,19 @@ class Callback:
     
     def __call__(self, response):
         """must return a tuple as such: (continue?, links)"""
+        _continue = self._descend(response)
+        return _continue, self._extract(response)
+
+    def _descend(self, response):
+        """count a level of depth, and return whether to continue"""
         with self._lock:
             self.depth += 1
             self.depth_remaining -= 1
-            url = self.url_class(response.url)
+            depth = self.depth
 
-            if __debug__:
-                print "(%u)" % self.depth, url
-            links = [str(url.bind(l)) for l in htmlextract.extract_links(
-                response.info(), response.read())]
-            return not self.depth == 0, \
-                filter(self._enforce_rules, links) # save queue space
+        if __debug__:
+            print "(%u)" % depth, response.url
+        return not depth == 0
 
     def _enforce_rules(self, link):
         """
@@ -68,8 +123,185 @@ class Callback:
                 return False
         return True
 
+    def _gate(self, response):
+        """
+        return (the kind of response, if it's to be parsed, or None,
+        and the response); if the response has no Content-Type,
+        its first octets are sniffed, and the response returned
+        replays them
+        """
+        header = response.info()
+        prefix = ""
+
+        if not header or not header.getheader("content-type"):
+            prefix = response.read(512)
+            response = _PrefixedResponse(response, prefix)
+        kind = htmlextract.KINDS.get(htmlextract.sniff(header, prefix))
+        return kind if kind in self.parse else None, response
+
+    def _extract(self, response, consume = None):
+        """
+        read the rest of a response in chunks, feeding them
+        to a link extractor, and return the (bound and filtered) links
+
+        if provided, consume(response) is called first;
+        anything it reads from the response is fed to the extractor too
+        """
+        kind, response = self._gate(response)
+
+        if kind is None:
+            if self.unparseable == "abort":
+                response.close()
+                raise Unparseable(response.url)
+            elif self.unparseable == "drop":
+                while response.read(self.chunk_size):
+                    pass
+                raise Unparseable(response.url)
+
+            if consume:
+                consume(response)
+            return []
+        elif kind == "css":
+            extractor = htmlextract.CSSExtractor()
+        elif kind == "sitemap":
+            extractor = htmlextract.SitemapExtractor()
+        elif self.near_duplicates is not None:
+            extractor = htmlextract.SimHashExtractor("href", "src")
+        else:
+            extractor = htmlextract.AttributeExtractor("href", "src")
+        header = response.info()
+        read = response.read
+
+        def tee(*args):
+            chunk = read(*args)
+            extractor.feed_chunk(chunk, header)
+            return chunk
+        response.read = tee # bypass socket._fileobject restrictions
+
+        try:
+            if consume:
+                consume(response)
+
+            while tee(self.chunk_size):
+                pass
+        finally:
+            response.read = read
+        extractor.feed_chunk("", header, True)
+        extractor.close()
+
+        if isinstance(extractor, htmlextract.SimHashExtractor):
+            fingerprint = extractor.simhash.fingerprint()
+
+            if fingerprint is not None and self.near_duplicates.add_unique(
+                    response.url, fingerprint) is not None:
+                if __debug__:
+                    print "(near-duplicate)", response.url
+                return []
+        url = self.url_class(response.url)
+        return filter(self._enforce_rules, # save queue space
+            [str(url.bind(v)) for a, v in extractor.drain()])
+
 DEFAULT_CALLBACK = Callback()
 
+class CompositeCallback(Callback):
+    """
+    extract links once, and fan each response out to several sinks
+    (e.g. a BodyStorageCallback and a WebgraphStorageCallback,
+    each with its own database), in a single fetch
+
+    a sink is anything with a store(response, links) method;
+    if any sink has READS_BODY set, the body is spooled
+    (in memory, up to spool_size octets, then to a temporary file)
+    as it's parsed, and each such sink reads a replay of it
+
+    entering or exiting a CompositeCallback enters or exits its sinks
+    """
+
+    def __init__(self, sinks, *args, **kwargs):
+        spool_size = kwargs.pop("spool_size", 1048576)
+        Callback.__init__(self, *args, **kwargs)
+        self.sinks = list(sinks)
+        self.spool_size = spool_size
+
+    def __call__(self, response):
+        _continue = self._descend(response)
+
+        if not _continue:
+            return _continue, self._extract(response)
+        elif not [s for s in self.sinks if getattr(s, "READS_BODY", False)]:
+            links = self._extract(response)
+
+            for sink in self.sinks:
+                sink.store(response, links)
+            return _continue, links
+
+        with tempfile.SpooledTemporaryFile(self.spool_size) as spool:
+            def consume(r):
+                while 1:
+                    chunk = r.read(self.chunk_size)
+
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+            links = self._extract(response, consume)
+
+            for sink in self.sinks:
+                if getattr(sink, "READS_BODY", False):
+                    spool.seek(0, 0)
+                    sink.store(_SpooledResponse(response, spool), links)
+                else:
+                    sink.store(response, links)
+        return _continue, links
+
+    def __enter__(self):
+        for sink in self.sinks:
+            if hasattr(sink, "__enter__"):
+                sink.__enter__()
+        return self
+
+    def __exit__(self, *exception):
+        for sink in self.sinks:
+            if hasattr(sink, "__exit__"):
+                sink.__exit__(*exception)
+
+class _PrefixedResponse:
+    """a response whose first octets (already read) are replayed"""
+
+    def __init__(self, response, prefix):
+        self.prefix = prefix
+        self.response = response
+        self.url = response.url
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def read(self, size = -1):
+        if not self.prefix:
+            return self.response.read(size)
+        elif size < 0:
+            data = self.prefix + self.response.read()
+        else:
+            data = self.prefix[:size]
+        self.prefix = self.prefix[len(data):]
+        return data
+
+class _SpooledResponse:
+    """a response whose body is replayed from a spool"""
+
+    def __init__(self, response, spool):
+        self.response = response
+        self.spool = spool
+        self.url = response.url
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def read(self, size = -1):
+        return self.spool.read(size)
+
+class Unparseable(Exception):
+    """a response dropped or aborted, since it isn't to be parsed"""
+
 class StorageCallback(Callback):
     """
     a Callback capable of storage via a db.DB instance
@@ -77,47 +309,108 @@ class StorageCallback(Callback):
     _generate_data is intended to be overridden,
     however the same may be done for _generate_id
 
+    if nwriters is positive, storage is write-behind:
+    entries are queued for a db.DBWriter with that many threads,
+    so the spider doesn't wait on the disk; they're written by __exit__
+
+    _generate_data may return an iterable of chunks
+    (e.g. reading the response in chunk_size chunks), which is streamed
+    into the entry via DB.writer as it's read (and parsed), unless
+    storage is write-behind
+
     default behavior is to store the full packet
+
+    store is what a CompositeCallback calls, once the response
+    (as replayed, if READS_BODY) has been read and its links extracted
     """
+
+    READS_BODY = True
     
     def __init__(self, db, *args, **kwargs):
+        nwriters = kwargs.pop("nwriters", 0)
         Callback.__init__(self, *args, **kwargs)
 
         assert isinstance(db, _db.DB), "db must be a db.DB instance"
         self.db = db
-        self.db.__enter__()
+        self.nwriters = nwriters
+        self.writer = None
+        self.__enter__()
 
     def __call__(self, response):
-        sio = StringIO.StringIO(response.read())
-        response.read = sio.read # bypass socket._fileobject restrictions
-        _continue, links = Callback.__call__(self, response)
-        
-        if _continue: # store
-            sio.seek(0, os.SEEK_SET)
-            self.db[self._generate_id(response)] = self._generate_data(
-                response)
-        return _continue, links
+        _continue = self._descend(response)
+        store = None
+
+        if _continue:
+            store = lambda r: self.store(r, None)
+        return _continue, self._extract(response, store)
+
+    def _chunks(self, response):
+        """generate the rest of a response in chunk_size chunks"""
+        while 1:
+            chunk = response.read(self.chunk_size)
+
+            if not chunk:
+                break
+            yield chunk
 
     def __del__(self):
+        self.__exit__()
+
+    def __enter__(self):
+        self.db.__enter__()
+
+        if self.nwriters > 0 and (not self.writer or self.writer.closed):
+            self.writer = _db.DBWriter(self.db, self.nwriters)
+        return self
+
+    def __exit__(self, *exception):
+        """write anything queued, and exit the database"""
+        if self.writer:
+            self.writer.close()
         self.db.__exit__()
 
     def _generate_data(self, response):
-        """return data from the response"""
-        return bytearray().join((str(response.info()), "\r\n\r\n",
-            response.read()))
+        """generate data from the response"""
+        yield str(response.info()) + "\r\n\r\n"
+
+        for chunk in self._chunks(response):
+            yield chunk
 
     def _generate_id(self, response):
         """return an ID for a response"""
         return response.url
 
+    def store(self, response, links):
+        """store a response"""
+        self._store(self._generate_id(response), self._generate_data(response))
+
+    def _store(self, name, data):
+        """store data (or an iterable of chunks), possibly write-behind"""
+        if isinstance(data, basestring) or isinstance(data, bytearray):
+            pass
+        elif self.writer:
+            data = str(bytearray().join(data))
+        else: # stream
+            with self.db.writer(name) as writer:
+                for chunk in data:
+                    writer.write(chunk)
+            return
+
+        if self.writer:
+            self.writer.put(name, data)
+        else:
+            self.db[name] = data
+
 class BodyStorageCallback(StorageCallback):
     def __init__(self, *args, **kwargs):
         StorageCallback.__init__(self, *args, **kwargs)
 
     def _generate_data(self, response):
-        return response.read()
+        return self._chunks(response)
 
 class HeaderStorageCallback(StorageCallback):
+    READS_BODY = False
+
     def __init__(self, *args, **kwargs):
         StorageCallback.__init__(self, *args, **kwargs)
 
@@ -131,15 +424,57 @@ class WebgraphStorageCallback(StorageCallback):
     note that the _generate_data function takes a list of links
     instead of a response
     """
+
+    READS_BODY = False
     
     def __init__(self, *args, **kwargs):
         StorageCallback.__init__(self, *args, **kwargs)
 
     def __call__(self, response):
         _continue, links = Callback.__call__(self, response)
-        self.db[self._generate_id(response)] = self._generate_data(links)
+        self.store(response, links)
         return _continue, links
 
+    def store(self, response, links):
+        """store a response's links"""
+        self._store(self._generate_id(response), self._generate_data(links))
+
     def _generate_data(self, links):
         """return a JSON list of links"""
         return json.dumps(links)
+
+class GraphStorageCallback(Callback):
+    """
+    store the webgraph compactly, via a db.Webgraph
+    (as integer IDs, rather than a JSON list of URLs per node)
+    """
+
+    READS_BODY = False
+
+    def __init__(self, graph, *args, **kwargs):
+        Callback.__init__(self, *args, **kwargs)
+
+        assert isinstance(graph, _db.Webgraph), \
+            "graph must be a db.Webgraph instance"
+        self.graph = graph
+        self.__enter__()
+
+    def __call__(self, response):
+        _continue, links = Callback.__call__(self, response)
+        self.store(response, links)
+        return _continue, links
+
+    def __del__(self):
+        self.__exit__()
+
+    def __enter__(self):
+        self.graph.__enter__()
+        return self
+
+    def __exit__(self, *exception):
+        """sync and exit the graph"""
+        self.graph.__exit__()
+
+    def store(self, response, links):
+        """store a response's links"""
+        self.graph.add(response.url, links)
@@ -0,0 +1,534 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections
+import hashlib
+import multiprocessing
+import os
+import signal
+import socket
+import SocketServer
+import struct
+import threading
+import time
+
+from lib import disque
+import url
+
+__doc__ = """
+distributed spidering, with hosts hash-partitioned across nodes
+
+each node owns the hosts whose hash falls in its partition,
+and forwards links it discovers for other partitions
+to their owners in batches, using a simple framed protocol:
+    request: 4-octet big-endian length + newline-separated URLs
+    response: ACK, once the batch is in the owner's frontier
+
+nodes also report to node 0 (which detects the end of the crawl:
+see Termination), in the same framing:
+    request: 4-octet big-endian length + NUL + a packed REPORT
+    response: ACK, or FINISHED once the crawl is over
+"""
+
+global ACK
+ACK = "\x06"
+
+global FINISHED
+FINISHED = "\x04"
+
+global REPORT
+REPORT = struct.Struct("!I?QQ") # index, idle, batches sent and received
+
+def owner(link, nnodes, url_class = url.DEFAULT_URL_CLASS):
+    """return the index of the node owning a link's host"""
+    try:
+        host = url_class(link)._domains().lower()
+    except (IndexError, SyntaxError, TypeError, ValueError):
+        host = ""
+    return int(hashlib.md5(host).hexdigest(), 16) % nnodes
+
+def pack_batch(links):
+    """frame a batch of links"""
+    payload = "\n".join(links)
+    return struct.pack("!I", len(payload)) + payload
+
+def pack_report(index, idle, sent, received):
+    """frame a node's report"""
+    payload = "\x00" + REPORT.pack(index, idle, sent, received)
+    return struct.pack("!I", len(payload)) + payload
+
+def parse_nodes(string):
+    """parse "HOST:PORT,HOST:PORT,..." into a list of addresses"""
+    nodes = []
+
+    for node in string.split(','):
+        host, port = node.strip().rsplit(':', 1)
+        nodes.append((host, int(port)))
+    return nodes
+
+def launch_local(nnodes, spider_factory, directory = "nodes", seeds = (),
+        host = "127.0.0.1", base_port = 7070, idle_timeout = 5, **kwargs):
+    """
+    launch nnodes nodes as local processes (a stand-in for a cluster),
+    storing node i under directory/node-i, and wait for them to finish
+
+    the nodes stop once this process exits, or is interrupted
+    (or terminated); if a node fails, the others are stopped too
+    """
+    nodes = [(host, base_port + i) for i in range(nnodes)]
+    processes = []
+    terminate = signal.signal(signal.SIGTERM, _raise_interrupt)
+
+    try:
+        for i in range(nnodes):
+            node = DistributedNode(nodes, i, spider_factory,
+                os.path.join(directory, "node-%u" % i), seeds,
+                idle_timeout = idle_timeout, parent = os.getpid(),
+                **kwargs)
+            processes.append(multiprocessing.Process(target = node))
+            processes[-1].start()
+
+        while any((p.is_alive() for p in processes)):
+            if any((p.exitcode for p in processes)): # a node failed
+                break
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, terminate)
+
+        for p in processes: # (each saves its frontier and outbox)
+            if p.is_alive():
+                p.terminate()
+
+        for p in processes:
+            p.join()
+
+class DistributedNode:
+    """
+    a single node of a distributed crawl
+
+    the node keeps its own frontier (a disque.Disque),
+    visited set (a disque.Seen) and whatever storage spider_factory sets up,
+    all under directory; spider_factory is called as
+    spider_factory(url_queue, directory), where url_queue is
+    the node's PartitionedQueue
+
+    seeds outside the node's partition are ignored,
+    so every node may be given the same seeds
+
+    the node serves its frontier at nodes[index];
+    it runs until interrupted, until the process parent exits
+    (when specified), or, unless idle_timeout is None,
+    until the whole crawl is over: every node has been idle
+    (an empty frontier and nothing left to forward),
+    with every batch sent received, for idle_timeout seconds;
+    node 0 decides (see Termination), from the other nodes' reports
+    """
+
+    def __init__(self, nodes, index, spider_factory, directory = "node",
+            seeds = (), idle_timeout = None, chunk_size = 2048,
+            batch_size = 256, flush_interval = 1, compression = None,
+            parent = None):
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.index = index
+        self.nodes = nodes
+        self.parent = parent
+        self._reporter = None # the connection to node 0
+        self.seeds = seeds
+        self.spider_factory = spider_factory
+        self._stopping = False
+
+    def __call__(self):
+        """crawl until finished or told otherwise"""
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self._interrupt)
+
+        if self.parent is not None:
+            watcher = threading.Thread(target = self._watch_parent)
+            watcher.daemon = True
+            watcher.start()
+        url_queue = disque.Disque(os.path.join(self.directory, "queue"),
+            chunk_size = self.chunk_size, compression = self.compression)
+        server = FrontierServer(self.nodes[self.index], url_queue)
+
+        if self.index == 0 and self.idle_timeout is not None:
+            server.termination = Termination(len(self.nodes),
+                self.idle_timeout)
+        server_thread = threading.Thread(target = server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        partitioned = PartitionedQueue(url_queue, self.nodes, self.index,
+            os.path.join(self.directory, "outbox"), self.batch_size,
+            self.flush_interval)
+
+        for seed in self.seeds:
+            if partitioned.owns(seed):
+                url_queue.put(seed)
+        spider = self.spider_factory(partitioned, self.directory)
+        spider.seen = disque.Seen(os.path.join(self.directory, "seen"))
+
+        with spider.seen:
+            spider.__enter__()
+
+            try:
+                while not self._stopping:
+                    spider()
+                    sent, received = partitioned.sent, server.received
+                    idle = url_queue.empty() and not partitioned.pending()
+
+                    if self.idle_timeout is not None \
+                            and self._report(server, idle, sent, received,
+                                partitioned.timeout):
+                        break
+                    time.sleep(0.1)
+
+                if server.termination is not None: # tell the others
+                    deadline = time.time() + partitioned.timeout
+
+                    while not self._stopping and time.time() < deadline \
+                            and not server.termination.all_told():
+                        time.sleep(0.1)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if self._reporter is not None:
+                    self._reporter.close()
+                server.shutdown()
+                server.server_close()
+                spider.__exit__() # syncs the frontier and the outbox
+
+    def _interrupt(self, *args):
+        """signal handler"""
+        if self._stopping: # (don't interrupt saving)
+            return
+        self._stopping = True
+        raise KeyboardInterrupt()
+
+    def _report(self, server, idle, sent, received, timeout):
+        """report to node 0, and return whether the crawl is over"""
+        if server.termination is not None:
+            return server.termination.report(self.index, idle, sent,
+                received)
+
+        try:
+            if self._reporter is None:
+                self._reporter = socket.create_connection(self.nodes[0],
+                    timeout)
+            self._reporter.sendall(pack_report(self.index, idle, sent,
+                received))
+            return self._reporter.recv(1) == FINISHED
+        except (socket.error, socket.timeout): # (node 0 isn't up yet)
+            if self._reporter is not None:
+                self._reporter.close()
+                self._reporter = None
+        return False
+
+    def _watch_parent(self):
+        """interrupt the node once its parent exits"""
+        while os.getppid() == self.parent:
+            time.sleep(1)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+class FrontierServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """accept batches of links into a frontier"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, url_queue):
+        SocketServer.TCPServer.__init__(self, address, FrontierHandler)
+        self.received = 0 # batches
+        self._received_lock = threading.Lock()
+        self.termination = None # node 0's Termination
+        self.url_queue = url_queue
+
+class FrontierHandler(SocketServer.StreamRequestHandler):
+    """handle batches from a single peer"""
+
+    def handle(self):
+        while 1:
+            header = self.rfile.read(4)
+
+            if len(header) < 4:
+                return
+            size = struct.unpack("!I", header)[0]
+            payload = self.rfile.read(size)
+
+            if len(payload) < size:
+                return
+
+            if payload.startswith("\x00"): # a report
+                self.wfile.write(FINISHED
+                    if self.server.termination is not None
+                    and self.server.termination.report(
+                        *REPORT.unpack(payload[1:]))
+                    else ACK)
+                self.wfile.flush()
+                continue
+            links = [l for l in payload.split("\n") if l]
+
+            for i, l in enumerate(links):
+                if isinstance(self.server.url_queue, disque.Disque):
+                    # persist before acknowledging
+                    self.server.url_queue.put(l, i == len(links) - 1)
+                else:
+                    self.server.url_queue.put(l)
+
+            with self.server._received_lock: # (counted before the ACK)
+                self.server.received += 1
+            self.wfile.write(ACK)
+            self.wfile.flush()
+
+class PartitionedQueue:
+    """
+    a queue that keeps links for its own partition in url_queue,
+    and forwards the rest to their owners in batches
+
+    batches are sent once batch_size links are buffered for a node,
+    or every flush_interval seconds; a batch is only dropped once its owner
+    acknowledges it (and counted in sent), and one that isn't is saved to
+    a disque.Disque at outbox_directory (when specified, else kept
+    in memory), as is anything unsent on exit; the outbox is resent
+    every retry_interval seconds (and on the next start),
+    and a node that didn't acknowledge isn't sent to again until then
+
+    get, empty and ack are passed through to url_queue
+    """
+
+    def __init__(self, url_queue, nodes, index, outbox_directory = None,
+            batch_size = 256, flush_interval = 1, timeout = 10,
+            url_class = url.DEFAULT_URL_CLASS, retry_interval = 10):
+        self.batch_size = batch_size
+        self._buffers = [collections.deque() for n in nodes]
+        self._connections = {}
+        self._down = {} # node -> when it last failed to acknowledge
+        self.flush_interval = flush_interval
+        self.index = index
+        self._lock = threading.RLock()
+        self.nodes = nodes
+        self._outbox = None
+        self.outbox_directory = outbox_directory
+        self._resent = 0 # when the outbox was last resent
+        self.retry_interval = retry_interval
+        self.sent = 0 # batches
+        self.timeout = timeout
+        self.url_class = url_class
+        self.url_queue = url_queue
+
+        if outbox_directory:
+            self._outbox = disque.Disque(outbox_directory)
+        self._flusher = threading.Thread(target = self._flush_loop)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def ack(self, link):
+        if hasattr(self.url_queue, "ack"):
+            getattr(self.url_queue, "ack")(link)
+
+    def _deliver(self, node, batch):
+        """
+        send a batch to a node, or save it to the outbox;
+        return whether it was acknowledged
+        """
+        if node in self._down \
+                and time.time() - self._down[node] < self.retry_interval:
+            acknowledged = False
+        else:
+            acknowledged = self._send(node, batch)
+
+        if acknowledged:
+            self._down.pop(node, None)
+            self.sent += 1
+            return True
+
+        if not node in self._down:
+            self._down[node] = time.time()
+
+        if self._outbox is None: # retry later
+            self._buffers[node].extendleft(reversed(batch))
+        else:
+            for i, link in enumerate(batch):
+                self._outbox.put(link, i == len(batch) - 1)
+        return False
+
+    def empty(self):
+        return self.url_queue.empty()
+
+    def __enter__(self):
+        if hasattr(self.url_queue, "__enter__"):
+            getattr(self.url_queue, "__enter__")()
+        return self
+
+    def __exit__(self, *exception):
+        self.flush()
+
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections = {}
+
+            if self._outbox is not None:
+                for buffer in self._buffers:
+                    while len(buffer):
+                        self._outbox.put(buffer.popleft())
+                self._outbox.__exit__()
+
+        if hasattr(self.url_queue, "__exit__"):
+            getattr(self.url_queue, "__exit__")()
+
+    def flush(self):
+        """send as many buffered batches as possible"""
+        with self._lock:
+            if self._outbox is not None and not self._outbox.empty() \
+                    and time.time() - self._resent >= self.retry_interval:
+                self._resend()
+
+            for node in range(len(self.nodes)):
+                self._flush_buffer(node)
+
+    def _flush_buffer(self, node, minimum = 1):
+        """send batches from a node's buffer while minimum are buffered"""
+        buffer = self._buffers[node]
+
+        while len(buffer) >= minimum:
+            if not self._deliver(node, [buffer.popleft()
+                    for i in range(min(self.batch_size, len(buffer)))]) \
+                    and self._outbox is None:
+                break
+
+    def _flush_loop(self):
+        """periodically flush the buffers"""
+        while 1:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def get(self):
+        return self.url_queue.get()
+
+    def owns(self, link):
+        """return whether a link belongs to this partition"""
+        return owner(link, len(self.nodes), self.url_class) == self.index
+
+    def pending(self):
+        """
+        return the number of links waiting to be forwarded
+        (including any being sent, and those in the outbox)
+        """
+        with self._lock:
+            return sum((len(b) for b in self._buffers)) \
+                + (self._outbox.qsize() if self._outbox is not None else 0)
+
+    def put(self, link):
+        node = owner(link, len(self.nodes), self.url_class)
+
+        if node == self.index:
+            self.url_queue.put(link)
+            return
+
+        with self._lock:
+            self._buffers[node].append(link)
+            self._flush_buffer(node, self.batch_size)
+
+    def _resend(self):
+        """move the outbox back through the buffers (the lock must be held)"""
+        self._resent = time.time()
+
+        for i in xrange(self._outbox.qsize()): # (not what's saved again)
+            if self._outbox.empty():
+                break
+            link = self._outbox.get()
+            node = owner(link, len(self.nodes), self.url_class)
+            self._buffers[node].append(link)
+            self._flush_buffer(node, self.batch_size)
+
+    def _send(self, node, batch):
+        """send a batch to a node, and return whether it was acknowledged"""
+        try:
+            if not node in self._connections:
+                self._connections[node] = socket.create_connection(
+                    self.nodes[node], self.timeout)
+            conn = self._connections[node]
+            conn.sendall(pack_batch(batch))
+
+            if not conn.recv(1) == ACK:
+                raise socket.error("batch wasn't acknowledged")
+            return True
+        except (socket.error, socket.timeout):
+            if node in self._connections:
+                self._connections.pop(node).close()
+        return False
+
+class Termination:
+    """
+    detect the end of a distributed crawl, from each node's reports
+    of whether it's idle, and how many batches it's sent and received
+
+    the crawl is over once every node's last report is idle,
+    with as many batches received as sent in all, and every node
+    has reported the same again, at least idle_timeout seconds later:
+    an idle node only gets work by receiving a batch,
+    which would change its report
+    """
+
+    def __init__(self, nnodes, idle_timeout = 0):
+        self.finished = False
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._reports = [None] * nnodes # (idle, sent, received)
+        self._since = None # when the reports were last all idle
+        self._since_reports = set() # nodes reporting the same since then
+        self._told = set() # nodes told that the crawl is over
+
+    def all_told(self):
+        """return whether every other node has been told it's over"""
+        with self._lock:
+            return len(self._told | set((0, ))) == len(self._reports)
+
+    def report(self, index, idle, sent, received):
+        """record a node's report, and return whether the crawl is over"""
+        with self._lock:
+            report = (idle, sent, received)
+
+            if not self.finished and not self._reports[index] == report:
+                self._reports[index] = report
+                self._since = None
+
+            if self.finished:
+                pass
+            elif self._since is None:
+                if all((r is not None and r[0] for r in self._reports)) \
+                        and sum((r[1] for r in self._reports)) \
+                        == sum((r[2] for r in self._reports)):
+                    self._since = time.time()
+                    self._since_reports = set()
+            else:
+                self._since_reports.add(index)
+                self.finished = len(self._since_reports) \
+                    == len(self._reports) \
+                    and time.time() - self._since >= self.idle_timeout
+
+            if self.finished:
+                self._told.add(index)
+            return self.finished
+
+def _raise_interrupt(*args):
+    """signal handler"""
+    raise KeyboardInterrupt()
@@ -13,14 +13,29 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import codecs
 import HTMLParser
 import Queue
+import re
+import xml.sax.saxutils
+
+import neardup
 
 __doc__ = "basic HTML extraction"
 
+KINDS = {"application/xhtml+xml": "html", "application/xml": "sitemap",
+    "text/css": "css", "text/html": "html", "text/xml": "sitemap"}
+
+SIGNATURES = (("\x89PNG", "image/png"), ("GIF8", "image/gif"),
+    ("\xff\xd8\xff", "image/jpeg"), ("%PDF-", "application/pdf"),
+    ("PK\x03\x04", "application/zip"), ("\x1f\x8b", "application/gzip"),
+    ("<!doctype html", "text/html"), ("<html", "text/html"),
+    ("<head", "text/html"), ("<body", "text/html"),
+    ("<?xml", "application/xml"), ("<urlset", "application/xml"),
+    ("<sitemapindex", "application/xml"))
+
 def extract_links(header, body, src = False):
     """convenience function to parse links from an HTTP response"""
-    links = []
     parser = AttributeExtractor("href", "src")
     
     try:
@@ -28,37 +43,79 @@ def extract_links(header, body, src = False):
         parser.close()
     except KeyboardInterrupt:
         raise KeyboardInterrupt()
+    return [v for a, v in parser.drain()]
 
-    while 1:
+def _decoder(header):
+    """
+    return an incremental decoder for the first charset named
+    by a header that's known, or False
+    """
+    for charset in _charsets(header):
         try:
-            links.append(parser.get_nowait()[1])
-        except Queue.Empty:
-            break
-    return links
+            return codecs.getincrementaldecoder(charset)("replace")
+        except LookupError:
+            pass
+    return False
+
+def _charsets(header):
+    """generate the charsets named by a header's Content-Type"""
+    if header and header.has_key("Content-Type"):
+        for k_v in header["Content-Type"].split(';'):
+            if not '=' in k_v:
+                continue
+            k, v = [e.strip() for e in k_v.split('=', 1)]
+
+            if k.lower() == "charset":
+                yield v.strip("\"'")
+
+class _Draining(Queue.Queue):
+    def drain(self):
+        """return a list of everything extracted so far"""
+        items = []
+
+        while 1:
+            try:
+                items.append(self.get_nowait())
+            except Queue.Empty:
+                break
+        return items
+
+class Extractor(HTMLParser.HTMLParser, _Draining):
+    """
+    an HTML parser which queues what it extracts
+
+    the body may be fed all at once (feed),
+    or in chunks (feed_chunk), which are decoded incrementally
+    """
 
-class Extractor(HTMLParser.HTMLParser, Queue.Queue):
     def __init__(self):
         HTMLParser.HTMLParser.__init__(self)
-        Queue.Queue.__init__(self)
+        _Draining.__init__(self)
+        self._decoder = None # undetermined
 
     def feed(self, body, header = None):
         """attempt to decode the HTML body before feeding"""
-        if header and header.has_key("Content-Type"):
-            for k_v in header["Content-Type"].split(';'):
-                if not '=' in k_v:
-                    continue
-                k, v = [e.strip() for e in k_v.split('=', 1)]
-
-                if not k.lower() == "charset":
-                    continue
-                
-                try:
-                    body = body.decode(v)
-                    break
-                except ValueError:
-                    pass
+        for charset in _charsets(header):
+            try:
+                body = body.decode(charset)
+                break
+            except (LookupError, ValueError):
+                pass
         HTMLParser.HTMLParser.feed(self, body)
 
+    def feed_chunk(self, chunk, header = None, final = False):
+        """
+        feed part of the HTML body, decoding it incrementally
+        (with the first charset named by the header that's known);
+        the last chunk should be fed with final set
+        """
+        if self._decoder is None:
+            self._decoder = _decoder(header)
+
+        if self._decoder:
+            chunk = self._decoder.decode(chunk, final)
+        HTMLParser.HTMLParser.feed(self, chunk)
+
 class AttributeExtractor(Extractor):
     def __init__(self, *attrs):
         Extractor.__init__(self)
@@ -69,6 +126,88 @@ class AttributeExtractor(Extractor):
             if a.lower().strip() in self.attrs:
                 self.put((a, v))
 
+class PatternExtractor(_Draining):
+    """
+    a fast extractor for what isn't HTML, queueing ("url", value)
+    for each match of PATTERN (its first nonempty group),
+    without parsing
+
+    like an Extractor, it may be fed in chunks (which are decoded
+    incrementally); up to overlap characters are kept between chunks,
+    so a match may span them
+    """
+
+    PATTERN = None
+
+    def __init__(self, overlap = 4096):
+        _Draining.__init__(self)
+        self._buffer = ""
+        self._decoder = None # undetermined
+        self.overlap = overlap
+
+    def close(self):
+        pass
+
+    def feed(self, body, header = None):
+        self.feed_chunk(body, header, True)
+
+    def feed_chunk(self, chunk, header = None, final = False):
+        """feed part of the body; the last should be fed with final set"""
+        if self._decoder is None:
+            self._decoder = _decoder(header)
+
+        if self._decoder:
+            chunk = self._decoder.decode(chunk, final)
+        self._buffer += chunk
+        end = 0
+
+        for match in self.PATTERN.finditer(self._buffer):
+            self.put(("url", self._value(match)))
+            end = match.end()
+        self._buffer = "" if final \
+            else self._buffer[max(end, len(self._buffer) - self.overlap):]
+
+    def _value(self, match):
+        return [g for g in match.groups() if g][0]
+
+class CSSExtractor(PatternExtractor):
+    """extract the url() and @import references of a stylesheet"""
+
+    PATTERN = re.compile(r"""url\(\s*(?:"([^"]+)"|'([^']+)'|([^)'"\s]+))"""
+        r"""\s*\)|@import\s+(?:"([^"]+)"|'([^']+)')""", re.I)
+
+class SitemapExtractor(PatternExtractor):
+    """extract the <loc> URLs of a sitemap (or sitemap index)"""
+
+    PATTERN = re.compile(r"<loc>\s*([^<\s][^<]*?)\s*</loc>", re.I)
+
+    def _value(self, match):
+        return xml.sax.saxutils.unescape(match.group(1))
+
+class SimHashExtractor(AttributeExtractor):
+    """
+    an AttributeExtractor which also computes the SimHash
+    (a neardup.SimHash) of the text, outside scripts and styles
+    """
+
+    def __init__(self, *attrs):
+        AttributeExtractor.__init__(self, *attrs)
+        self._script = False
+        self.simhash = neardup.SimHash()
+
+    def handle_data(self, data):
+        if not self._script:
+            self.simhash.update(data)
+
+    def handle_endtag(self, tag):
+        self._script = False
+        self.simhash.break_word()
+
+    def handle_starttag(self, tag, attrs):
+        AttributeExtractor.handle_starttag(self, tag, attrs)
+        self._script = tag.lower() in ("script", "style")
+        self.simhash.break_word()
+
 class TagExtractor(Extractor):
     def __init__(self, *tags):
         Extractor.__init__(self)
@@ -77,3 +216,23 @@ class TagExtractor(Extractor):
     def handle_starttag(self, tag, attrs):
         if tag.lower() in self.tags:
             self.put((tag, attrs))
+
+def sniff(header, prefix = ""):
+    """
+    return a response's MIME type: its Content-Type's,
+    or (lacking one) that sniffed from the first octets of its body,
+    by SIGNATURES ("application/octet-stream" if none match)
+    """
+    if header and header.getheader("content-type"):
+        return header.getheader("content-type").split(';')[0].strip().lower()
+    prefix = prefix.lstrip("\xef\xbb\xbf \t\r\n")
+
+    for signature, mimetype in SIGNATURES:
+        if prefix[:len(signature)].lower() == signature.lower():
+            if mimetype == "application/xml" and "<html" in prefix.lower():
+                return "application/xhtml+xml"
+            return mimetype
+
+    if "<html" in prefix.lower():
+        return "text/html"
+    return "application/octet-stream"
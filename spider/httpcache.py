@@ -0,0 +1,143 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import email.utils
+import time
+import urllib2
+
+from lib import threaded
+import replay
+
+__doc__ = "HTTP caching for recrawls"
+
+class CachingOpener:
+    """
+    an urlopen replacement (see Spider) which uses the responses
+    stored by StorageCallback in a db.DB as an HTTP cache
+
+    a GET for a stored URL is answered from the database,
+    without touching the network, while the stored response is fresh
+    (per its Cache-Control max-age, or Expires, relative to its Date);
+    otherwise the request is made conditional
+    (with If-None-Match and If-Modified-Since, from the stored ETag
+    and Last-Modified), and a 304 is answered with the stored response,
+    its header updated from the 304's
+
+    cached responses are replay.ReplayResponse instances, so they're
+    read (and stored again) by the callback just as fetched ones are;
+    hits, revalidations and misses are counted
+    """
+
+    UPDATED = ("Cache-Control", "Date", "ETag", "Expires", "Last-Modified")
+
+    def __init__(self, db, urlopen = urllib2.urlopen):
+        self.db = db
+        self.hits = threaded.Synchronized(0)
+        self.misses = threaded.Synchronized(0)
+        self.revalidations = threaded.Synchronized(0)
+        self.urlopen = urlopen
+
+    def __call__(self, request, *args, **kwargs):
+        """open a request (or URL), using the cache where possible"""
+        if isinstance(request, basestring):
+            request = urllib2.Request(request)
+        stored = None
+
+        if request.get_method() == "GET":
+            url = request.get_full_url()
+
+            try:
+                stored = replay.ReplayResponse.from_entry(url,
+                    self.db.entry(url))
+            except (IOError, KeyError, ValueError): # not stored
+                pass
+
+        if stored is not None:
+            header = stored.info()
+
+            if fresh(header):
+                self.hits.transform(lambda n: n + 1)
+                return stored
+
+            if header.getheader("etag"):
+                request.add_header("If-None-Match", header.getheader("etag"))
+
+            if header.getheader("last-modified"):
+                request.add_header("If-Modified-Since",
+                    header.getheader("last-modified"))
+
+        try:
+            response = self.urlopen(request, *args, **kwargs)
+        except urllib2.HTTPError as e:
+            if stored is None or not e.code == 304:
+                raise e
+
+            for name in CachingOpener.UPDATED:
+                if e.info() and e.info().getheader(name):
+                    stored.info()[name] = e.info().getheader(name)
+            self.revalidations.transform(lambda n: n + 1)
+            return stored
+        self.misses.transform(lambda n: n + 1)
+        return response
+
+    def stats(self):
+        """return a dict with the counters"""
+        return {"hits": self.hits.get(), "misses": self.misses.get(),
+            "revalidations": self.revalidations.get()}
+
+def _directives(header):
+    """return a dict of a header's Cache-Control directives"""
+    directives = {}
+
+    for directive in (header.getheader("cache-control") or "").split(','):
+        name, _, value = directive.partition('=')
+
+        if name.strip():
+            directives[name.strip().lower()] = value.strip().strip('"')
+    return directives
+
+def fresh(header, now = None):
+    """
+    return whether a response (by its header, a mimetools.Message)
+    is still fresh, by its explicit lifetime
+    (no lifetime is guessed for responses without one)
+    """
+    directives = _directives(header)
+
+    if "no-cache" in directives or "no-store" in directives:
+        return False
+    date = email.utils.parsedate_tz(header.getheader("date") or "")
+
+    if not date:
+        return False
+    date = email.utils.mktime_tz(date)
+
+    if "max-age" in directives:
+        try:
+            lifetime = int(directives["max-age"])
+        except ValueError:
+            return False
+    else:
+        expires = email.utils.parsedate_tz(header.getheader("expires") or "")
+
+        if not expires:
+            return False
+        lifetime = email.utils.mktime_tz(expires) - date
+
+    try:
+        age = int(header.getheader("age") or 0)
+    except ValueError:
+        age = 0
+    return max((now or time.time()) - date, 0) + age < lifetime
@@ -15,8 +15,20 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 __package__ = __name__
 
+import cached
+from cached import CachedDB
 import db
 from db import DB
+import dedup
+from dedup import DedupDB
+import segment
+from segment import SegmentDB
+import sharded
+from sharded import ShardedDB
+import webgraph
+from webgraph import Webgraph
+import writer
+from writer import DBWriter, WriteError
 
 if __name__ == "__main__":
     import csv
@@ -0,0 +1,215 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections
+import threading
+
+import db as _db
+
+__doc__ = "an in-process read cache for databases"
+
+class CachedDB(_db.DB):
+    """
+    a least-recently-used read cache in front of another db.DB
+
+    up to max_bytes octets of entry data are kept in memory
+    (values larger than that aren't cached); writes through this instance
+    invalidate the names they touch, but writes through other instances
+    (or processes) aren't seen, so this suits read-mostly use
+
+    everything else is passed through to the underlying database;
+    hits and misses are counted, so the cache can be sized (see stats)
+    """
+
+    def __init__(self, db, max_bytes = 67108864):
+        self.db = db
+        self.directory = db.directory
+        self.hits = 0
+        self._invalidations = 0 # so a racing miss can't cache stale data
+        self._lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.misses = 0
+        self._nbytes = 0
+        self.readonly = db.readonly
+        self._values = collections.OrderedDict() # name -> data, oldest first
+
+    def append(self, name, data, *args, **kwargs):
+        self.invalidate(name)
+
+        try:
+            return self.db.append(name, data, *args, **kwargs)
+        finally:
+            self.invalidate(name)
+
+    def clean(self, *args, **kwargs):
+        self.clear()
+        return self.db.clean(*args, **kwargs)
+
+    def clear(self):
+        """empty the cache (the counters are kept)"""
+        with self._lock:
+            self._invalidations += 1
+            self._values.clear()
+            self._nbytes = 0
+
+    def __contains__(self, name):
+        with self._lock:
+            if self._key(name) in self._values:
+                return True
+        return name in self.db
+
+    def __del__(self):
+        pass # the underlying database cleans up after itself
+
+    def __delitem__(self, name):
+        try:
+            del self.db[name]
+        finally:
+            self.invalidate(name)
+
+    def deregister(self, name):
+        self.invalidate(name)
+        return self.db.deregister(name)
+
+    def __enter__(self):
+        self.db.__enter__()
+        return self
+
+    def entry(self, name):
+        return self.db.entry(name)
+
+    def existent(self):
+        return self.db.existent()
+
+    def __exit__(self, *exception):
+        return self.db.__exit__(*exception)
+
+    def __getitem__(self, name):
+        """retrieve an entry, from the cache if possible"""
+        key = self._key(name)
+
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                data = self._values.pop(key)
+                self._values[key] = data # now the most recent
+                return data
+            self.misses += 1
+            invalidations = self._invalidations
+        data = self.db[name]
+
+        if len(data) <= self.max_bytes:
+            with self._lock:
+                if not invalidations == self._invalidations:
+                    return data
+
+                if key in self._values:
+                    self._nbytes -= len(self._values.pop(key))
+                self._values[key] = data
+                self._nbytes += len(data)
+
+                while self._nbytes > self.max_bytes:
+                    self._nbytes -= len(self._values.popitem(False)[1])
+        return data
+
+    def invalidate(self, name):
+        """drop a name from the cache"""
+        with self._lock:
+            self._invalidations += 1
+            data = self._values.pop(self._key(name), None)
+
+            if data is not None:
+                self._nbytes -= len(data)
+
+    def iternames(self):
+        return self.db.iternames()
+
+    def _key(self, name):
+        return tuple(_db._as_list(name))
+
+    def __len__(self):
+        return len(self.db)
+
+    def list(self):
+        return self.db.list()
+
+    def register(self, name):
+        return self.db.register(name)
+
+    def __setitem__(self, name, data):
+        self.invalidate(name)
+
+        try:
+            self.db[name] = data
+        finally:
+            self.invalidate(name)
+
+    def stats(self):
+        """return a dict with the cache's counters and usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"bytes": self._nbytes, "entries": len(self._values),
+                "hit-rate": float(self.hits) / lookups if lookups else 0.0,
+                "hits": self.hits, "max-bytes": self.max_bytes,
+                "misses": self.misses}
+
+    def traverse(self, *args, **kwargs):
+        return self.db.traverse(*args, **kwargs)
+
+    def update(self, pairs, *args, **kwargs):
+        pairs = list(pairs)
+
+        for name, data in pairs:
+            self.invalidate(name)
+
+        try:
+            return self.db.update(pairs, *args, **kwargs)
+        finally:
+            for name, data in pairs:
+                self.invalidate(name)
+
+    def writer(self, name):
+        """return a writer from the underlying database, which invalidates"""
+        self.invalidate(name)
+        return _InvalidatingWriter(self, self.db.writer(name), name)
+
+class _InvalidatingWriter:
+    """wrap a stream writer, invalidating its name once it's closed"""
+
+    def __init__(self, cache, writer, name):
+        self.cache = cache
+        self.name = name
+        self.writer = writer
+
+    def abort(self):
+        self.writer.abort()
+
+    def close(self):
+        try:
+            return self.writer.close()
+        finally:
+            self.cache.invalidate(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        try:
+            return self.writer.__exit__(*exception)
+        finally:
+            self.cache.invalidate(self.name)
+
+    def write(self, data):
+        self.writer.write(data)
@@ -0,0 +1,125 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import sqlite3
+import threading
+
+__doc__ = "an indexed catalog of database entry names"
+
+class Catalog:
+    """
+    a persistent, sorted set of entry names, backed by an SQLite table
+
+    a name (a list of components) is keyed by its components joined
+    with NUL octets, as a BLOB, so the key order matches the order
+    of the names as lists; components therefore mustn't contain NULs
+
+    the number of names is kept in a separate table,
+    maintained alongside every change, so len is O(1)
+    """
+
+    def __init__(self, path, timeout = 60):
+        self._connection = sqlite3.connect(path, timeout,
+            check_same_thread = False, isolation_level = None)
+        self._lock = threading.RLock()
+        self.path = path
+
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS names"
+                " (name BLOB PRIMARY KEY) WITHOUT ROWID")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS size"
+                " (n INTEGER)")
+
+            if self._connection.execute("SELECT COUNT(*) FROM size") \
+                    .fetchone()[0] == 0:
+                self._connection.execute("INSERT INTO size VALUES (0)")
+
+    def add(self, name):
+        """add a name, and return whether it was new"""
+        return self.update((name, )) == 1
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM names"
+                " WHERE name = ?", (self._encode(name), )).fetchone() \
+                is not None
+
+    def _decode(self, key):
+        return str(key).split("\x00")
+
+    def discard(self, name):
+        """remove a name, and return whether it existed"""
+        return self.difference_update((name, )) == 1
+
+    def difference_update(self, names):
+        """remove names in a single transaction; return how many existed"""
+        return self._change("DELETE FROM names WHERE name = ?", -1, names)
+
+    def _change(self, statement, sign, names):
+        """apply a statement to names, and maintain the size"""
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+
+            try:
+                n = 0
+
+                for name in names:
+                    cursor.execute(statement, (self._encode(name), ))
+                    n += cursor.rowcount
+                cursor.execute("UPDATE size SET n = n + ?", (sign * n, ))
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+            return n
+
+    def _encode(self, name):
+        if not isinstance(name, list) and not isinstance(name, tuple):
+            name = [name]
+        return buffer("\x00".join(("" if n is None else str(n)
+            for n in name)))
+
+    def __iter__(self):
+        """generate the names in sorted order"""
+        cursor = self._connection.cursor()
+
+        with self._lock:
+            cursor.execute("SELECT name FROM names ORDER BY name")
+
+        while 1:
+            with self._lock:
+                rows = cursor.fetchmany(1024)
+
+            if not rows:
+                break
+
+            for row in rows:
+                yield self._decode(row[0])
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT n FROM size") \
+                .fetchone()[0]
+
+    def update(self, names):
+        """add names in a single transaction; return how many were new"""
+        return self._change("INSERT OR IGNORE INTO names VALUES (?)", 1,
+            names)
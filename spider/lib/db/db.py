@@ -14,12 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import csv
+import errno
 import fcntl
 import hashlib
+import mmap
 import os
 import StringIO
 import sys
+import tempfile
 
+from catalog import Catalog
 from lib import withfile
 
 __doc__ = "a string-based database"
@@ -36,16 +40,25 @@ class DB:
     """
     an extensible string-based database
     
-    the database is made up of two main components:
+    the database is made up of three main components:
     1. the database file
         a ragged CSV document where each row is a list of name components
-    2. entries
+    2. the catalog
+        an indexed (catalog.Catalog) copy of the registered names,
+        through which names are counted, tested, removed and listed;
+        it's built from the database file the first time it's opened,
+        and clean rewrites the database file from it
+    3. entries
         the corresponding raw data for an entry name,
         stored at "directory/subtree of hashed name components/entry.dat"
 
     the database model is dict-like, but is intended for extensibility
     through its simplicity
 
+    in readonly mode, nothing is created or written (writes raise an IOError),
+    and a missing catalog is built in memory instead;
+    reads only ever take shared locks
+
     the functions follow a simple model for integrity purposes:
     1. enter as needed
     2. open any files
@@ -57,69 +70,121 @@ class DB:
     8. return any data
     """
     
-    def __init__(self, directory = os.getcwd(), hash = "sha256"):
+    def __init__(self, directory = os.getcwd(), hash = "sha256",
+            readonly = False):
+        self.catalog = None
         self.directory = os.path.realpath(directory)
         self._fp = None
         hash = getattr(hashlib, hash)
         self._hash = lambda s: hash(str(s)).hexdigest()
+        self._lock = None # for the database file
         self.path = os.path.join(self.directory, "db.csv")
         self._reader = None
+        self.readonly = readonly
         self._writer = None
 
     def append(self, name, data, offset = 0, whence = os.SEEK_CUR,
-            truncate = False):
+            truncate = False, sync = True):
         """append data to an entry"""
-        new = not name in self
-            
+        self._writable()
+
         with DBEntry(self._generate_path(name)) as entry:
-            entry.append(data, offset, whence, truncate)
+            entry.append(data, offset, whence, truncate, sync)
 
             if entry.new:
                 self.register(name)
 
     def clean(self, filter = lambda n: True):
-        """filter entries in the database file"""
-        self.__enter__()
+        """
+        filter entries in the catalog,
+        and rewrite the database file from it
+        """
+        self._writable()
 
-        with withfile.FileLock(self._fp):
-            names = self.list()
+        with self._lock:
+            self.catalog.difference_update([n for n in self.catalog
+                if not filter(n)])
             self._fp.seek(0, os.SEEK_SET)
             self._fp.truncate()
 
-            for n in names:
-                if filter(n):
-                    self.register(n)
+            for n in self.catalog:
+                self._writer.writerow(n)
+            self._fp.flush()
+            os.fdatasync(self._fp.fileno())
     
     def __contains__(self, name):
         """return whether an entry exists"""
-        with withfile.FileLock(self._fp):
-            return os.path.exists(self._generate_path(name))
+        self.__enter__()
+        return _as_list(name) in self.catalog
 
     def __del__(self):
         self.__exit__()
 
     def __delitem__(self, name):
         """delete an entry"""
-        with withfile.FileLock(self._fp):
-            with DBEntry(self._generate_path(name)) as entry:
-                entry.delete()
-            self.deregister(name)
+        self._writable()
+
+        with DBEntry(self._generate_path(name)) as entry:
+            entry.delete()
+        self.deregister(name)
 
     def deregister(self, name):
-        """deregister a name from the database file"""
-        name = _as_list(name) # do this only once
-        self.clean(lambda n: not n == name)
+        """
+        deregister a name from the catalog
+
+        the database file keeps the name until the next clean
+        """
+        self._writable()
+        self.catalog.discard(_as_list(name))
     
     def __enter__(self):
+        if self.readonly:
+            return self._enter_readonly()
+
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
         
         if not isinstance(self._fp, file) or self._fp.closed:
             self._fp = open(self.path, "a+b")
+            self._lock = withfile.FileLock(self._fp)
             self._reader = csv.reader(self._fp)
             self._writer = csv.writer(self._fp)
+
+        if self.catalog is None:
+            path = os.path.join(self.directory, "catalog.sqlite")
+
+            with self._lock:
+                new = not os.path.exists(path)
+                self.catalog = Catalog(path)
+
+                if new: # build it from the database file
+                    self._load_catalog()
+        return self
+
+    def _enter_readonly(self):
+        """enter without creating anything"""
+        if (not isinstance(self._fp, file) or self._fp.closed) \
+                and os.path.exists(self.path):
+            self._fp = open(self.path, "rb")
+            self._reader = csv.reader(self._fp)
+
+        if self.catalog is None:
+            path = os.path.join(self.directory, "catalog.sqlite")
+
+            if os.path.exists(path):
+                self.catalog = Catalog(path)
+            else:
+                self.catalog = Catalog(":memory:")
+
+                if isinstance(self._fp, file):
+                    with withfile.FileLock(self._fp, shared = True):
+                        self._load_catalog()
         return self
 
+    def entry(self, name):
+        """return an entry (for I/O on the raw data)"""
+        return DBEntry(self._generate_path(name), self.readonly)
+
     def existent(self):
         """remove redundant/nonexistent entries from the database file"""
         self.clean(lambda n: os.path.exists(self._generate_path(n)))
@@ -130,6 +195,11 @@ class DB:
                 self._fp.close()
             except (IOError, OSError):
                 pass
+        self._fp = None
+
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
 
     def _generate_path(self, name):
         """return the hashed equivalent of a name (None is evaluated as "")"""
@@ -146,52 +216,165 @@ class DB:
 
     def __getitem__(self, name):
         """retrieve an entry"""
-        with DBEntry(self._generate_path(name)) as entry:
-            return entry.get()
+        try:
+            with DBEntry(self._generate_path(name), True) as entry:
+                return entry.get()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(name)
+            raise e
 
     def __len__(self):
         """return the number of unique entries"""
-        return len(self.list())
+        self.__enter__()
+        return len(self.catalog)
+
+    def iternames(self):
+        """generate all the entry names in sorted order"""
+        self.__enter__()
+        return iter(self.catalog)
+    
+    def _load_catalog(self):
+        """add the existent names in the database file to the catalog"""
+        self._fp.seek(0, os.SEEK_SET)
+        self.catalog.update((l for l in self._reader
+            if os.path.exists(self._generate_path(l))))
     
     def list(self):
         """return a sorted list of all the entry names"""
-        self.__enter__()
-        names = set()
-        
-        with withfile.FileLock(self._fp):
-            self._fp.seek(0, os.SEEK_SET)
-            
-            for l in self._reader:
-                if l in self:
-                    names.add(tuple(l))
-        return sorted((list(n) for n in names))
+        return list(self.iternames())
     
     def register(self, name):
         """register a name with the database"""
-        self.__enter__()
+        self._register_all((name, ))
 
-        with withfile.FileLock(self._fp):
+    def _register_all(self, names, sync = True):
+        """register several names in a single transaction"""
+        self._writable()
+        new = []
+
+        with self._lock:
+            for name in names:
+                name = _as_list(name)
+
+                if not name in new and not name in self.catalog:
+                    new.append(name)
+
+            if not new:
+                return
+            self.catalog.update(new)
             self._fp.seek(0, os.SEEK_END)
-            self._writer.writerow(_as_list(name))
+
+            for name in new:
+                self._writer.writerow(name)
             self._fp.flush()
-            os.fdatasync(self._fp.fileno())
+
+            if sync:
+                os.fdatasync(self._fp.fileno())
     
     def __setitem__(self, name, data):
         """store a name mapped to data"""
         self.append(name, data, truncate = True, whence = os.SEEK_SET)
 
+    def update(self, pairs, sync = True):
+        """
+        store several (name, data) pairs as a group (a group commit):
+        the entries are written, then synced together,
+        and the new names are registered in a single transaction
+        """
+        self._writable()
+        entries = []
+        new = []
+
+        try:
+            for name, data in pairs:
+                entries.append(DBEntry(self._generate_path(name)))
+                entries[-1].append(data, 0, os.SEEK_SET, True, False)
+
+                if entries[-1].new:
+                    new.append(name)
+
+            if sync:
+                for entry in entries:
+                    entry.sync()
+        finally:
+            for entry in entries:
+                entry.__exit__()
+        self._register_all(new, sync)
+
     def traverse(self, open = False):
         """
-        generate DBEntry instances while performing
-        an unordered traversal of the database
+        generate entries (see entry) while performing
+        a traversal of the database (in name order)
         """
+        for name in self.iternames():
+            yield self.entry(name)
+
+    def _writable(self):
+        """enter, unless in readonly mode"""
+        if self.readonly:
+            raise IOError("read-only database")
         self.__enter__()
 
-        with withfile.FileLock(self._fp):
-            self._fp.seek(0, os.SEEK_SET)
+    def writer(self, name):
+        """return an EntryWriter, to stream data into an entry"""
+        self._writable()
+        return EntryWriter(self, name)
+
+class EntryWriter:
+    """
+    a file-like writer, streaming data into a DB entry
+
+    the data is written to a temporary file beside entry.dat,
+    which replaces it on close (so the entry's never partially written);
+    exiting with an exception aborts instead
+    """
+
+    def __init__(self, db, name):
+        self.closed = False
+        self.db = db
+        self.directory = db._generate_path(name)
+        self.name = name
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fd, self._path = tempfile.mkstemp(".tmp", "entry.", self.directory)
+        self._fp = os.fdopen(fd, "wb")
+
+    def abort(self):
+        """discard the written data"""
+        if self.closed:
+            return
+        self.closed = True
+        self._fp.close()
+        os.unlink(self._path)
+
+    def close(self):
+        """replace the entry with the written data"""
+        if self.closed:
+            return
+        self.closed = True
+        self._fp.flush()
+        os.fdatasync(self._fp.fileno())
+        self._fp.close()
+        path = os.path.join(self.directory, "entry.dat")
+        new = not os.path.exists(path)
+        os.rename(self._path, path)
+
+        if new:
+            self.db.register(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        if exception and exception[0]:
+            self.abort()
+        else:
+            self.close()
 
-            for name in self._reader:
-                yield DBEntry(self._generate_path(name))
+    def write(self, data):
+        self._fp.write(data)
 
 class DBEntry:
     """
@@ -205,37 +388,57 @@ class DBEntry:
             entry.dat
     where entry-directory is a unique directory,
     and entry.dat contains raw data
+
+    reads take a shared lock, and writes an exclusive one;
+    in readonly mode, the entry is opened without being created
+    (so entering a nonexistent entry raises an IOError)
     """
 
-    def __init__(self, directory):
+    def __init__(self, directory, readonly = False):
         self.directory = directory
         self._fp = None # data file pointer
         self.path = os.path.join(self.directory, "entry.dat")
+        self.readonly = readonly
         self.new = not os.path.exists(self.path) # whether the entry is new
 
-    def append(self, data, offset = 0, whence = os.SEEK_CUR, truncate = False):
+    def append(self, data, offset = 0, whence = os.SEEK_CUR, truncate = False,
+            sync = True):
         """
         append data to the entry
 
         this function is rather slow, as it calls
-        both file.flush and os.fdatasync
+        both file.flush and os.fdatasync (unless sync is False,
+        in which case the caller should sync later)
         """
-        self.__enter__()
+        self._writable()
 
         with withfile.FileLock(self._fp):
             self._fp.seek(offset, whence)
             self._fp.write(data)
-            self._fp.flush()
-            os.fdatasync(self._fp.fileno())
 
             if truncate:
                 self._fp.truncate()
-                self._fp.flush() # just in case, we have to re-sync
+            self._fp.flush()
+
+            if sync:
                 os.fdatasync(self._fp.fileno())
 
+    def chunks(self, offset = 0, buflen = 1048576):
+        """
+        generate the entry's data from offset, in buflen-octet chunks
+        (holding a shared lock until the generator's exhausted or closed)
+        """
+        self.__enter__()
+
+        with withfile.FileLock(self._fp, shared = True):
+            self._fp.seek(offset, os.SEEK_SET)
+
+            for chunk in withfile.BufferedReader(self._fp, buflen):
+                yield chunk
+
     def delete(self, rmemptydirs = True):
         """delete the entry and optionally all empty parent directories"""
-        self.__enter__()
+        self._writable()
 
         with withfile.FileLock(self._fp):
             os.unlink(self.path)
@@ -248,6 +451,11 @@ class DBEntry:
                     dir = os.path.dirname(dir)
 
     def __enter__(self):
+        if self.readonly:
+            if not isinstance(self._fp, file) or self._fp.closed:
+                self._fp = open(self.path, "rb")
+            return self
+
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
 
@@ -271,13 +479,48 @@ class DBEntry:
         self.__enter__()
         data = ""
 
-        with withfile.FileLock(self._fp):
+        with withfile.FileLock(self._fp, shared = True):
             start = self._fp.tell()
             self._fp.seek(offset, whence)
             data = self._fp.read()
             self._fp.seek(start, os.SEEK_SET)
         return data
     
+    def mmap(self):
+        """
+        return a read-only mmap.mmap of the entry's data
+        (or "" if it's empty, since that can't be mapped)
+
+        the view isn't locked: it remains consistent while the entry
+        is replaced (e.g. via DB.writer), but not while it's
+        written in place
+        """
+        self.__enter__()
+
+        if not os.fstat(self._fp.fileno()).st_size:
+            return ""
+        return mmap.mmap(self._fp.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def read(self, offset = 0, length = -1):
+        """read up to length octets (or everything) from offset"""
+        self.__enter__()
+
+        with withfile.FileLock(self._fp, shared = True):
+            self._fp.seek(offset, os.SEEK_SET)
+            return self._fp.read(length)
+
     def set(self, data):
         """set the entry's data"""
         self.append(data, truncate = True, whence = os.SEEK_SET)
+
+    def sync(self):
+        """sync any written data to disk"""
+        if isinstance(self._fp, file) and not self._fp.closed:
+            self._fp.flush()
+            os.fdatasync(self._fp.fileno())
+
+    def _writable(self):
+        """enter, unless in readonly mode"""
+        if self.readonly:
+            raise IOError("read-only entry")
+        self.__enter__()
@@ -0,0 +1,511 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import errno
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import zlib
+
+import db
+from lib import withfile
+
+__doc__ = "a content-addressed, deduplicating string-based database"
+
+class BlobStore:
+    """
+    zlib-compressed blobs, named by their SHA-256 digests,
+    and reference counted in an SQLite table
+
+    a blob is stored at "directory/first 2 digits/digest";
+    it's only written when its first reference is added,
+    and removed along with its last reference
+    (both under the table's write lock, so they can't race)
+    """
+
+    def __init__(self, directory, level = 6, timeout = 60):
+        self.directory = directory
+        self.level = level
+        self._lock = threading.RLock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(os.path.join(directory,
+            "blobs.sqlite"), timeout, check_same_thread = False,
+            isolation_level = None)
+
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS blobs"
+                " (digest TEXT PRIMARY KEY, refs INTEGER, size INTEGER,"
+                " stored INTEGER) WITHOUT ROWID")
+
+    def chunks(self, digest, buflen = 1048576):
+        """generate a blob's data, decompressing it as it's read"""
+        decompressor = zlib.decompressobj()
+
+        with open(self._path(digest), "rb") as fp:
+            for chunk in withfile.BufferedReader(fp, buflen):
+                chunk = decompressor.decompress(chunk)
+
+                if chunk:
+                    yield chunk
+        chunk = decompressor.flush()
+
+        if chunk:
+            yield chunk
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def decref(self, digest):
+        """drop a reference to a blob, removing it with the last one"""
+        with self._transaction() as cursor:
+            self._decref(cursor, digest)
+
+    def _decref(self, cursor, digest):
+        """decref, within a transaction"""
+        row = cursor.execute("SELECT refs FROM blobs WHERE digest = ?",
+            (digest, )).fetchone()
+
+        if row is None:
+            return
+
+        if row[0] > 1:
+            cursor.execute("UPDATE blobs SET refs = refs - 1"
+                " WHERE digest = ?", (digest, ))
+            return
+        cursor.execute("DELETE FROM blobs WHERE digest = ?", (digest, ))
+
+        try:
+            os.unlink(self._path(digest))
+        except OSError as e:
+            if not e.errno == errno.ENOENT:
+                raise e
+
+    def get(self, digest):
+        """return a blob's data"""
+        with open(self._path(digest), "rb") as fp:
+            return zlib.decompress(fp.read())
+
+    def incref(self, data):
+        """add a reference to data, storing it if it's new; return its digest"""
+        data = str(data)
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._transaction() as cursor:
+            if cursor.execute("UPDATE blobs SET refs = refs + 1"
+                    " WHERE digest = ?", (digest, )).rowcount:
+                return digest
+            stored = self._write(digest, zlib.compress(data, self.level))
+            cursor.execute("INSERT INTO blobs VALUES (?, 1, ?, ?)", (digest,
+                len(data), stored))
+        return digest
+
+    def _incref_file(self, digest, size, path):
+        """
+        add a reference to a blob, which is already compressed
+        (and synced) at path; path is renamed into place if the blob is new,
+        and removed otherwise
+        """
+        with self._transaction() as cursor:
+            if cursor.execute("UPDATE blobs SET refs = refs + 1"
+                    " WHERE digest = ?", (digest, )).rowcount:
+                os.unlink(path)
+                return
+            stored = os.path.getsize(path)
+
+            if not os.path.exists(os.path.dirname(self._path(digest))):
+                os.makedirs(os.path.dirname(self._path(digest)))
+            os.rename(path, self._path(digest))
+            cursor.execute("INSERT INTO blobs VALUES (?, 1, ?, ?)", (digest,
+                size, stored))
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def stats(self):
+        """
+        return a dict with the number of blobs, the number of references,
+        and the logical and stored octets
+        """
+        with self._lock:
+            blobs, refs, size, stored = self._connection.execute(
+                "SELECT COUNT(*), SUM(refs), SUM(refs * size), SUM(stored)"
+                " FROM blobs").fetchone()
+        return {"blobs": blobs, "refs": refs or 0, "bytes": size or 0,
+            "stored-bytes": stored or 0}
+
+    def _transaction(self):
+        return _Transaction(self)
+
+    def writer(self):
+        """return a BlobWriter, to stream data into a blob"""
+        return BlobWriter(self)
+
+    def _write(self, digest, compressed):
+        """atomically write a compressed blob, and return its size"""
+        path = self._path(digest)
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(compressed)
+            fp.flush()
+            os.fdatasync(fp.fileno())
+        os.rename(path + ".tmp", path)
+        return len(compressed)
+
+class BlobWriter:
+    """
+    a file-like writer, streaming data into a BlobStore:
+    the data is hashed and compressed as it's written,
+    into a temporary file, and close adds the reference
+    (and sets digest); exiting with an exception aborts instead
+    """
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.closed = False
+        self._compressor = zlib.compressobj(blobs.level)
+        self.digest = None
+        fd, self._path = tempfile.mkstemp(".tmp", "blob.", blobs.directory)
+        self._fp = os.fdopen(fd, "wb")
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def abort(self):
+        """discard the written data"""
+        if not self.closed:
+            self.closed = True
+            self._fp.close()
+            os.unlink(self._path)
+
+    def close(self):
+        """store the blob (if it's new), and return its digest"""
+        if self.closed:
+            return self.digest
+        self.closed = True
+        self._fp.write(self._compressor.flush())
+        self._fp.flush()
+        os.fdatasync(self._fp.fileno())
+        self._fp.close()
+        self.digest = self._hash.hexdigest()
+        self.blobs._incref_file(self.digest, self.size, self._path)
+        return self.digest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        if exception and exception[0]:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data):
+        data = str(data)
+        self._hash.update(data)
+        self.size += len(data)
+        self._fp.write(self._compressor.compress(data))
+
+class DedupDB(db.DB):
+    """
+    a db.DB which stores each distinct value once, as a blob
+
+    an entry only holds the digest of its blob (a line),
+    followed by an optional inline prefix: if separator is provided,
+    everything up to and including its first occurrence
+    is stored inline instead of in the blob
+    (e.g. "\\r\\n\\r\\n" keeps varying HTTP headers out of the blobs,
+    so identical bodies still share one)
+
+    an entry's pointer is read, replaced (or deleted) and its old
+    reference dropped in one blob store transaction, so concurrent writes
+    to an entry (by threads or processes) drop each reference once
+
+    appending rewrites the whole value, so this is best suited to
+    values which are set once
+    """
+
+    def __init__(self, directory = os.getcwd(), hash = "sha256",
+            readonly = False, separator = None, level = 6):
+        db.DB.__init__(self, directory, hash, readonly)
+        self.blobs = None
+        self.level = level
+        self.separator = separator
+
+    def append(self, name, data, offset = 0, whence = os.SEEK_CUR,
+            truncate = False, sync = True):
+        """
+        append data to an entry (as with db.DBEntry, the position
+        is relative to the start of the entry unless whence is os.SEEK_END)
+        """
+        self._writable()
+
+        try:
+            old = self[name]
+        except KeyError:
+            old = ""
+        position = offset
+
+        if whence == os.SEEK_END:
+            position += len(old)
+        new = old[:position] + "\x00" * (position - len(old)) + str(data)
+
+        if not truncate:
+            new += old[len(new):]
+        self[name] = new
+
+    def __delitem__(self, name):
+        """delete an entry, dropping its reference to its blob"""
+        self._writable()
+
+        with self.blobs._transaction() as cursor:
+            digest = self._read_pointer(name)[0]
+            db.DB.__delitem__(self, name)
+            self.blobs._decref(cursor, digest)
+
+    def __enter__(self):
+        db.DB.__enter__(self)
+
+        if self.blobs is None and (not self.readonly
+                or os.path.exists(os.path.join(self.directory, "blobs"))):
+            self.blobs = BlobStore(os.path.join(self.directory, "blobs"),
+                self.level)
+        return self
+
+    def entry(self, name):
+        """return a DedupEntry"""
+        return DedupEntry(self, name)
+
+    def __exit__(self, *exception):
+        db.DB.__exit__(self, *exception)
+
+        if self.blobs is not None:
+            self.blobs.close()
+            self.blobs = None
+
+    def __getitem__(self, name):
+        """retrieve an entry"""
+        digest, prefix = self._read_pointer(name)
+        return prefix + self.blobs.get(digest)
+
+    def _read_pointer(self, name):
+        """return an entry's (digest, inline prefix)"""
+        self.__enter__()
+        pointer = db.DB.__getitem__(self, name)
+        digest, _, prefix = pointer.partition("\n")
+        return digest, prefix
+
+    def __setitem__(self, name, data):
+        """store a name mapped to data, sharing any identical blob"""
+        self._writable()
+        data = str(data)
+        prefix = ""
+
+        if self.separator:
+            i = data.find(self.separator)
+
+            if i >= 0:
+                i += len(self.separator)
+                prefix, data = data[:i], data[i:]
+
+        self._point(name, self.blobs.incref(data), prefix)
+
+    def _point(self, name, digest, prefix):
+        """
+        point an entry to a blob (which must already be referenced),
+        dropping its old reference
+        """
+        with self.blobs._transaction() as cursor:
+            try:
+                old = self._read_pointer(name)[0]
+            except KeyError:
+                old = None
+
+            with db.DBEntry(self._generate_path(name)) as entry:
+                entry.set(digest + "\n" + prefix)
+
+                if entry.new:
+                    self.register(name)
+
+            if old is not None:
+                self.blobs._decref(cursor, old)
+
+    def stats(self):
+        """return the blob store's statistics"""
+        self.__enter__()
+
+        if self.blobs is None:
+            return {"blobs": 0, "refs": 0, "bytes": 0, "stored-bytes": 0}
+        return self.blobs.stats()
+
+    def update(self, pairs, sync = True):
+        """store several (name, data) pairs"""
+        for name, data in pairs:
+            self[name] = data
+
+    def writer(self, name):
+        """return a DedupWriter, to stream data into an entry"""
+        self._writable()
+        return DedupWriter(self, name)
+
+class DedupEntry:
+    """a read-only view of a DedupDB entry (for traversal)"""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+    def chunks(self, offset = 0, buflen = 1048576):
+        """
+        generate the entry's data from offset
+        (the inline prefix, then the blob, as it's decompressed)
+        """
+        digest, prefix = self.db._read_pointer(self.name)
+
+        def _chunks():
+            yield prefix
+
+            for chunk in self.db.blobs.chunks(digest, buflen):
+                yield chunk
+
+        for chunk in _chunks():
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            yield chunk[offset:]
+            offset = 0
+
+    def get(self, offset = 0, whence = os.SEEK_SET):
+        """get the entry's data"""
+        data = self.db[self.name]
+
+        if whence == os.SEEK_END:
+            offset += len(data)
+        return data[offset:]
+
+    def read(self, offset = 0, length = -1):
+        """
+        read up to length octets (or everything) from offset,
+        decompressing no more than needed
+        """
+        chunks = []
+        n = 0
+
+        for chunk in self.chunks(offset, 65536):
+            if length >= 0 and n + len(chunk) >= length:
+                chunks.append(chunk[:length - n])
+                break
+            chunks.append(chunk)
+            n += len(chunk)
+        return "".join(chunks)
+
+class DedupWriter:
+    """
+    a file-like writer, streaming data into a DedupDB entry
+
+    if the database has a separator, everything up to it is buffered
+    (as the inline prefix), but only up to max_prefix octets;
+    the rest is streamed into a BlobWriter
+    """
+
+    def __init__(self, db, name, max_prefix = 65536):
+        self._blob = db.blobs.writer()
+        self.closed = False
+        self.db = db
+        self._head = "" if db.separator else None # until the separator
+        self.max_prefix = max_prefix
+        self.name = name
+        self._prefix = ""
+
+    def abort(self):
+        """discard the written data"""
+        if not self.closed:
+            self.closed = True
+            self._blob.abort()
+
+    def close(self):
+        """point the entry to the written data"""
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._head:
+            self._blob.write(self._head)
+        self.db._point(self.name, self._blob.close(), self._prefix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        if exception and exception[0]:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data):
+        data = str(data)
+
+        if self._head is None:
+            self._blob.write(data)
+            return
+        self._head += data
+        i = self._head.find(self.db.separator)
+
+        if i >= 0:
+            i += len(self.db.separator)
+            self._prefix, data = self._head[:i], self._head[i:]
+        elif len(self._head) > self.max_prefix: # no prefix
+            data = self._head
+        else:
+            return
+        self._head = None
+        self._blob.write(data)
+
+class _Transaction:
+    """an immediate (write-locked) transaction on a BlobStore"""
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def __enter__(self):
+        self.blobs._lock.acquire()
+
+        try:
+            self.cursor = self.blobs._connection.cursor()
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except:
+            self.blobs._lock.release()
+            raise
+        return self.cursor
+
+    def __exit__(self, *exception):
+        try:
+            self.cursor.execute("ROLLBACK" if exception and exception[0]
+                else "COMMIT")
+        finally:
+            self.blobs._lock.release()
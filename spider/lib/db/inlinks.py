@@ -0,0 +1,300 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import array
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import threading
+
+from lib import withfile
+
+__doc__ = "an index of the links to each node"
+
+class InlinkIndex:
+    """
+    a persistent set of (target, source) integer pairs, for finding
+    the sources linking to a target
+
+    additions and removals are buffered in memory, and written
+    (on flush, __exit__, or once run_size are buffered) as a run:
+    a file of sorted entries, one per pair, each packed as two big-endian
+    32-bit integers and an octet (1 for an added pair, 0 for a removed
+    one, a tombstone), so a run sorts (and is searched) simply
+    as a sequence of 9-octet strings; a later run's entry for a pair
+    overrides an earlier one's
+
+    once there are more than max_runs runs, they're merged
+    (streamed through heapq.merge) into one, keeping only each pair's
+    latest entry, and dropping tombstones (as the first run needn't
+    keep them either)
+
+    a query binary-searches each (memory-mapped) run, and the buffer,
+    so it reads only the entries for its target
+
+    runs are created and merged under an flock on "lock",
+    which queries also take, so several processes may share an index
+    (though each only sees the others' pairs once they're written)
+    """
+
+    ENTRY = struct.Struct("!IIB")
+    PAIR = struct.Struct("!II")
+
+    def __init__(self, directory = os.getcwd(), run_size = 1048576,
+            max_runs = 8):
+        self._buffer = {} # packed pair -> whether it's present
+        self.directory = directory
+        self._lock = None
+        self._lock_fp = None
+        self.max_runs = max_runs
+        self._mutex = threading.RLock() # guards the buffer
+        self.run_size = run_size
+
+    def add(self, target, source):
+        """add a pair"""
+        self.update(((target, source), ))
+
+    def clear(self):
+        """remove every pair"""
+        with self._locked():
+            self._buffer = {}
+
+            for run in self._runs():
+                os.remove(self._run_path(run))
+
+    def count(self, target):
+        """return the number of sources linking to a target"""
+        with self._locked():
+            runs = self._runs()
+
+            if len(runs) > 1 or (runs and self._buffer): # may overlap
+                return len(self.sources(target))
+            n = len([p for p, present in self._buffer.iteritems()
+                if present and InlinkIndex.PAIR.unpack(p)[0] == target]) \
+                if self._buffer else 0
+
+            for run in runs: # (the first run has no tombstones)
+                with _Run(self._run_path(run)) as entries:
+                    n += entries.bisect(target + 1) - entries.bisect(target)
+            return n
+
+    def __del__(self):
+        self.__exit__()
+
+    def __enter__(self):
+        with self._mutex:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+
+            if not isinstance(self._lock_fp, file) or self._lock_fp.closed:
+                self._lock_fp = open(os.path.join(self.directory, "lock"),
+                    "a+b")
+                self._lock = withfile.FileLock(self._lock_fp)
+        return self
+
+    def __exit__(self, *exception):
+        with self._mutex:
+            if isinstance(self._lock_fp, file) and not self._lock_fp.closed:
+                self.flush()
+                self._lock_fp.close()
+
+    def flush(self):
+        """write the buffered additions and removals as a run"""
+        with self._locked():
+            if not self._buffer:
+                return
+            runs = self._runs()
+            self._write_run(runs[-1] + 1 if runs else 0,
+                (p + chr(present) for p, present
+                in sorted(self._buffer.iteritems())
+                if runs or present)) # nothing to remove from
+            self._buffer = {}
+
+            if len(runs) + 1 > self.max_runs:
+                self.merge()
+
+    def _locked(self):
+        """enter, then return the lock (taken after the mutex)"""
+        self.__enter__()
+        return _Both(self._mutex, self._lock)
+
+    def merge(self):
+        """merge every run into one, dropping tombstones"""
+        with self._locked():
+            runs = self._runs()
+
+            if len(runs) < 2:
+                return
+            readers = [_Run(self._run_path(r)) for r in runs]
+
+            try:
+                self._write_run(runs[-1] + 1, (e for e in _latest(
+                    heapq.merge(*[_ranked(r, -i)
+                    for i, r in enumerate(readers)])) if ord(e[-1])))
+            finally:
+                for r in readers:
+                    r.close()
+
+            for run in runs:
+                os.remove(self._run_path(run))
+
+    def _run_path(self, run):
+        return os.path.join(self.directory, "%08u.run" % run)
+
+    def _runs(self):
+        """return a sorted list of the run numbers"""
+        return sorted((int(f[:-4]) for f in os.listdir(self.directory)
+            if f.endswith(".run") and f[:-4].isdigit()))
+
+    def sources(self, target):
+        """return the sources linking to a target, in ascending order"""
+        found = {} # source -> whether it's present
+
+        with self._locked():
+            for run in self._runs(): # oldest first
+                with _Run(self._run_path(run)) as entries:
+                    for i in xrange(entries.bisect(target),
+                            entries.bisect(target + 1)):
+                        t, s, present = InlinkIndex.ENTRY.unpack(entries[i])
+                        found[s] = present
+
+            for pair, present in self._buffer.iteritems():
+                t, s = InlinkIndex.PAIR.unpack(pair)
+
+                if t == target:
+                    found[s] = present
+        return array.array('I', sorted((s for s, present
+            in found.iteritems() if present)))
+
+    def remove(self, pairs):
+        """remove several (target, source) pairs"""
+        self._set(pairs, 0)
+
+    def _set(self, pairs, present):
+        """buffer several (target, source) pairs' presence"""
+        with self._mutex:
+            for t, s in pairs:
+                self._buffer[InlinkIndex.PAIR.pack(t, s)] = present
+
+            if len(self._buffer) >= self.run_size:
+                self.flush()
+
+    def update(self, pairs):
+        """add several (target, source) pairs"""
+        self._set(pairs, 1)
+
+    def _write_run(self, run, entries):
+        """write sorted packed entries as a run (the lock must be held)"""
+        path = self._run_path(run)
+
+        with open(path + ".tmp", "wb") as fp:
+            chunk = []
+
+            for entry in entries:
+                chunk.append(entry)
+
+                if len(chunk) >= 65536:
+                    fp.write("".join(chunk))
+                    chunk = []
+            fp.write("".join(chunk))
+            fp.flush()
+            os.fdatasync(fp.fileno())
+        os.rename(path + ".tmp", path)
+
+class _Both:
+    """hold a mutex, then a lock"""
+
+    def __init__(self, mutex, lock):
+        self.lock = lock
+        self.mutex = mutex
+
+    def __enter__(self):
+        self.mutex.acquire()
+
+        try:
+            self.lock.__enter__()
+        except:
+            self.mutex.release()
+            raise
+        return self
+
+    def __exit__(self, *exception):
+        try:
+            self.lock.__exit__(*exception)
+        finally:
+            self.mutex.release()
+
+class _Run:
+    """a memory-mapped run, as a sequence of packed entries"""
+
+    def __init__(self, path):
+        self._fp = open(path, "rb")
+        size = os.fstat(self._fp.fileno()).st_size
+        self._mmap = mmap.mmap(self._fp.fileno(), size,
+            access = mmap.ACCESS_READ) if size else ""
+
+    def bisect(self, target):
+        """return the index of the first entry with at least target"""
+        return bisect.bisect_left(self, InlinkIndex.ENTRY.pack(target, 0, 0))
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def __getitem__(self, i):
+        i *= InlinkIndex.ENTRY.size
+        return self._mmap[i:i + InlinkIndex.ENTRY.size]
+
+    def __iter__(self):
+        """generate the entries, reading sequentially"""
+        self._fp.seek(0, os.SEEK_SET)
+
+        while 1:
+            chunk = self._fp.read(InlinkIndex.ENTRY.size * 65536)
+
+            if not chunk:
+                break
+
+            for i in xrange(0, len(chunk), InlinkIndex.ENTRY.size):
+                yield chunk[i:i + InlinkIndex.ENTRY.size]
+
+    def __len__(self):
+        return len(self._mmap) // InlinkIndex.ENTRY.size
+
+def _latest(ranked):
+    """
+    generate the entry of each pair from sorted (pair, rank, entry)
+    triples, keeping the lowest ranked one
+    """
+    previous = None
+
+    for pair, rank, entry in ranked:
+        if not pair == previous:
+            yield entry
+        previous = pair
+
+def _ranked(run, rank):
+    """generate a run's entries as (pair, rank, entry)"""
+    for entry in run:
+        yield entry[:InlinkIndex.PAIR.size], rank, entry
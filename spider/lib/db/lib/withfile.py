@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import fcntl
+import threading
 
 __doc__ = "wrappers for use with a file, in an enterable"
 
@@ -47,29 +48,68 @@ class FileLock:
     """
     an flock-oriented enterable for clarity
 
+    the lock is reentrant, and also excludes other threads using
+    the same instance (flock alone can't, since they share the file)
+
+    if shared evaluates to True, take a shared (LOCK_SH) lock,
+    which only excludes exclusive locks on other open files;
+    note that flock converts, rather than stacks, locks on the same open file,
+    so shared and exclusive instances shouldn't share a file
+
     if complain evaluates to True, raise any pertinent errors
     """
 
-    def __init__(self, fp, complain = False):
+    def __init__(self, fp, complain = False, shared = False):
         self.complain = complain
+        self._depth = 0
         self.fp = fp
         self.locked = False
+        self._owner = None
+        self._rlock = threading.RLock()
+        self.shared = shared
 
     def __enter__(self):
+        self._rlock.acquire()
+        self._depth += 1
+
+        if self._depth > 1: # already held
+            return self
+        self._owner = threading.current_thread()
+
         try:
-            fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_SH if self.shared
+                else fcntl.LOCK_EX)
             self.locked = True
         except IOError as e:
             if self.complain:
+                self._depth -= 1
+                self._owner = None
+                self._rlock.release()
                 raise e
         return self
 
     def __exit__(self, *exception):
-        if self.locked:
-            try:
-                fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
-            except IOError as e:
-                if self.complain:
-                    raise e
-        elif self.complain:
-            raise IOError("already unlocked")
+        try:
+            self._depth -= 1
+
+            if self._depth > 0: # still held
+                return
+            self._owner = None
+
+            if self.locked:
+                self.locked = False
+
+                try:
+                    fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+                except IOError as e:
+                    if self.complain:
+                        raise e
+            elif self.complain:
+                raise IOError("already unlocked")
+        finally:
+            self._rlock.release()
+
+    def owned(self):
+        """return whether the current thread holds the lock"""
+        return self._depth > 0 \
+            and self._owner is threading.current_thread()
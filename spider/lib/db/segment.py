@@ -0,0 +1,712 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import csv
+import errno
+import json
+import os
+import shutil
+import StringIO
+import struct
+import tempfile
+import threading
+import time
+
+import db
+from lib import withfile
+
+__doc__ = "a log-structured string-based database"
+
+class SegmentDB(db.DB):
+    """
+    a db.DB which appends records to large segment files
+    instead of storing one directory per entry
+
+    a record is composed as such:
+        flags (1 octet), name length (4 octets), data length (8 octets),
+        name (a CSV row), data
+    where flags is one of SegmentDB.SET, SegmentDB.APPEND
+    or SegmentDB.DELETE; segments are rolled over
+    once they reach segment_size octets
+
+    an in-memory hash index maps each name to the extents
+    (segment, offset, length) making up its data;
+    because the segments are append-only, each instance only has to scan
+    what other processes have written since its last operation,
+    and a snapshot of the index (written on __exit__ and compaction)
+    saves rescanning everything on open
+
+    catching up costs a stat of the directory (whose listing
+    and generation are cached until it changes) and an fstat
+    of the last segment scanned, unless another process has written
+
+    records aren't synced one by one: a write syncs the active segment
+    only once sync_interval seconds have passed since the last sync
+    (unless sync is specified), and sync and __exit__ sync what's left,
+    so a crash may lose the last sync_interval seconds of writes
+    (but a torn record is dropped, not indexed)
+
+    compaction rewrites the live data into new segments and removes
+    the old ones; it may be run in the background with start_compaction
+
+    access is controlled via flock calls on the lock file:
+    reads take a shared lock (through a second open file,
+    since flock would otherwise convert the exclusive lock),
+    and writes an exclusive one; in readonly mode, no locks are taken at all,
+    since records are only ever appended (and a torn record
+    isn't indexed until it's complete), and a segment removed
+    by a concurrent compaction just restarts the scan
+    """
+
+    APPEND = 1
+    DELETE = 2
+    HEADER = struct.Struct("!BIQ")
+    SET = 0
+
+    def __init__(self, directory = os.getcwd(), hash = "sha256",
+            segment_size = 268435456, readonly = False, sync_interval = 1):
+        db.DB.__init__(self, directory, hash, readonly)
+        self._compactor = None
+        self._generation = -1
+        self._index = {} # name -> [(segment, offset, length), ...]
+        self._listing = None # (directory mtime, generation, segments)
+        self._lock = None
+        self._lock_fp = None
+        self._mutex = threading.RLock() # guards the in-memory state
+        self._position = (0, 0) # scanned up to (segment, offset)
+        self._readers = {} # segment -> file
+        self._shared_lock = None
+        self._shared_lock_fp = None
+        self.segment_size = segment_size
+        self._active = None # the segment being written: (segment, file)
+        self.sync_interval = sync_interval
+        self._synced = time.time() # when the active segment was last synced
+
+    def append(self, name, data, offset = 0, whence = os.SEEK_CUR,
+            truncate = False, sync = None):
+        """
+        append data to an entry (as with db.DBEntry, the position
+        is relative to the start of the entry unless whence is os.SEEK_END)
+
+        sync may be True (sync now), False (don't),
+        or None (sync if sync_interval has passed)
+        """
+        name = tuple(db._as_list(name))
+
+        with self._locked():
+            extents = self._index.get(name, [])
+            length = sum((e[2] for e in extents))
+            position = offset
+
+            if whence == os.SEEK_END:
+                position += length
+
+            if position == length and not truncate: # a true append
+                self._write_record(SegmentDB.APPEND, name, data, sync)
+                return
+            old = self._read_extents(extents)
+            old = old[:position] + "\x00" * (position - len(old))
+            new = bytearray().join((old, data))
+
+            if not truncate:
+                new += self._read_extents(extents)[len(new):]
+            self._write_record(SegmentDB.SET, name, str(new), sync)
+
+    def _catch_up(self):
+        """scan any records written since the last scan"""
+        while 1:
+            try:
+                return self._scan()
+            except IOError as e: # compacted away mid-scan
+                if not self.readonly or not e.errno == errno.ENOENT:
+                    raise e
+                self._generation = -1
+                self._listing = None
+
+    def _scan(self):
+        """scan from the last scanned position"""
+        generation, segments = self._list()
+
+        if not generation == self._generation: # compacted: start over
+            self._generation = generation
+            self._index = {}
+            self._position = (0, 0)
+            self._close_readers()
+            self._load_snapshot()
+
+        for segment in segments:
+            if segment < self._position[0]:
+                continue
+            offset = self._position[1] if segment == self._position[0] else 0
+            fp = self._segment_reader(segment)
+
+            if os.fstat(fp.fileno()).st_size <= offset: # nothing new
+                continue
+            fp.seek(offset, os.SEEK_SET)
+
+            while 1:
+                header = fp.read(SegmentDB.HEADER.size)
+
+                if len(header) < SegmentDB.HEADER.size:
+                    break
+                flags, name_length, data_length = SegmentDB.HEADER.unpack(
+                    header)
+                name = fp.read(name_length)
+                start = fp.tell()
+                fp.seek(data_length, os.SEEK_CUR)
+
+                if len(name) < name_length \
+                        or start + data_length > os.fstat(fp.fileno()).st_size:
+                    break # torn
+                self._apply(flags, self._decode_name(name),
+                    (segment, start, data_length))
+                offset = fp.tell()
+            self._position = (segment, offset)
+
+    def _apply(self, flags, name, extent):
+        """apply a record to the index"""
+        if flags == SegmentDB.APPEND:
+            self._index.setdefault(name, []).append(extent)
+        elif flags == SegmentDB.DELETE:
+            self._index.pop(name, None)
+        else:
+            self._index[name] = [extent]
+
+    def clean(self, filter = lambda n: True):
+        """delete entries that don't satisfy the filter"""
+        with self._locked():
+            for name in self.list():
+                if not filter(name):
+                    del self[name]
+
+    def _close_readers(self):
+        for fp in self._readers.values():
+            fp.close()
+        self._readers = {}
+
+    def compact(self):
+        """rewrite the live data into new segments, dropping the old ones"""
+        with self._locked():
+            old = self._segments()
+            first = old[-1] + 1 if old else 0
+            self._roll(first)
+
+            for name, extents in sorted(self._index.items()):
+                self._write_record(SegmentDB.SET, name,
+                    self._read_extents(extents), False)
+            self._fsync_writer()
+
+            for segment in old:
+                os.remove(self._segment_path(segment))
+            self._close_readers()
+            self._generation += 1
+            self._write_generation(self._generation)
+            self._listing = None
+            self._dump_snapshot()
+
+    def __contains__(self, name):
+        with self._locked(True):
+            return tuple(db._as_list(name)) in self._index
+
+    def _decode_name(self, octets):
+        """decode a CSV-encoded name"""
+        return tuple(next(csv.reader(StringIO.StringIO(octets))))
+
+    def __del__(self):
+        self.__exit__()
+
+    def __delitem__(self, name):
+        """delete an entry"""
+        name = tuple(db._as_list(name))
+
+        with self._locked():
+            if not name in self._index:
+                raise KeyError(name)
+            self._write_record(SegmentDB.DELETE, name, "")
+
+    def deregister(self, name):
+        """delete an entry, if it exists"""
+        try:
+            del self[name]
+        except KeyError:
+            pass
+
+    def _dump_snapshot(self):
+        """snapshot the index (the lock must be held)"""
+        path = os.path.join(self.directory, "index.json")
+
+        with open(path + ".tmp", "wb") as fp:
+            json.dump({"generation": self._generation,
+                "position": self._position,
+                "entries": [[list(n), e] for n, e in self._index.iteritems()]},
+                fp)
+            fp.flush()
+            os.fdatasync(fp.fileno())
+        os.rename(path + ".tmp", path)
+
+    def _encode_name(self, name):
+        """encode a name as a CSV row"""
+        sio = StringIO.StringIO()
+        csv.writer(sio).writerow([str(n) if n is not None else ""
+            for n in name])
+        return sio.getvalue().rstrip("\r\n")
+
+    def __enter__(self):
+        if self.readonly:
+            return self
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        if not isinstance(self._lock_fp, file) or self._lock_fp.closed:
+            path = os.path.join(self.directory, "lock")
+            self._lock_fp = open(path, "a+b")
+            self._lock = withfile.FileLock(self._lock_fp)
+            self._shared_lock_fp = open(path, "rb")
+            self._shared_lock = withfile.FileLock(self._shared_lock_fp,
+                shared = True)
+        return self
+
+    def entry(self, name):
+        """return a SegmentEntry"""
+        return SegmentEntry(self, name)
+
+    def existent(self):
+        pass
+
+    def __exit__(self, *exception):
+        self.stop_compaction()
+
+        if self.readonly:
+            with self._mutex:
+                self._close_readers()
+        elif isinstance(self._lock_fp, file) and not self._lock_fp.closed:
+            with self._locked():
+                self._dump_snapshot()
+
+                if self._active:
+                    self._fsync_writer()
+                    self._active[1].close()
+                    self._active = None
+                self._close_readers()
+            self._lock_fp.close()
+            self._shared_lock_fp.close()
+
+    def _fsync_writer(self):
+        if self._active:
+            self._active[1].flush()
+            os.fdatasync(self._active[1].fileno())
+        self._synced = time.time()
+
+    def garbage(self):
+        """return the fraction of segment octets that are dead"""
+        with self._locked(True):
+            total = sum((os.path.getsize(self._segment_path(s))
+                for s in self._segments()))
+            live = sum((SegmentDB.HEADER.size + len(self._encode_name(n))
+                + e[2] for n, extents in self._index.iteritems()
+                for e in extents))
+            return 1 - float(live) / total if total else 0.0
+
+    def __getitem__(self, name):
+        """retrieve an entry"""
+        return self._read_range(name)
+
+    def __len__(self):
+        with self._locked(True):
+            return len(self._index)
+
+    def iternames(self):
+        """generate all the entry names in sorted order"""
+        return iter(self.list())
+
+    def list(self):
+        """return a sorted list of all the entry names"""
+        with self._locked(True):
+            return sorted((list(n) for n in self._index.iterkeys()))
+
+    def _list(self):
+        """
+        return (the generation, a sorted list of the segment numbers),
+        cached until the directory's modification time changes
+
+        (a listing isn't cached within a second of a change,
+        which might otherwise share its modification time)
+        """
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError: # (nothing's been written, in readonly mode)
+            return 0, []
+
+        if self._listing and self._listing[0] == mtime:
+            return self._listing[1:]
+        listing = (mtime, self._read_generation(), sorted((int(f[:-4])
+            for f in os.listdir(self.directory)
+            if f.endswith(".seg") and f[:-4].isdigit())))
+        self._listing = listing if time.time() - mtime > 1 else None
+        return listing[1:]
+
+    def _load_snapshot(self):
+        """load the index snapshot, if it's current"""
+        path = os.path.join(self.directory, "index.json")
+
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path, "rb") as fp:
+                snapshot = json.load(fp)
+        except ValueError:
+            return
+
+        if not snapshot.get("generation") == self._generation:
+            return
+        self._index = {tuple((str(c) for c in n)): [tuple(e) for e in extents]
+            for n, extents in snapshot["entries"]}
+        self._position = tuple(snapshot["position"])
+
+    def _locked(self, shared = False):
+        """
+        enter, then return the (caught up) lock:
+        shared if requested (and the exclusive lock isn't already held),
+        or none at all in readonly mode
+        """
+        self.__enter__()
+
+        if self.readonly:
+            if not shared:
+                raise IOError("read-only database")
+            return _CatchingUp(self, None)
+        elif shared and not self._lock.owned():
+            return _CatchingUp(self, self._shared_lock)
+        return _CatchingUp(self, self._lock)
+
+    def _read_range(self, name, offset = 0, length = -1):
+        """
+        read up to length octets (or everything) of an entry from offset,
+        touching only the extents that overlap them
+        """
+        name = tuple(db._as_list(name))
+
+        while 1:
+            with self._locked(True):
+                if not name in self._index:
+                    raise KeyError(name)
+                extents = []
+                remaining = length
+                skip = offset
+
+                for segment, start, size in self._index[name]:
+                    if skip >= size:
+                        skip -= size
+                        continue
+                    take = size - skip
+
+                    if remaining >= 0:
+                        take = min(take, remaining)
+                        remaining -= take
+                    extents.append((segment, start + skip, take))
+                    skip = 0
+
+                    if not remaining:
+                        break
+
+                try:
+                    return self._read_extents(extents)
+                except IOError as e: # compacted away (in readonly mode)
+                    if not self.readonly or not e.errno == errno.ENOENT:
+                        raise e
+                    self._generation = -1
+
+    def _read_extents(self, extents):
+        """read and join the data of some extents"""
+        chunks = []
+
+        for segment, offset, length in extents:
+            fp = self._segment_reader(segment)
+            fp.seek(offset, os.SEEK_SET)
+            chunks.append(fp.read(length))
+        return "".join(chunks)
+
+    def _read_generation(self):
+        path = os.path.join(self.directory, "generation")
+
+        if not os.path.exists(path):
+            return 0
+
+        with open(path, "rb") as fp:
+            try:
+                return int(fp.read().strip() or 0)
+            except ValueError:
+                return 0
+
+    def _segment_reader(self, segment):
+        """return a (cached) read-only file for a segment"""
+        if not segment in self._readers:
+            self._readers[segment] = open(self._segment_path(segment), "rb")
+        return self._readers[segment]
+
+    def register(self, name):
+        """create an empty entry, if it doesn't exist"""
+        with self._locked():
+            if not tuple(db._as_list(name)) in self._index:
+                self[name] = ""
+
+    def _roll(self, segment):
+        """start writing to a segment"""
+        if self._active:
+            self._fsync_writer()
+            self._active[1].close()
+        path = self._segment_path(segment)
+        self._active = (segment, open(path, ('r' if os.path.exists(path)
+            else 'w') + "+b"))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, "%08u.seg" % segment)
+
+    def _segments(self):
+        """return a sorted list of the segment numbers"""
+        return self._list()[1]
+
+    def __setitem__(self, name, data):
+        """store a name mapped to data (see sync_interval)"""
+        with self._locked():
+            self._write_record(SegmentDB.SET, tuple(db._as_list(name)), data)
+
+    def start_compaction(self, interval = 60, threshold = 0.5):
+        """
+        compact in a background thread whenever more than threshold
+        of the segment octets are dead
+        """
+        self.stop_compaction()
+        stop = threading.Event()
+
+        def compactor():
+            while not stop.wait(interval):
+                if self.garbage() > threshold:
+                    self.compact()
+        self._compactor = (stop, threading.Thread(target = compactor))
+        self._compactor[1].daemon = True
+        self._compactor[1].start()
+
+    def stop_compaction(self):
+        """stop background compaction, if it's running"""
+        if self._compactor:
+            self._compactor[0].set()
+            self._compactor[1].join()
+            self._compactor = None
+
+    def sync(self):
+        """sync the active segment to disk"""
+        with self._locked():
+            self._fsync_writer()
+
+    def update(self, pairs, sync = True):
+        """store several (name, data) pairs, syncing once"""
+        with self._locked():
+            for name, data in pairs:
+                self._write_record(SegmentDB.SET, tuple(db._as_list(name)),
+                    data, False)
+
+            if sync:
+                self._fsync_writer()
+
+    def writer(self, name):
+        """return a SegmentWriter, to stream data into an entry"""
+        if self.readonly:
+            raise IOError("read-only database")
+        self.__enter__()
+        return SegmentWriter(self, name)
+
+    def _write_generation(self, generation):
+        path = os.path.join(self.directory, "generation")
+
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(str(generation))
+            fp.flush()
+            os.fdatasync(fp.fileno())
+        os.rename(path + ".tmp", path)
+
+    def _write_record(self, flags, name, data, sync = None):
+        """
+        append a record to the active segment (the lock must be held,
+        so the scan is caught up); data may also be a file,
+        which is copied from its start
+
+        sync may be True, False, or None (see sync_interval)
+        """
+        segments = self._segments() # (cached)
+        last = segments[-1] if segments else 0
+
+        if not self._active or not self._active[0] == last:
+            self._roll(last)
+        fp = self._active[1]
+        fp.seek(0, os.SEEK_END)
+
+        if fp.tell() >= self.segment_size:
+            self._roll(last + 1)
+            fp = self._active[1]
+        elif self._position[0] == last \
+                and fp.tell() > self._position[1]: # drop a torn record
+            fp.truncate(self._position[1])
+            fp.seek(0, os.SEEK_END)
+        encoded = self._encode_name(name)
+
+        if isinstance(data, file):
+            data.seek(0, os.SEEK_END)
+            length = data.tell()
+            data.seek(0, os.SEEK_SET)
+        else:
+            data = str(data)
+            length = len(data)
+        fp.write(SegmentDB.HEADER.pack(flags, len(encoded), length))
+        fp.write(encoded)
+        start = fp.tell()
+
+        if isinstance(data, file):
+            shutil.copyfileobj(data, fp, 1048576)
+        else:
+            fp.write(data)
+
+        if sync is None:
+            sync = time.time() - self._synced >= self.sync_interval
+
+        if sync:
+            self._fsync_writer()
+        else:
+            fp.flush()
+        self._apply(flags, name, (self._active[0], start, length))
+        self._position = (self._active[0], fp.tell())
+
+class SegmentWriter:
+    """
+    a file-like writer, streaming data into a SegmentDB entry
+
+    the data is spooled to a temporary file (in the database's "spool"
+    directory, so the database directory itself isn't modified),
+    and appended as a single record on close,
+    so the lock is only held while copying it;
+    exiting with an exception aborts instead
+    """
+
+    def __init__(self, db, name):
+        self.closed = False
+        self.db = db
+        self.name = name
+        spool = os.path.join(db.directory, "spool")
+
+        if not os.path.exists(spool):
+            os.makedirs(spool)
+        self._fp = tempfile.TemporaryFile(dir = spool)
+
+    def abort(self):
+        """discard the written data"""
+        if not self.closed:
+            self.closed = True
+            self._fp.close()
+
+    def close(self):
+        """store the written data"""
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            with self.db._locked():
+                self.db._write_record(SegmentDB.SET,
+                    tuple(db._as_list(self.name)), self._fp)
+        finally:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        if exception and exception[0]:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data):
+        self._fp.write(data)
+
+class SegmentEntry:
+    """a read-only view of a SegmentDB entry (for traversal)"""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+    def chunks(self, offset = 0, buflen = 1048576):
+        """generate the entry's data from offset, in buflen-octet chunks"""
+        while 1:
+            chunk = self.read(offset, buflen)
+
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def get(self, offset = 0, whence = os.SEEK_SET):
+        """get the entry's data"""
+        if whence == os.SEEK_SET:
+            return self.read(offset)
+        data = self.db[self.name]
+
+        if whence == os.SEEK_END:
+            offset += len(data)
+        return data[offset:]
+
+    def read(self, offset = 0, length = -1):
+        """read up to length octets (or everything) from offset"""
+        return self.db._read_range(self.name, offset, length)
+
+class _CatchingUp:
+    """hold a SegmentDB's mutex and lock, catching up on entry"""
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.db._mutex.acquire()
+
+        try:
+            if self.lock:
+                self.lock.__enter__()
+
+            try:
+                self.db._catch_up()
+            except:
+                if self.lock:
+                    self.lock.__exit__()
+                raise
+        except:
+            self.db._mutex.release()
+            raise
+        return self
+
+    def __exit__(self, *exception):
+        try:
+            if self.lock:
+                self.lock.__exit__(*exception)
+        finally:
+            self.db._mutex.release()
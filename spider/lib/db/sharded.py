@@ -0,0 +1,318 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import heapq
+import json
+import os
+import Queue
+import threading
+
+import db as _db
+
+__doc__ = "a database spread across several directories"
+
+def _prefetch(iterable, maxsize = 1024):
+    """generate an iterable's items, as read ahead by another thread"""
+    queue = Queue.Queue(maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def read():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                queue.put((True, item))
+            queue.put((True, done))
+        except Exception as e:
+            queue.put((False, e))
+    thread = threading.Thread(target = read)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while 1:
+            ok, item = queue.get()
+
+            if not ok:
+                raise item
+            elif item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+
+        while thread.is_alive(): # unblock the reader
+            try:
+                queue.get_nowait()
+            except Queue.Empty:
+                thread.join(0.01)
+
+class ShardedDB(_db.DB):
+    """
+    a db.DB which routes each name (by the MD5 of its components)
+    to one of several underlying databases, one per directory
+    (e.g. on different disks), each a db_class(directory, hash)
+
+    the order of the directories is what the routing depends on,
+    so each directory records its place in a manifest ("shard.json"),
+    and opening them in another order, or a different number of them,
+    raises a ValueError; use rebalance to change the directories
+
+    names are listed and traversed in sorted order, by merging
+    the shards' (sorted) names, as read ahead by a thread per shard
+    """
+
+    MANIFEST = "shard.json"
+
+    def __init__(self, directories, hash = "sha256", db_class = _db.DB,
+            readonly = False):
+        if not directories:
+            raise ValueError("there must be at least one directory")
+        self.db_class = db_class
+        self.directories = [os.path.realpath(d) for d in directories]
+        self.directory = self.directories[0]
+        self.hash = hash
+        self.readonly = readonly
+        self.shards = [self._open_shard(d) for d in self.directories]
+        self._entered = False
+
+    def append(self, name, *args, **kwargs):
+        return self.shard(name).append(name, *args, **kwargs)
+
+    def _check_manifest(self, i):
+        """write (or check) the ith shard's manifest"""
+        path = os.path.join(self.directories[i], ShardedDB.MANIFEST)
+        manifest = {"index": i, "count": len(self.directories)}
+
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                found = json.load(fp)
+
+            if not found == manifest:
+                raise ValueError("%s was shard %u of %u, not %u of %u" % (
+                    self.directories[i], found["index"], found["count"], i,
+                    len(self.directories)))
+        elif not self.readonly:
+            _write_manifest(path, manifest)
+
+    def clean(self, *args, **kwargs):
+        self._each(lambda i: self.shards[i].clean(*args, **kwargs))
+
+    def __contains__(self, name):
+        return name in self.shard(name)
+
+    def __del__(self):
+        self.__exit__()
+
+    def __delitem__(self, name):
+        del self.shard(name)[name]
+
+    def deregister(self, name):
+        return self.shard(name).deregister(name)
+
+    def _each(self, function):
+        """
+        apply a function to each shard index in parallel,
+        returning the results
+        """
+        results = [None] * len(self.shards)
+        errors = []
+
+        def apply(i):
+            try:
+                results[i] = function(i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target = apply, args = (i, ))
+            for i in range(len(self.shards))]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def __enter__(self):
+        if not self._entered:
+            for i in range(len(self.shards)):
+                if not self.readonly and not os.path.exists(
+                        self.directories[i]):
+                    os.makedirs(self.directories[i])
+                self._check_manifest(i)
+            self._entered = True
+
+        for shard in self.shards:
+            shard.__enter__()
+        return self
+
+    def entry(self, name):
+        return self.shard(name).entry(name)
+
+    def existent(self):
+        self._each(lambda i: self.shards[i].existent())
+
+    def __exit__(self, *exception):
+        for shard in getattr(self, "shards", ()):
+            shard.__exit__(*exception)
+
+    def __getitem__(self, name):
+        return self.shard(name)[name]
+
+    def index(self, name):
+        """return the index of the shard a name belongs to"""
+        return _route(name, len(self.shards))
+
+    def iternames(self):
+        """generate all the entry names in sorted order"""
+        self.__enter__()
+        return heapq.merge(*[_prefetch(s.iternames()) for s in self.shards])
+
+    def __len__(self):
+        self.__enter__()
+        return sum(self.stats())
+
+    def list(self):
+        """return a sorted list of all the entry names"""
+        self.__enter__()
+        return list(heapq.merge(*self._each(lambda i: self.shards[i].list())))
+
+    def _open_shard(self, directory):
+        if self.readonly:
+            return self.db_class(directory, self.hash, readonly = True)
+        return self.db_class(directory, self.hash)
+
+    def rebalance(self, directories):
+        """
+        move the entries to a new list of directories
+        (which may overlap the current ones), then use those
+
+        each entry is copied (streamed) to its new shard
+        before it's deleted from its old one, so an interrupted rebalance
+        loses nothing and may simply be run again
+        (until it finishes, the old directories remain the valid ones)
+        """
+        if self.readonly:
+            raise IOError("read-only database")
+        self.__enter__()
+        new = ShardedDB(directories, self.hash, self.db_class)
+        new._entered = True # the manifests are only rewritten at the end
+
+        for i, d in enumerate(new.directories):
+            if d in self.directories: # share the open shard
+                new.shards[i] = self.shards[self.directories.index(d)]
+            elif not os.path.exists(d):
+                os.makedirs(d)
+        new.__enter__()
+
+        def move(i):
+            old = self.shards[i]
+
+            for name in old.list():
+                target = new.shards[new.index(name)]
+
+                if target is old:
+                    continue
+
+                with target.writer(name) as writer:
+                    for chunk in old.entry(name).chunks():
+                        writer.write(chunk)
+                del old[name]
+        self._each(move)
+
+        for i, d in enumerate(new.directories):
+            _write_manifest(os.path.join(d, ShardedDB.MANIFEST),
+                {"index": i, "count": len(new.directories)})
+
+        for i, d in enumerate(self.directories): # retired directories
+            if not d in new.directories:
+                os.remove(os.path.join(d, ShardedDB.MANIFEST))
+                self.shards[i].__exit__()
+        self.directories = new.directories
+        self.directory = new.directory
+        self.shards = new.shards
+        new.shards = []
+
+    def register(self, name):
+        return self.shard(name).register(name)
+
+    def __setitem__(self, name, data):
+        self.shard(name)[name] = data
+
+    def shard(self, name):
+        """return the database a name belongs to"""
+        self.__enter__()
+        return self.shards[self.index(name)]
+
+    def stats(self):
+        """return the number of entries in each shard"""
+        self.__enter__()
+        return self._each(lambda i: len(self.shards[i]))
+
+    def traverse(self, open = False):
+        """generate entries in name order, merged across the shards"""
+        self.__enter__()
+        return (self.entry(n) for n in self.iternames())
+
+    def update(self, pairs, *args, **kwargs):
+        """store several (name, data) pairs, a group per shard (in parallel)"""
+        self.__enter__()
+        groups = [[] for s in self.shards]
+
+        for name, data in pairs:
+            groups[self.index(name)].append((name, data))
+        self._each(lambda i: groups[i] and self.shards[i].update(groups[i],
+            *args, **kwargs))
+
+    def writer(self, name):
+        return self.shard(name).writer(name)
+
+def _route(name, n):
+    """return the index of the shard a name belongs to, out of n"""
+    name = ["" if c is None else str(c) for c in _db._as_list(name)]
+    return int(hashlib.md5("\x00".join(name)).hexdigest(), 16) % n
+
+def _write_manifest(path, manifest):
+    with open(path + ".tmp", "wb") as fp:
+        json.dump(manifest, fp)
+        fp.flush()
+        os.fdatasync(fp.fileno())
+    os.rename(path + ".tmp", path)
+
+if __name__ == "__main__":
+    import sys
+
+    def _help():
+        print "rebalance a sharded database\n" \
+              "Usage: python sharded.py [OPTIONS] OLD NEW\n" \
+              "OPTIONS\n" \
+              "\t-h, --help\tshow this text and exit\n" \
+              "OLD\n" \
+              "\tthe current comma-separated list of shard directories\n" \
+              "NEW\n" \
+              "\tthe new comma-separated list of shard directories"
+
+    if len(sys.argv) < 3 or "-h" in sys.argv or "--help" in sys.argv:
+        _help()
+        sys.exit()
+    sharded = ShardedDB(sys.argv[1].split(','))
+    sharded.rebalance(sys.argv[2].split(','))
+    print "%u entries across %s" % (len(sharded), sharded.stats())
+    sharded.__exit__()
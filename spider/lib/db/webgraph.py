@@ -0,0 +1,462 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import array
+import json
+import os
+import sqlite3
+import threading
+
+import inlinks
+from lib import withfile
+
+__doc__ = "a compact webgraph store"
+
+class Webgraph:
+    """
+    a webgraph whose nodes are URLs, mapped to dense integer IDs
+    (0, 1, ...) by a persistent dictionary ("ids.sqlite"),
+    and whose out-links are appended to segment files as records
+    of varints, composed as such:
+        body length, source ID, number of links,
+        then the sorted link IDs, each as its difference from the last
+    a later record for the same source replaces the earlier one;
+    segments are rolled over once they reach segment_size octets
+
+    csr returns the whole graph as compressed sparse row arrays,
+    which export_csr writes (and load_csr reads back) as raw files
+
+    appends are serialized by an flock on "lock", so several processes
+    (and threads) may share a Webgraph; records are flushed as they're
+    written, but only synced on flush and __exit__, unless requested
+
+    recently used IDs are cached in memory (up to cache_size URLs);
+    the index of where each source's latest record is (for neighbors
+    and csr) is only built once it's needed
+
+    every link is also added to an inlinks.InlinkIndex (in "inlinks"),
+    for inlinks and inlink_count, and those a later record drops
+    are removed from it (so updates build the index of records)
+    """
+
+    def __init__(self, directory = os.getcwd(), segment_size = 67108864,
+            cache_size = 1048576, timeout = 60, run_size = 1048576):
+        self._active = None # the segment being written: (segment, file)
+        self._cache = {} # URL -> ID
+        self.cache_size = cache_size
+        self._connection = None
+        self.directory = directory
+        self._index = None # source ID -> (segment, offset, length)
+        self.inlink_index = inlinks.InlinkIndex(os.path.join(directory,
+            "inlinks"), run_size)
+        self._lock = None
+        self._lock_fp = None
+        self._mutex = threading.RLock() # guards the in-memory state
+        self._position = (0, 0) # scanned up to (segment, offset)
+        self._readers = {} # segment -> file
+        self.segment_size = segment_size
+        self.timeout = timeout
+
+    def add(self, url, links, sync = False):
+        """store a URL's links, replacing any stored before"""
+        self.update(((url, links), ), sync)
+
+    def _catch_up(self):
+        """scan any records written since the last scan"""
+        for segment in self._segments():
+            if segment < self._position[0]:
+                continue
+            offset = self._position[1] if segment == self._position[0] else 0
+            fp = self._segment_reader(segment)
+            fp.seek(offset, os.SEEK_SET)
+            data = bytearray(fp.read())
+            i = 0
+
+            while i < len(data):
+                try:
+                    length, start = _read_varint(data, i)
+                    source = _read_varint(data, start)[0]
+                except IndexError: # torn
+                    break
+
+                if start + length > len(data): # torn
+                    break
+
+                if self._index is not None:
+                    self._index[source] = (segment, offset + start, length)
+                i = start + length
+            self._position = (segment, offset + i)
+
+    def _close_readers(self):
+        for fp in self._readers.values():
+            fp.close()
+        self._readers = {}
+
+    def __contains__(self, url):
+        self.__enter__()
+
+        with self._mutex:
+            return self._connection.execute("SELECT 1 FROM nodes"
+                " WHERE url = ?", (buffer(str(url)), )).fetchone() \
+                is not None
+
+    def csr(self):
+        """
+        return the graph as compressed sparse row arrays (indptr, indices):
+        node i links to the nodes indices[indptr[i]:indptr[i + 1]]
+        """
+        adjacency = {}
+
+        with self._mutex:
+            self._indexed()
+            data = None
+            n = len(self)
+            segment = None
+
+            for source, (s, offset, length) in sorted(
+                    self._index.iteritems(), key = lambda p: p[1]):
+                if not s == segment: # read each segment only once
+                    segment = s
+                    fp = self._segment_reader(segment)
+                    fp.seek(0, os.SEEK_SET)
+                    data = bytearray(fp.read())
+                adjacency[source] = _decode_links(data, offset)
+            data = None
+        indices = array.array('I')
+        indptr = array.array('L', (0, ))
+
+        for i in xrange(n):
+            if i in adjacency:
+                indices.extend(adjacency.pop(i))
+            indptr.append(len(indices))
+        return indptr, indices
+
+    def __del__(self):
+        self.__exit__()
+
+    def __enter__(self):
+        with self._mutex:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+
+            if self._connection is None:
+                self._connection = sqlite3.connect(os.path.join(
+                    self.directory, "ids.sqlite"), self.timeout,
+                    check_same_thread = False, isolation_level = None)
+                self._connection.execute("PRAGMA journal_mode = WAL")
+                self._connection.execute("CREATE TABLE IF NOT EXISTS nodes"
+                    " (id INTEGER PRIMARY KEY, url BLOB UNIQUE NOT NULL)")
+
+            if not isinstance(self._lock_fp, file) or self._lock_fp.closed:
+                self._lock_fp = open(os.path.join(self.directory, "lock"),
+                    "a+b")
+                self._lock = withfile.FileLock(self._lock_fp)
+            self.inlink_index.__enter__()
+        return self
+
+    def __exit__(self, *exception):
+        with self._mutex:
+            if self._active:
+                self.flush()
+                self._active[1].close()
+                self._active = None
+            self._close_readers()
+            self.inlink_index.__exit__()
+
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+            if isinstance(self._lock_fp, file) and not self._lock_fp.closed:
+                self._lock_fp.close()
+
+    def export_csr(self, directory = None):
+        """
+        write the CSR arrays as raw files ("indptr" and "indices")
+        to a directory (by default, "csr" in the graph's directory),
+        described by "csr.json", which is written last;
+        return the directory
+        """
+        if directory is None:
+            directory = os.path.join(self.directory, "csr")
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        indptr, indices = self.csr()
+
+        for name, values in (("indptr", indptr), ("indices", indices)):
+            with open(os.path.join(directory, name), "wb") as fp:
+                values.tofile(fp)
+        path = os.path.join(directory, "csr.json")
+
+        with open(path + ".tmp", "wb") as fp:
+            json.dump({"edges": len(indices), "indices": indices.typecode,
+                "indptr": indptr.typecode, "nodes": len(indptr) - 1}, fp)
+            fp.flush()
+            os.fdatasync(fp.fileno())
+        os.rename(path + ".tmp", path)
+        return directory
+
+    def flush(self):
+        """sync the segment being written"""
+        with self._mutex:
+            if self._active:
+                self._active[1].flush()
+                os.fdatasync(self._active[1].fileno())
+
+    def id(self, url):
+        """return a URL's ID, assigning one if it's new"""
+        return self.ids((url, ))[0]
+
+    def ids(self, urls):
+        """return the IDs of several URLs, assigning any new ones at once"""
+        self.__enter__()
+        found = {}
+        urls = [str(u) for u in urls]
+
+        with self._mutex:
+            missing = set((u for u in urls if not u in self._cache))
+
+            if missing:
+                cursor = self._connection.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+
+                try:
+                    for url in missing:
+                        cursor.execute("INSERT OR IGNORE INTO nodes (url)"
+                            " VALUES (?)", (buffer(url), ))
+                        cursor.execute("SELECT id FROM nodes WHERE url = ?",
+                            (buffer(url), ))
+                        found[url] = cursor.fetchone()[0] - 1 # from 0
+                    cursor.execute("COMMIT")
+                except:
+                    cursor.execute("ROLLBACK")
+                    raise
+
+                if len(self._cache) + len(found) > self.cache_size:
+                    self._cache = {}
+                self._cache.update(found)
+            return [found[u] if u in found else self._cache[u] for u in urls]
+
+    def _indexed(self):
+        """catch up, building the index first if need be"""
+        if self._index is None:
+            self._close_readers()
+            self._index = {}
+            self._position = (0, 0)
+        self._catch_up()
+
+    def inlink_count(self, node):
+        """return the number of nodes linking to a node (a URL or an ID)"""
+        return self.inlink_index.count(self._node(node))
+
+    def inlinks(self, node):
+        """return the IDs linking to a node (a URL or an ID)"""
+        return self.inlink_index.sources(self._node(node))
+
+    def __len__(self):
+        """return the number of nodes"""
+        self.__enter__()
+
+        with self._mutex:
+            return self._connection.execute("SELECT COALESCE(MAX(id), 0)"
+                " FROM nodes").fetchone()[0]
+
+    def _links(self, source):
+        """return the IDs in a source's latest record (once indexed)"""
+        if not source in self._index: # only ever linked to
+            return array.array('I')
+        segment, offset, length = self._index[source]
+        fp = self._segment_reader(segment)
+        fp.seek(offset, os.SEEK_SET)
+        return _decode_links(bytearray(fp.read(length)), 0)
+
+    def neighbors(self, node):
+        """return the IDs a node (a URL or an ID) links to"""
+        node = self._node(node)
+
+        with self._mutex:
+            self._indexed()
+            return self._links(node)
+
+    def _node(self, node):
+        """return the ID of a node (a URL, without assigning, or an ID)"""
+        if not isinstance(node, basestring):
+            return node
+        self.__enter__()
+
+        with self._mutex:
+            row = self._connection.execute("SELECT id FROM nodes"
+                " WHERE url = ?", (buffer(str(node)), )).fetchone()
+
+        if row is None:
+            raise KeyError(node)
+        return row[0] - 1
+
+    def rebuild_inlinks(self):
+        """rebuild the inlink index from the latest records"""
+        indptr, indices = self.csr()
+        self.inlink_index.clear()
+
+        for i in xrange(len(indptr) - 1):
+            self.inlink_index.update(((indices[k], i)
+                for k in xrange(indptr[i], indptr[i + 1])))
+        self.inlink_index.flush()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, "%08u.adj" % segment)
+
+    def _segment_reader(self, segment):
+        """return a (cached) read-only file for a segment"""
+        if not segment in self._readers:
+            self._readers[segment] = open(self._segment_path(segment), "rb")
+        return self._readers[segment]
+
+    def _segments(self):
+        """return a sorted list of the segment numbers"""
+        if not os.path.exists(self.directory):
+            return []
+        return sorted((int(f[:-4]) for f in os.listdir(self.directory)
+            if f.endswith(".adj") and f[:-4].isdigit()))
+
+    def update(self, nodes, sync = False):
+        """store several (URL, links) pairs in a single write"""
+        nodes = list(nodes)
+        ids = self.ids([u for u, links in nodes]
+            + [l for u, links in nodes for l in links])
+        i = len(nodes)
+        records = bytearray()
+        written = [] # (source, offset, length)
+        latest = {} # source -> links
+
+        for k, (url, links) in enumerate(nodes):
+            body = bytearray()
+            i += len(links)
+            links = sorted(set(ids[i - len(links):i]))
+            latest[ids[k]] = links
+            previous = 0
+            _write_varint(body, ids[k])
+            _write_varint(body, len(links))
+
+            for l in links:
+                _write_varint(body, l - previous)
+                previous = l
+            _write_varint(records, len(body))
+            written.append((ids[k], len(records), len(body)))
+            records += body
+
+        with self._mutex:
+            with self._lock:
+                self._indexed()
+                dropped = [(l, s) for s, links in latest.iteritems()
+                    for l in set(self._links(s)).difference(links)]
+                self._write(records, written, sync)
+            self.inlink_index.remove(dropped)
+            self.inlink_index.update(((l, s)
+                for s, links in latest.iteritems() for l in links))
+
+    def url(self, id):
+        """return the URL with an ID"""
+        self.__enter__()
+
+        with self._mutex:
+            row = self._connection.execute("SELECT url FROM nodes"
+                " WHERE id = ?", (id + 1, )).fetchone()
+
+        if row is None:
+            raise KeyError(id)
+        return str(row[0])
+
+    def _write(self, records, written, sync):
+        """
+        append records to the last segment (the lock must be held,
+        and the scan caught up), dropping any torn record at its end
+        """
+        segments = self._segments()
+        last = segments[-1] if segments else 0
+
+        if not self._active or not self._active[0] == last:
+            if self._active:
+                self.flush()
+                self._active[1].close()
+            self._active = (last, open(self._segment_path(last), "ab"))
+        size = os.fstat(self._active[1].fileno()).st_size
+
+        if size >= self.segment_size:
+            self.flush()
+            self._active[1].close()
+            last += 1
+            self._active = (last, open(self._segment_path(last), "ab"))
+            self._position = (last, 0)
+        elif size > self._position[1]: # torn
+            os.ftruncate(self._active[1].fileno(), self._position[1])
+        self._active[1].write(records)
+
+        if sync:
+            self.flush()
+        else:
+            self._active[1].flush()
+
+        if self._index is not None:
+            for source, offset, length in written:
+                self._index[source] = (last, self._position[1] + offset,
+                    length)
+        self._position = (last, self._position[1] + len(records))
+
+def _decode_links(data, i):
+    """decode the links of the record body at data[i:]"""
+    n, i = _read_varint(data, _read_varint(data, i)[1])
+    links = array.array('I')
+    previous = 0
+
+    for k in xrange(n):
+        delta, i = _read_varint(data, i)
+        previous += delta
+        links.append(previous)
+    return links
+
+def load_csr(directory):
+    """load the CSR arrays (indptr, indices) written by export_csr"""
+    with open(os.path.join(directory, "csr.json"), "rb") as fp:
+        description = json.load(fp)
+    arrays = []
+
+    for name, n in (("indptr", description["nodes"] + 1),
+            ("indices", description["edges"])):
+        arrays.append(array.array(str(description[name])))
+
+        with open(os.path.join(directory, name), "rb") as fp:
+            arrays[-1].fromfile(fp, n)
+    return tuple(arrays)
+
+def _read_varint(data, i):
+    """return (the varint at data[i], the index after it)"""
+    shift = value = 0
+
+    while 1:
+        octet = data[i]
+        i += 1
+        value |= (octet & 0x7f) << shift
+
+        if octet < 0x80:
+            return value, i
+        shift += 7
+
+def _write_varint(data, value):
+    """append a varint to a bytearray"""
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
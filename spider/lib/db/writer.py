@@ -0,0 +1,177 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import atexit
+import Queue
+import sys
+import threading
+import weakref
+
+import db as _db
+
+__doc__ = "write-behind storage"
+
+_open = weakref.WeakSet() # the DBWriters to close at interpreter exit
+
+class DBWriter:
+    """
+    write (name, data) pairs to a db.DB in the background
+
+    pairs are put on one of nthreads bounded queues (chosen by name,
+    so writes to the same name stay in order); put blocks once a queue
+    holds maxsize // nthreads pairs, which bounds the memory used
+    and pushes back on producers when the disk can't keep up
+
+    each writer thread drains up to batch_size pairs at a time,
+    and stores them with a single DB.update (a group commit);
+    if that fails, the batch is retried pair by pair
+
+    anything queued is written by flush, close, __exit__,
+    or (as a last resort, while the writer's still open) at interpreter
+    exit; the pairs which couldn't be written are reported
+    by a WriteError, raised by the next put, flush or close
+    """
+
+    def __init__(self, db, nthreads = 1, maxsize = 1024, batch_size = 64):
+        if nthreads <= 0:
+            raise ValueError("nthreads must be positive")
+        self.batch_size = batch_size
+        self.closed = False
+        self.db = db
+        self._failed = [] # [(name, exception), ...]
+        self._failed_lock = threading.Lock()
+        self._queues = [Queue.Queue(max(maxsize // nthreads, 1))
+            for i in range(nthreads)]
+        self._threads = []
+
+        for queue in self._queues:
+            self._threads.append(threading.Thread(target = self._write_loop,
+                args = (queue, )))
+            self._threads[-1].daemon = True
+            self._threads[-1].start()
+        _open.add(self)
+
+    def close(self):
+        """write anything queued, then stop the writer threads"""
+        if self.closed:
+            return
+        self.closed = True
+        _open.discard(self)
+
+        for queue in self._queues:
+            queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def flush(self):
+        """wait for everything queued to be written"""
+        for queue in self._queues:
+            queue.join()
+        self._raise()
+
+    def put(self, name, data):
+        """queue a pair for writing, blocking while the queue is full"""
+        if self.closed:
+            raise ValueError("closed")
+        self._raise()
+        self._queues[hash(tuple(_db._as_list(name))) % len(self._queues)] \
+            .put((name, data))
+
+    def qsize(self):
+        """return the approximate number of pairs waiting"""
+        return sum((q.qsize() for q in self._queues))
+
+    def _raise(self):
+        """raise (and forget) a WriteError for the failed pairs"""
+        with self._failed_lock:
+            failed, self._failed = self._failed, []
+
+        if failed:
+            raise WriteError(failed)
+
+    def _write(self, batch):
+        """write a batch, falling back to one pair at a time"""
+        try:
+            self.db.update(batch)
+            return
+        except Exception:
+            if len(batch) == 1:
+                raise
+
+        for name, data in batch:
+            try:
+                self.db.update([(name, data)])
+            except Exception as e:
+                with self._failed_lock:
+                    self._failed.append((name, e))
+
+    def _write_loop(self, queue):
+        """write batches from a queue until told to stop"""
+        stop = False
+
+        while not stop:
+            batch = []
+            pair = queue.get()
+
+            while pair is not None:
+                batch.append(pair)
+
+                if len(batch) >= self.batch_size:
+                    break
+
+                try:
+                    pair = queue.get_nowait()
+                except Queue.Empty:
+                    break
+            stop = pair is None
+
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                with self._failed_lock:
+                    self._failed.append((batch[0][0], e))
+            finally:
+                for i in range(len(batch) + stop):
+                    queue.task_done()
+
+class WriteError(IOError):
+    """
+    an error for the pairs a DBWriter couldn't write:
+    failed is a list of (name, exception), and names lists the names
+    """
+
+    def __init__(self, failed):
+        IOError.__init__(self, "%u pair(s) not written (first: %r: %s)"
+            % (len(failed), failed[0][0], failed[0][1]))
+        self.failed = failed
+        self.names = [n for n, e in failed]
+
+def _close_all():
+    """close the DBWriters still open"""
+    for writer in list(_open):
+        try:
+            writer.close()
+        except WriteError as e: # (too late to raise)
+            print >> sys.stderr, "DBWriter:", e
+atexit.register(_close_all)
@@ -16,6 +16,10 @@
 __package__ = __name__
 
 import disque
-from disque import Disque
+from disque import Disque, Lease
+import hybrid
+from hybrid import HybridDisque
+import seen
+from seen import Seen
 
 __doc__ = "persistent, large-scale queueing"
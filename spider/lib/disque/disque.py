@@ -19,9 +19,11 @@ import hashlib
 import json
 import os
 import Queue
+import StringIO
 import sys
 import threading
 import time
+import zlib
 
 from lib import withfile
 
@@ -43,27 +45,91 @@ class Disque:
     because this operates by buffering entries,
     not everything may be on disk at a time;
     TO SAFELY ENSURE PERSISTENCE, RUN sync or __exit__ ON EXIT
+
+    the index also keeps running totals (the on-disk size and byte count,
+    and the number of entries ever enqueued/dequeued), so qsize and stats
+    never have to touch the chunks
+
+    if lease_duration is specified, the disque is leased:
+    get takes one entry at a time straight off the disk and returns
+    a Lease, which must be passed to ack once it's been handled;
+    leases are journaled on-disk, and any left unacknowledged
+    for longer than lease_duration seconds are reissued,
+    so a crashed consumer loses nothing
+
+    the lease table is kept in memory, and only what other processes
+    have since appended to the journal is read; acknowledgements
+    are group-committed, at most every ack_interval seconds
+    (by ack, get, empty, qsize and stats), and on flush_acks and sync,
+    along with the input buffer, so anything put while handling a lease
+    is on-disk before the lease is dropped (a crash before then
+    reissues the lease, rather than losing the puts); until then,
+    a lease still counts as outstanding, to other processes too
+
+    chunks may be compressed, as specified by compression:
+        None
+            -> plain CSV
+        "front"
+            -> front-coding: each entry is stored as the length of
+            the prefix it shares with the previous entry, and the remainder
+        "zlib"
+            -> zlib-compressed CSV
+        "front+zlib"
+            -> both
+    a compressed chunk starts with a NUL-prefixed header line naming
+    its compression, so chunks written with different settings
+    can be mixed freely; stats reports the compression ratio
+    and the time spent (de)compressing
     """
     
+    BYTES = "bytes"
     CHUNK_SIZE = "chunk-size"
+    DEQUEUED = "dequeued"
+    ENQUEUED = "enqueued"
     HEAD = "head"
+    HEAD_OFFSET = "head-offset"
     INDEX = ".index"
+    LEASED = "leased"
+    LEASES = ".leases"
     NEXT_TAIL = "next-tail"
+    RAW_BYTES = "raw-bytes"
+    SIZE = "size"
     
     def __init__(self, directory = os.getcwd(), hash = "sha256",
-            chunk_size = 512):
+            chunk_size = 512, lease_duration = None, compression = None,
+            ack_interval = 1):
         if not os.path.exists(directory):
             os.makedirs(directory)
+        self.ack_interval = ack_interval
+        self._acks = [] # acknowledged lease IDs, not yet journaled
+        self._acks_since = None # when the oldest was acknowledged
         self.directory = directory
+        if not compression in (None, "front", "zlib", "front+zlib"):
+            raise ValueError("unknown compression: %s" % compression)
+        self.compression = compression
+        self.compression_time = 0.0 # CPU seconds spent compressing
+        self.decompression_time = 0.0
         self._get_lock = threading.RLock()
         self.hash = hash
-        self._index = {Disque.CHUNK_SIZE: chunk_size, Disque.HEAD: "",
-                Disque.NEXT_TAIL: ""}
+        self._head_rows = ("", [], 0) # the cached head (name, rows, raw size)
+        self._index = {Disque.BYTES: 0, Disque.CHUNK_SIZE: chunk_size,
+                Disque.DEQUEUED: 0, Disque.ENQUEUED: 0, Disque.HEAD: "",
+                Disque.HEAD_OFFSET: 0, Disque.NEXT_TAIL: "",
+                Disque.RAW_BYTES: 0, Disque.SIZE: 0}
         self._index_fp = None
         self._index_fp_lock = None
         self._inbuf = collections.deque()
+        self.lease_duration = lease_duration
+        self._leases = {} # ID -> (expires, octets), as of _leases_offset
+        self._leases_fp = None
+        self._leases_offset = 0 # how much of the journal has been read
+        self._leases_rows = 0
         self._outbuf = collections.deque()
         self._put_lock = threading.RLock()
+        self.get_rate = RateMeter()
+        self.put_rate = RateMeter()
+        self._unsynced = {Disque.DEQUEUED: 0, Disque.ENQUEUED: 0}
+        self._unsynced_lock = threading.Lock()
 
     def _append_chunk(self, flush = False):
         """
@@ -72,13 +138,13 @@ class Disque:
         """
         self.__enter__()
         
-        with self._put_lock:
-            if not len(self._inbuf) \
-                    or (not len(self._inbuf) >= self._index[Disque.CHUNK_SIZE]
-                    and not flush):
-                return
-            
-            with self._index_fp_lock:
+        with self._index_fp_lock: # always before _put_lock
+            with self._put_lock:
+                if not len(self._inbuf) \
+                        or (not len(self._inbuf) \
+                            >= self._index[Disque.CHUNK_SIZE]
+                        and not flush):
+                    return
                 self._load_index()
                 tail = self._index[Disque.NEXT_TAIL]
 
@@ -90,37 +156,158 @@ class Disque:
                 path = os.path.join(self.directory, tail)
                 self._index[Disque.NEXT_TAIL] = self._generate_name()
                 
-                with self._persistent_open(path) as fp:
-                    i = 0
-                    writer = csv.writer(fp)
-
-                    while i < self._index[Disque.CHUNK_SIZE] \
-                            and len(self._inbuf):
-                        writer.writerow([self._inbuf.popleft()])
-                        i += 1
-                    writer.writerow([self._index[Disque.NEXT_TAIL]]) # link
-                    self._fsync(fp)
+                self._write_chunk(path, [self._inbuf.popleft()
+                    for i in range(min(self._index[Disque.CHUNK_SIZE],
+                        len(self._inbuf)))],
+                    self._index[Disque.NEXT_TAIL])
                 self._dump_index()
 
                 if flush and len(self._inbuf): # flush the remainder
                     self._append_chunk(True)
 
-    def _dump_index(self):
-        """dump the index"""
+    def ack(self, lease):
+        """
+        acknowledge that a lease was handled, removing its entry for good
+        (once committed: see _commit_acks)
+
+        this does nothing when lease isn't a Lease
+        """
+        if not isinstance(lease, Lease):
+            return
+
+        with self._put_lock:
+            self._acks.append(lease.id)
+
+            if self._acks_since is None:
+                self._acks_since = time.time()
+        self._commit_acks()
+
+    def _commit_acks(self, force = False):
+        """
+        journal the pending acknowledgements (after flushing
+        the input buffer), if the oldest is ack_interval seconds old
+        or force is specified
+        """
+        with self._put_lock:
+            if not len(self._acks) or (not force
+                    and time.time() - self._acks_since < self.ack_interval):
+                return
+        self.__enter__()
+
+        with self._index_fp_lock: # always before _put_lock
+            with self._put_lock:
+                self._append_chunk(True) # persist whatever the consumer put
+                self._journal([["a", id] for id in self._acks])
+                self._acks = []
+                self._acks_since = None
+            self._compact_leases()
+
+    def _compact_leases(self):
+        """rewrite the lease journal when it's mostly acknowledgements"""
+        with self._index_fp_lock:
+            self._refresh_leases()
+
+            if self._leases_rows <= 2 * len(self._leases) + 64:
+                return
+            path = os.path.join(self.directory, Disque.LEASES)
+
+            with open(path + ".tmp", "wb") as fp:
+                writer = csv.writer(fp)
+
+                for id, (expires, octets) in self._leases.iteritems():
+                    writer.writerow(["l", id, repr(expires), octets])
+                self._fsync(fp)
+            os.rename(path + ".tmp", path) # (others reopen it)
+            self._leases_fp.close()
+            self._refresh_leases()
+
+    def _compress(self, rows):
+        """return (raw size, encoded chunk) for a list of rows"""
+        start = time.clock()
+        sio = StringIO.StringIO()
+        writer = csv.writer(sio)
+
+        if self.compression:
+            sio.write("\x00%s\n" % self.compression) # header
+
+        if self.compression and "front" in self.compression:
+            previous = ""
+
+            for row in rows:
+                n = len(os.path.commonprefix((previous, row)))
+                writer.writerow([n, row[n:]])
+                previous = row
+        else:
+            writer.writerows(([r] for r in rows))
+        data = sio.getvalue()
+
+        if self.compression and "zlib" in self.compression:
+            header, data = data.split("\n", 1)
+            data = "\n".join((header, zlib.compress(data)))
+
+        if self.compression:
+            self.compression_time += time.clock() - start
+        return sum((len(r) + 2 for r in rows)), data
+
+    def _count(self, key):
+        """count a get/put until the next index dump"""
+        with self._unsynced_lock:
+            self._unsynced[key] += 1
+        (self.get_rate if key == Disque.DEQUEUED else self.put_rate).mark()
+
+    def _decompress(self, data):
+        """return (raw size, rows) for an encoded chunk"""
+        start = time.clock()
+        compression = ""
+
+        if data.startswith("\x00"):
+            compression, data = data[1:].split("\n", 1)
+
+        if "zlib" in compression:
+            data = zlib.decompress(data)
+        rows = [row for row in csv.reader(StringIO.StringIO(data))]
+
+        if "front" in compression:
+            previous = ""
+
+            for i, (n, suffix) in enumerate(rows):
+                rows[i] = previous = previous[:int(n)] + suffix
+        else:
+            rows = [row[0] for row in rows]
+
+        if compression:
+            self.decompression_time += time.clock() - start
+        return sum((len(r) + 2 for r in rows)), rows
+
+    def _dump_index(self, sync = True):
+        """dump the index, optionally synching it to disk"""
         with self._index_fp_lock:
+            with self._unsynced_lock: # fold in the local counts
+                for key, n in self._unsynced.iteritems():
+                    self._index[key] += n
+                    self._unsynced[key] = 0
             self._index_fp.seek(0, os.SEEK_SET)
             json.dump(self._index, self._index_fp)
-            self._fsync(self._index_fp)
+            self._index_fp.truncate() # the previous index may've been longer
+
+            if sync:
+                self._fsync(self._index_fp)
+            else:
+                self._index_fp.flush()
 
     def empty(self):
         """return whether the disque is empty"""
         self.__enter__()
+        self._commit_acks()
         
         with self._get_lock:
             if len(self._outbuf): # diminish flock calls
                 return False
             
             with self._index_fp_lock:
+                if self.lease_duration is not None: # don't touch the chunks
+                    return not self.qsize() and not len(self._expired())
+
                 while not len(self._outbuf):
                     try:
                         self._pop_chunk()
@@ -141,8 +328,35 @@ class Disque:
 
     def __exit__(self, *exception):
         self._index_fp.close()
+
+        if isinstance(self._leases_fp, file):
+            self._leases_fp.close()
         self.sync()
 
+    def _expired(self):
+        """
+        return a list of (ID, octets) for the expired leases
+        (except those acknowledged, but not yet committed)
+        """
+        now = time.time()
+
+        with self._index_fp_lock:
+            self._refresh_leases()
+
+            with self._put_lock:
+                return [(id, octets)
+                    for id, (expires, octets) in self._leases.iteritems()
+                    if expires <= now and not id in self._acks]
+
+    def flush_acks(self):
+        """commit the pending acknowledgements now (see _commit_acks)"""
+        self._commit_acks(True)
+
+    def _forget_head(self, path):
+        """remove the (read) head chunk from the byte counts"""
+        self._index[Disque.BYTES] -= os.path.getsize(path)
+        self._index[Disque.RAW_BYTES] -= self._head_rows[2]
+
     def _fsync(self, fp):
         """flush a file-like objects buffer, synching to disk if possible"""
         fp.flush()
@@ -157,17 +371,73 @@ class Disque:
         return getattr(hashlib, self.hash)(id).hexdigest()
 
     def get(self):
-        """get octets from the disque"""
+        """get octets (or a Lease, if leased) from the disque"""
         self.__enter__()
+
+        if self.lease_duration is not None:
+            return self._get_lease()
         
         with self._get_lock:
-            if len(self._outbuf): # diminish flock calls
-                return self._outbuf.popleft()
-            
+            if not len(self._outbuf): # diminish flock calls
+                with self._index_fp_lock:
+                    while not len(self._outbuf):
+                        self._pop_chunk()
+            octets = self._outbuf.popleft()
+            self._count(Disque.DEQUEUED)
+            return octets
+
+    def _get_lease(self):
+        """
+        lease the next entry, preferring expired leases
+
+        the lease is journaled (and synched) before the index is advanced,
+        so a crash in between causes a repeat, not a loss;
+        the index itself isn't synched, since losing its update
+        only causes a repeat too
+        """
+        self._commit_acks()
+
+        with self._get_lock:
             with self._index_fp_lock:
-                while not len(self._outbuf):
-                    self._pop_chunk()
-                return self._outbuf.popleft()
+                self._load_index(False)
+                expired = self._expired()
+                journal = []
+                
+                if len(expired): # reissue under a new ID
+                    id, octets = expired[0]
+                    journal.append(["a", id])
+                else:
+                    path = self._locate_head()
+                    rows = self._read_head(path)
+
+                    while self._index[Disque.HEAD_OFFSET] >= len(rows) - 1:
+                        self._forget_head(path)
+                        self._index[Disque.HEAD] = rows[-1]
+                        self._index[Disque.HEAD_OFFSET] = 0
+                        self._dump_index()
+                        os.remove(path)
+                        path = self._locate_head()
+                        rows = self._read_head(path)
+                    octets = rows[self._index[Disque.HEAD_OFFSET]]
+                    self._index[Disque.HEAD_OFFSET] += 1
+                    self._index[Disque.SIZE] -= 1
+                lease = Lease(octets, os.urandom(8).encode("hex"),
+                    time.time() + self.lease_duration)
+                journal.append(["l", lease.id, repr(lease.expires),
+                    octets])
+                self._journal(journal)
+                self._count(Disque.DEQUEUED)
+                self._dump_index(False)
+                return lease
+
+    def _journal(self, rows):
+        """append rows to the lease journal, synching it"""
+        with self._index_fp_lock:
+            self._refresh_leases()
+            fp = self._open_leases()
+            csv.writer(fp).writerows(rows)
+            self._fsync(fp)
+            self._refresh_leases() # (reading back only these rows)
 
     def _load_index(self, re_sync = True):
         """load the index, then optionally re-sync to ensure valid data"""
@@ -185,17 +455,63 @@ class Disque:
             if isinstance(index, dict):
                 index = {str(k): v for k, v in index.iteritems()}
                 
-                for key, type in ((Disque.CHUNK_SIZE, int), (Disque.HEAD, str),
-                        (Disque.NEXT_TAIL, str)): # caste
+                for key, type in ((Disque.BYTES, int),
+                        (Disque.CHUNK_SIZE, int), (Disque.DEQUEUED, int),
+                        (Disque.ENQUEUED, int), (Disque.HEAD, str),
+                        (Disque.HEAD_OFFSET, int), (Disque.NEXT_TAIL, str),
+                        (Disque.RAW_BYTES, int), (Disque.SIZE, int)): # caste
                     if key in index:
                         try:
-                            self._index[key] = type(self._index[key])
+                            self._index[key] = type(index[key])
                         except (TypeError, ValueError):
                             pass
 
             if re_sync: # in case the index wasn't valid
                 self._dump_index()
 
+    def _load_leases(self):
+        """return the active leases as {ID: (expires, octets)}, and the
+        number of rows in the journal"""
+        with self._index_fp_lock:
+            self._refresh_leases()
+            return dict(self._leases), self._leases_rows
+
+    def _locate_head(self):
+        """return the path to the head chunk, or raise a ValueError"""
+        with self._index_fp_lock:
+            if not self._index[Disque.HEAD]:
+                self._append_chunk(True)
+            path = os.path.join(self.directory, self._index[Disque.HEAD])
+
+            if not os.path.isfile(path): # check for buffered input
+                self._append_chunk(True)
+                path = os.path.join(self.directory, self._index[Disque.HEAD])
+
+            if not os.path.isfile(path):
+                raise ValueError("empty")
+            return path
+
+    def _open_leases(self):
+        """
+        return the lease journal, opening it as needed;
+        if it's been replaced (compacted by another process),
+        it's reopened, and the lease table forgotten
+        """
+        path = os.path.join(self.directory, Disque.LEASES)
+
+        if isinstance(self._leases_fp, file) and not self._leases_fp.closed \
+                and os.path.exists(path) and not os.stat(path).st_ino \
+                    == os.fstat(self._leases_fp.fileno()).st_ino:
+            self._leases_fp.close()
+
+        if not isinstance(self._leases_fp, file) or self._leases_fp.closed:
+            self._leases_fp = self._persistent_open(path)
+            self._leases = {}
+            self._leases_offset = 0
+            self._leases_rows = 0
+        self._leases_fp.seek(0, os.SEEK_END)
+        return self._leases_fp
+
     def _persistent_open(self, path):
         """open a path using a mode that'll preserve its contents"""
         return open(path, ('r' if os.path.exists(path) else 'w') + "+b")
@@ -207,28 +523,17 @@ class Disque:
         with self._get_lock:
             with self._index_fp_lock:
                 self._load_index()
-
-                if not self._index[Disque.HEAD]:
-                    self._append_chunk(True)
-                path = os.path.join(self.directory, self._index[Disque.HEAD])
-                
-                if not os.path.isfile(path): # check for buffered input
-                    self._append_chunk(True)
-                    path = os.path.join(self.directory,
-                        self._index[Disque.HEAD])
-
-                if not os.path.isfile(path):
-                    raise ValueError("empty")
-                
-                with open(path, "rb") as fp:
-                    fp_reader = csv.reader(fp)
-
-                    for row in fp_reader:
-                        self._outbuf.append(row[0])
+                path = self._locate_head()
+                rows = list(self._read_head(path))
                 self._index[Disque.HEAD] = "" # assume empty
                 
-                if len(self._outbuf): # extract link to new head
-                    self._index[Disque.HEAD] = self._outbuf.pop()
+                if len(rows): # extract link to new head
+                    self._index[Disque.HEAD] = rows.pop()
+                rows = rows[self._index[Disque.HEAD_OFFSET]:] # skip leased
+                self._index[Disque.HEAD_OFFSET] = 0
+                self._outbuf.extend(rows)
+                self._forget_head(path)
+                self._index[Disque.SIZE] -= len(rows)
                 os.remove(path)
                 self._dump_index()
 
@@ -240,10 +545,121 @@ class Disque:
                 " or unicode instance")
         self.__enter__()
 
-        with self._put_lock:
-            with self._index_fp_lock:
+        with self._index_fp_lock:
+            with self._put_lock:
                 self._inbuf.append(octets)
+                self._count(Disque.ENQUEUED)
                 self._append_chunk(flush)
+
+    def put_front(self, entries):
+        """
+        put entries (in order) ahead of everything in the disque;
+        they're gotten first, and written to disk by the next sync
+        """
+        entries = list(entries)
+
+        for octets in entries:
+            if not isinstance(octets, bytearray) \
+                    and not isinstance(octets, str) \
+                    and not isinstance(octets, unicode):
+                raise TypeError("octets must be a bytearray, str," \
+                    " or unicode instance")
+
+        with self._get_lock:
+            self._outbuf.extendleft(reversed(entries))
+
+        for octets in entries:
+            self._count(Disque.ENQUEUED)
+
+    def requeue(self, lease):
+        """give up a lease, so its entry is reissued by the next get"""
+        if not isinstance(lease, Lease):
+            raise TypeError("lease must be a Lease instance")
+        self.__enter__()
+        self._journal([["l", lease.id, repr(0.0), lease]])
+
+    def _refresh_leases(self):
+        """read the rows appended to the lease journal since the last read"""
+        with self._index_fp_lock:
+            fp = self._open_leases()
+
+            if fp.tell() <= self._leases_offset:
+                return
+            fp.seek(self._leases_offset, os.SEEK_SET)
+            data = fp.read()
+            data = data[:data.rfind("\n") + 1] # whole rows only
+
+            for row in csv.reader(StringIO.StringIO(data)):
+                self._leases_rows += 1
+
+                if row[0] == "a":
+                    self._leases.pop(row[1], None)
+                elif row[0] == "l":
+                    self._leases[row[1]] = (float(row[2]), row[3])
+            self._leases_offset += len(data)
+
+    def _read_head(self, path):
+        """return the rows of the head chunk (including the link)"""
+        name = os.path.basename(path)
+
+        if not self._head_rows[0] == name: # chunks are immutable
+            with open(path, "rb") as fp:
+                self._head_rows = (name, ) + self._decompress(fp.read())[::-1]
+        return self._head_rows[1]
+
+    def qsize(self):
+        """
+        return the number of entries, including those buffered
+        by this instance
+
+        this only reads the index, so it's cheap enough to poll
+        """
+        self.__enter__()
+        self._commit_acks()
+
+        with self._index_fp_lock:
+            self._load_index(False)
+            return max(self._index[Disque.SIZE], 0) + len(self._inbuf) \
+                + len(self._outbuf)
+
+    def stats(self):
+        """
+        return a dict of counters, as such:
+            bytes: the size of the on-disk chunks
+            compression-ratio: the uncompressed size over bytes
+            compression-time: CPU seconds spent compressing
+                (this instance only)
+            decompression-time: CPU seconds spent decompressing
+                (this instance only)
+            dequeued: the total number of entries ever gotten
+            enqueued: the total number of entries ever put
+            get-rate: gets per second (this instance only)
+            leased: the number of outstanding leases (including those
+                acknowledged, but not yet committed: see flush_acks)
+            put-rate: puts per second (this instance only)
+            size: the number of entries (see qsize)
+        """
+        self.__enter__()
+        self._commit_acks()
+
+        with self._index_fp_lock:
+            self._load_index(False)
+            with self._unsynced_lock:
+                dequeued, enqueued = (self._index[k] + self._unsynced[k]
+                    for k in (Disque.DEQUEUED, Disque.ENQUEUED))
+            return {Disque.BYTES: self._index[Disque.BYTES],
+                "compression-ratio": float(self._index[Disque.RAW_BYTES])
+                    / self._index[Disque.BYTES]
+                    if self._index[Disque.BYTES] > 0 else 1.0,
+                "compression-time": self.compression_time,
+                "decompression-time": self.decompression_time,
+                Disque.DEQUEUED: dequeued, Disque.ENQUEUED: enqueued,
+                "get-rate": self.get_rate.rate(),
+                Disque.LEASED: len(self._load_leases()[0])
+                    if os.path.exists(os.path.join(self.directory,
+                        Disque.LEASES)) else 0,
+                "put-rate": self.put_rate.rate(),
+                Disque.SIZE: self.qsize()}
     
     def sync(self):
         """
@@ -254,33 +670,86 @@ class Disque:
         being smaller than the specified chunk size
         """
         self.__enter__()
+        self._commit_acks(True)
         
-        with self._index_fp_lock:
-            current = new_head = self._generate_name()
-            next = self._generate_name()
-            
-            while len(self._outbuf): # re-insert the buffered head(s)
-                path = os.path.join(self.directory, current)
-                
-                with self._persistent_open(path) as fp:
-                    fp_writer = csv.writer(fp)
-                    i = 0
+        with self._get_lock:
+            with self._index_fp_lock:
+                self._load_index(False)
 
-                    while i < self._index[Disque.CHUNK_SIZE] \
-                            and len(self._outbuf):
-                        fp_writer.writerow([self._outbuf.popleft()])
-                        i += 1
+                if len(self._outbuf) and self._index[Disque.HEAD_OFFSET]:
+                    self._pop_chunk() # the head was partially leased
+                current = new_head = self._generate_name()
+                next = self._generate_name()
 
-                    if i == self._index[Disque.CHUNK_SIZE] \
-                            and not len(self._outbuf):
+                while len(self._outbuf): # re-insert the buffered head(s)
+                    entries = [self._outbuf.popleft()
+                        for i in range(min(self._index[Disque.CHUNK_SIZE],
+                            len(self._outbuf)))]
+
+                    if not len(self._outbuf): # the last re-inserted chunk
                         if self._index[Disque.HEAD]: # link to head
                             next = self._index[Disque.HEAD]
-                        else: # headless, so act as a normal append operation
+                        else: # headless, so act as a normal append
                             self._index[Disque.NEXT_TAIL] = next
-                    fp_writer.writerow([next]) # link
-                    self._fsync(fp)
-                current = next
-                next = self._generate_name()
-            self._index[Disque.HEAD] = new_head # redirect
-            self._dump_index()
-            self._append_chunk(True) # flush the buffered tail(s)
+                    self._write_chunk(os.path.join(self.directory, current),
+                        entries, next)
+                    current = next
+                    next = self._generate_name()
+
+                    if not len(self._outbuf): # redirect
+                        self._index[Disque.HEAD] = new_head
+                self._dump_index()
+                self._append_chunk(True) # flush the buffered tail(s)
+
+    def _write_chunk(self, path, entries, link):
+        """write a chunk of entries followed by a link, and count it"""
+        raw_size, data = self._compress(entries + [link])
+
+        with self._persistent_open(path) as fp:
+            fp.write(data)
+            fp.truncate()
+            self._fsync(fp)
+        self._index[Disque.BYTES] += len(data)
+        self._index[Disque.RAW_BYTES] += raw_size
+        self._index[Disque.SIZE] += len(entries)
+
+class Lease(str):
+    """an entry gotten from a leased Disque, with its ID and expiry time"""
+
+    def __new__(cls, octets, id, expires):
+        self = str.__new__(cls, octets)
+        self.expires = expires
+        self.id = id
+        return self
+
+class RateMeter:
+    """a rolling event rate, counted in one-second buckets"""
+
+    def __init__(self, window = 60):
+        self._buckets = collections.deque() # [second, count]
+        self._lock = threading.Lock()
+        self.window = window
+
+    def _expire(self, now):
+        """drop buckets that have left the window"""
+        while len(self._buckets) and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+
+    def mark(self, n = 1):
+        """count n events"""
+        now = int(time.time())
+
+        with self._lock:
+            if len(self._buckets) and self._buckets[-1][0] == now:
+                self._buckets[-1][1] += n
+            else:
+                self._buckets.append([now, n])
+                self._expire(now)
+
+    def rate(self):
+        """return the mean number of events per second over the window"""
+        now = int(time.time())
+
+        with self._lock:
+            self._expire(now)
+            return float(sum((b[1] for b in self._buckets))) / self.window
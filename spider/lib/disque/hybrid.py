@@ -0,0 +1,167 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://hiten2.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import collections
+import os
+import shutil
+import threading
+
+from disque import Disque
+
+__doc__ = "memory-then-disk queueing"
+
+class HybridDisque:
+    """
+    a FIFO structure which keeps its head and tail in memory,
+    and only spills the middle to a Disque under memory pressure
+
+    entries flow tail -> (spilled) -> head;
+    once the buffered entries exceed memory_limit octets,
+    the oldest entries of the tail are spilled until half that remains,
+    and while anything is spilled, the head is only ever refilled
+    from the spill (in batches of up to a quarter of memory_limit octets),
+    so FIFO order is kept
+
+    the Disque is created lazily (with disque_kwargs), so small queues
+    never touch the disk; if persistent, sync and __exit__ write
+    the whole queue to it (in order), otherwise __exit__ discards
+    anything spilled
+
+    like Disque, get raises a ValueError when empty
+    """
+
+    def __init__(self, directory = os.getcwd(), memory_limit = 67108864,
+            persistent = True, **disque_kwargs):
+        self.directory = directory
+        self._disque = None
+        self.disque_kwargs = disque_kwargs
+        self._head = collections.deque()
+        self._lock = threading.RLock()
+        self.memory_limit = memory_limit
+        self._nbytes = 0 # octets buffered in memory
+        self._nspilled = 0
+        self.persistent = persistent
+        self._tail = collections.deque()
+
+        if os.path.exists(os.path.join(directory, Disque.INDEX)): # resume
+            self._nspilled = self._open().qsize()
+
+    def empty(self):
+        """return whether the queue is empty"""
+        with self._lock:
+            return not len(self._head) and not self._nspilled \
+                and not len(self._tail)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        with self._lock:
+            if self.persistent:
+                self.sync()
+
+                if self._disque:
+                    self._disque.__exit__()
+            elif self._disque:
+                self._disque.__exit__()
+                shutil.rmtree(self.directory, True)
+                self._disque = None
+                self._nspilled = 0
+
+    def get(self):
+        """get octets from the queue"""
+        with self._lock:
+            if not len(self._head):
+                if self._nspilled:
+                    self._refill()
+                else: # everything's in the tail
+                    self._head, self._tail = self._tail, self._head
+
+            if not len(self._head):
+                raise ValueError("empty")
+            octets = self._head.popleft()
+            self._nbytes -= len(octets)
+            return octets
+
+    def _open(self):
+        """return the spill Disque, creating it as needed"""
+        if not self._disque:
+            self._disque = Disque(self.directory, **self.disque_kwargs)
+        return self._disque
+
+    def put(self, octets):
+        """put octets into the queue"""
+        if not isinstance(octets, bytearray) and not isinstance(octets, str) \
+                and not isinstance(octets, unicode):
+            raise TypeError("octets must be a bytearray, str," \
+                " or unicode instance")
+
+        with self._lock:
+            self._tail.append(octets)
+            self._nbytes += len(octets)
+
+            if self._nbytes > self.memory_limit:
+                self._spill()
+
+    def qsize(self):
+        """return the number of entries"""
+        with self._lock:
+            return len(self._head) + self._nspilled + len(self._tail)
+
+    def _refill(self):
+        """refill the head from the spill"""
+        nbytes = 0
+
+        while self._nspilled and nbytes < self.memory_limit // 4:
+            try:
+                octets = self._open().get()
+            except ValueError: # out of sync (e.g. lost buffers)
+                self._nspilled = 0
+                break
+            self._head.append(octets)
+            nbytes += len(octets)
+            self._nspilled -= 1
+        self._nbytes += nbytes
+
+        if self._nbytes > self.memory_limit: # make room in the tail
+            self._spill()
+
+    def _spill(self):
+        """spill the oldest tail entries until half the limit remains"""
+        disque = self._open()
+
+        while len(self._tail) and self._nbytes > self.memory_limit // 2:
+            octets = self._tail.popleft()
+            disque.put(octets)
+            self._nbytes -= len(octets)
+            self._nspilled += 1
+
+    def sync(self):
+        """write the whole queue, in order, to the Disque"""
+        with self._lock:
+            if not len(self._head) and not len(self._tail):
+                if self._disque:
+                    self._disque.sync()
+                return
+            disque = self._open()
+            self._nspilled += len(self._head) + len(self._tail)
+
+            disque.put_front(self._head) # (ahead of anything on-disk)
+
+            while len(self._tail):
+                disque.put(self._tail.popleft())
+            self._head.clear()
+            self._nbytes = 0
+            disque.sync()
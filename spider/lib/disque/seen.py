@@ -0,0 +1,119 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://hiten2.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import os
+import threading
+
+from lib import withfile
+
+__doc__ = "persistent, process-safe membership"
+
+class Seen:
+    """
+    a persistent set of strings (e.g. visited URLs),
+    safe to share between processes
+
+    members are hashed into one of 256 buckets,
+    each an append-only file of fixed-size digests;
+    an instance caches the digests it's read from a bucket,
+    so it only ever reads what other processes have since appended
+
+    access to a bucket is controlled via flock calls on its file
+    """
+
+    def __init__(self, directory = os.getcwd(), hash = "sha1",
+            digest_size = 16):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.digest_size = digest_size
+        self.directory = directory
+        self.hash = hash
+        self._buckets = {} # bucket -> [file, FileLock, offset, set]
+        self._lock = threading.Lock()
+
+    def add(self, string):
+        """add a string, and return whether it was new"""
+        digest = self._digest(string)
+        fp, lock, members = self._open(digest)
+
+        with lock:
+            self._refresh(digest)
+
+            if digest in members:
+                return False
+            fp.seek(0, os.SEEK_END)
+            fp.write(digest)
+            fp.flush()
+            self._buckets[digest[0]][2] = fp.tell()
+            members.add(digest)
+        return True
+
+    def __contains__(self, string):
+        digest = self._digest(string)
+        lock, members = self._open(digest)[1:]
+
+        with lock:
+            self._refresh(digest)
+            return digest in members
+
+    def _digest(self, string):
+        """return the truncated digest of a string"""
+        if isinstance(string, unicode):
+            string = string.encode("utf-8")
+        return getattr(hashlib, self.hash)(str(string)).digest()[
+            :self.digest_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        with self._lock:
+            for fp, lock, offset, members in self._buckets.values():
+                try:
+                    fp.close()
+                except (IOError, OSError):
+                    pass
+            self._buckets = {}
+
+    def __len__(self):
+        """return the number of members (this only stats the buckets)"""
+        return sum((os.path.getsize(os.path.join(self.directory, b))
+            for b in os.listdir(self.directory))) // self.digest_size
+
+    def _open(self, digest):
+        """return the (file, lock, members) for a digest's bucket"""
+        with self._lock:
+            if not digest[0] in self._buckets:
+                path = os.path.join(self.directory,
+                    "%02x" % ord(digest[0]))
+                fp = open(path, ('r' if os.path.exists(path) else 'w')
+                    + "+b")
+                self._buckets[digest[0]] = [fp, withfile.FileLock(fp), 0,
+                    set()]
+            fp, lock, offset, members = self._buckets[digest[0]]
+            return fp, lock, members
+
+    def _refresh(self, digest):
+        """read any digests appended to a bucket since the last refresh"""
+        bucket = self._buckets[digest[0]]
+        fp, members = bucket[0], bucket[3]
+        fp.seek(bucket[2], os.SEEK_SET)
+        data = fp.read()
+        data = data[:len(data) - len(data) % self.digest_size] # whole only
+
+        for i in range(0, len(data), self.digest_size):
+            members.add(data[i:i + self.digest_size])
+        bucket[2] += len(data)
@@ -0,0 +1,202 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from lib import disque
+
+__doc__ = "multi-process spidering on a single host"
+
+class MultiprocessSpider:
+    """
+    run a spider in each of nprocesses processes, all sharing
+    one leased disque.Disque frontier and one disque.Seen visited set
+
+    because file locks are shared across a fork,
+    spider_factory is called in each child with the child's frontier,
+    and must construct everything else (callback, databases, etc.) itself
+
+    the crawl ends once every child is idle and the frontier is empty
+    (including outstanding leases); a SIGINT or SIGTERM to the parent
+    shuts the children down cleanly, syncing their frontiers
+
+    progress is aggregated from the children's Spider.nhandled counters,
+    and written to the progress file every progress_interval seconds
+    """
+
+    def __init__(self, nprocesses, spider_factory, queue_directory = "queue",
+            seen_directory = None, chunk_size = 2048, lease_duration = 300,
+            progress = sys.stderr, progress_interval = 1, compression = None):
+        if nprocesses <= 0:
+            raise ValueError("nprocesses must be positive")
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self._interrupted = False
+        self.lease_duration = lease_duration
+        self.nprocesses = nprocesses
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.queue_directory = queue_directory
+
+        if not seen_directory:
+            seen_directory = os.path.join(queue_directory, "seen")
+        self.seen_directory = seen_directory
+        self.spider_factory = spider_factory
+        self._busy = multiprocessing.Array('b', [1] * nprocesses,
+            lock = False) # guarded by _lock
+        self._done = multiprocessing.Value('b', 0, lock = False)
+        self._lock = multiprocessing.Lock()
+        self._nhandled = multiprocessing.Array('L', nprocesses)
+        self._nhandled_offsets = [0] * nprocesses # from crashed children
+        self._processes = [None] * nprocesses
+        self._stopping = multiprocessing.Value('b', 0)
+
+    def __call__(self):
+        """crawl until finished or told otherwise"""
+        last = (time.time(), 0)
+        handlers = {}
+
+        for i in range(self.nprocesses):
+            self._spawn(i)
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            handlers[sig] = signal.signal(sig, self._stop)
+
+        try:
+            while any((p.is_alive() for p in self._processes)):
+                time.sleep(self.progress_interval)
+                last = self._report(last)
+
+                for i, p in enumerate(self._processes):
+                    if not p.is_alive() and p.exitcode \
+                            and not self._stopping.value \
+                            and not self._done.value: # crashed
+                        self._spawn(i)
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+
+            for p in self._processes:
+                p.join()
+            self._report(last)
+
+    def _child(self, i):
+        """crawl as the ith child"""
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self._interrupt)
+        url_queue = disque.Disque(self.queue_directory,
+            chunk_size = self.chunk_size, lease_duration = self.lease_duration,
+            compression = self.compression)
+        spider = self.spider_factory(url_queue)
+        spider.seen = disque.Seen(self.seen_directory)
+        publisher = threading.Thread(target = self._publish, args = (i,
+            spider))
+        publisher.daemon = True
+        publisher.start()
+
+        with spider.seen:
+            spider.__enter__()
+
+            try:
+                while not self._stopping.value and not self._done.value:
+                    spider()
+
+                    if not self._idle(i, url_queue):
+                        continue
+
+                    while not self._stopping.value \
+                            and not self._done.value:
+                        time.sleep(0.1)
+
+                        if not url_queue.empty():
+                            with self._lock:
+                                self._busy[i] = 1
+                            break
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self._nhandled[i] = spider.nhandled.get()
+                spider.__exit__()
+
+    def _idle(self, i, url_queue):
+        """
+        mark the ith child as idle, and return whether it should wait;
+        if every child is idle and the frontier is drained,
+        finish the crawl
+
+        the child's acknowledgements are committed first,
+        so its leases don't outlive it being busy
+        """
+        with self._lock:
+            if not url_queue.empty():
+                return False
+            url_queue.flush_acks()
+            self._busy[i] = 0
+
+            if not any(self._busy) and not url_queue.stats()[
+                    disque.Disque.LEASED]:
+                self._done.value = 1
+        return True
+
+    def _interrupt(self, *args):
+        """signal handler for the children"""
+        if self._interrupted: # (don't interrupt syncing)
+            return
+        self._interrupted = True # (in this child only)
+        self._stopping.value = 1
+        raise KeyboardInterrupt()
+
+    def _publish(self, i, spider):
+        """periodically publish the ith child's progress"""
+        while 1:
+            self._nhandled[i] = spider.nhandled.get()
+            time.sleep(self.progress_interval)
+
+    def _report(self, last):
+        """write the aggregate progress, and return (time, total)"""
+        now = time.time()
+        total = sum(self._nhandled) + sum(self._nhandled_offsets)
+
+        if self.progress:
+            self.progress.write("%u pages (%.2f/s)\n" % (total,
+                (total - last[1]) / max(now - last[0], 1e-6)))
+            self.progress.flush()
+        return now, total
+
+    def _spawn(self, i):
+        """start (or restart) the ith child"""
+        with self._lock:
+            self._busy[i] = 1 # busy until proven otherwise
+        self._nhandled_offsets[i] += self._nhandled[i]
+        self._nhandled[i] = 0
+        self._processes[i] = multiprocessing.Process(target = self._child,
+            args = (i, ))
+        self._processes[i].start()
+
+    def _stop(self, *args):
+        """signal handler for the parent: stop the children cleanly"""
+        self._stopping.value = 1
+
+        for p in self._processes:
+            if p.is_alive():
+                try:
+                    os.kill(p.pid, signal.SIGTERM)
+                except OSError:
+                    pass
@@ -0,0 +1,203 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+
+__doc__ = "near-duplicate detection, by SimHash"
+
+class SimHash:
+    """
+    a 64-bit SimHash of a text's word shingles (of up to size words),
+    fed incrementally
+
+    each shingle's hash votes on each bit of the fingerprint;
+    similar texts share most shingles, so their fingerprints differ
+    in few bits
+    """
+
+    def __init__(self, size = 3):
+        self._counts = {} # shingle hash -> occurrences
+        self._partial = "" # a word possibly continued by the next text
+        self.size = size
+        self._words = [] # the last size words
+
+    def _add(self, word):
+        """add a word, and the shingle it ends"""
+        self._words = (self._words + [word])[-self.size:]
+
+        if len(self._words) == self.size:
+            self._count(" ".join(self._words))
+
+    def _count(self, shingle):
+        h = struct.unpack("!Q", hashlib.md5(shingle.encode("utf-8")
+            if isinstance(shingle, unicode) else shingle).digest()[:8])[0]
+        self._counts[h] = self._counts.get(h, 0) + 1
+
+    def break_word(self):
+        """end any partial word (e.g. at a tag)"""
+        if self._partial:
+            self._add(self._partial)
+            self._partial = ""
+
+    def fingerprint(self):
+        """return the fingerprint, or None if there were no words"""
+        self.break_word()
+
+        if not self._counts and self._words: # fewer words than a shingle
+            self._count(" ".join(self._words))
+
+        if not self._counts:
+            return None
+        fingerprint = 0
+
+        for bit in range(64):
+            mask = 1 << bit
+
+            if sum((n if h & mask else -n
+                    for h, n in self._counts.iteritems())) > 0:
+                fingerprint |= mask
+        return fingerprint
+
+    def update(self, text):
+        """feed text (which may end mid-word)"""
+        words = (self._partial + text).lower().split()
+
+        if words and not text[-1:].isspace():
+            self._partial = words.pop()
+        else:
+            self._partial = ""
+
+        for word in words:
+            self._add(word)
+
+def distance(a, b):
+    """return the Hamming distance between two fingerprints"""
+    return bin(a ^ b).count('1')
+
+class SimHashIndex:
+    """
+    a persistent index of page fingerprints, for finding a near-duplicate
+    (within distance bits) of a new page
+
+    fingerprints are split into 4 bands of 16 bits, each indexed;
+    two fingerprints within 3 bits must share a band,
+    so a query only compares those sharing one
+    (a larger distance may miss near-duplicates)
+
+    the index is an SQLite database (by default, in memory),
+    and add_unique queries and adds in one transaction,
+    so several processes may share a file
+    """
+
+    BANDS = 4
+
+    def __init__(self, path = ":memory:", distance = 3, timeout = 60):
+        self._connection = None
+        self.distance = distance
+        self._mutex = threading.RLock()
+        self.path = path
+        self.timeout = timeout
+
+    def add(self, url, fingerprint):
+        """index a page's fingerprint"""
+        with self._mutex:
+            self.__enter__()
+            self._insert(self._connection, url, fingerprint)
+
+    def add_unique(self, url, fingerprint):
+        """
+        index a page's fingerprint unless it's a near-duplicate
+        (of another URL); return the URL it duplicates, or None
+        """
+        with self._mutex:
+            self.__enter__()
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+
+            try:
+                duplicate = self._find(cursor, url, fingerprint)
+
+                if duplicate is None:
+                    self._insert(cursor, url, fingerprint)
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+            return duplicate
+
+    def __del__(self):
+        self.__exit__()
+
+    def __enter__(self):
+        with self._mutex:
+            if self._connection is None:
+                if not self.path == ":memory:" \
+                        and os.path.dirname(self.path) \
+                        and not os.path.exists(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                self._connection = sqlite3.connect(self.path, self.timeout,
+                    check_same_thread = False, isolation_level = None)
+
+                if not self.path == ":memory:":
+                    self._connection.execute("PRAGMA journal_mode = WAL")
+                self._connection.execute("CREATE TABLE IF NOT EXISTS pages"
+                    " (url BLOB PRIMARY KEY, fingerprint INTEGER NOT NULL, %s)"
+                    % ", ".join(("b%u INTEGER NOT NULL" % i
+                    for i in range(SimHashIndex.BANDS))))
+
+                for i in range(SimHashIndex.BANDS):
+                    self._connection.execute("CREATE INDEX IF NOT EXISTS"
+                        " pages_b%u ON pages (b%u)" % (i, i))
+        return self
+
+    def __exit__(self, *exception):
+        with self._mutex:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def find(self, url, fingerprint):
+        """return the URL of a near-duplicate (of another URL), or None"""
+        with self._mutex:
+            self.__enter__()
+            return self._find(self._connection, url, fingerprint)
+
+    def _find(self, cursor, url, fingerprint):
+        for other, f in cursor.execute("SELECT url, fingerprint FROM pages"
+                " WHERE %s" % " OR ".join(("b%u = ?" % i
+                for i in range(SimHashIndex.BANDS))), _bands(fingerprint)):
+            if distance(f & 0xffffffffffffffff, fingerprint) \
+                    <= self.distance and not str(other) == url:
+                return str(other)
+        return None
+
+    def _insert(self, cursor, url, fingerprint):
+        cursor.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, %s)"
+            % ", ".join('?' * SimHashIndex.BANDS), [buffer(url),
+            _signed(fingerprint)] + _bands(fingerprint))
+
+def _bands(fingerprint):
+    """return a fingerprint's bands"""
+    width = 64 // SimHashIndex.BANDS
+    return [(fingerprint >> (i * width)) & ((1 << width) - 1)
+        for i in range(SimHashIndex.BANDS)]
+
+def _signed(fingerprint):
+    """return a fingerprint as SQLite's signed 64-bit integer"""
+    return fingerprint - (1 << 64) if fingerprint >> 63 else fingerprint
@@ -0,0 +1,185 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import heapq
+import json
+import math
+import threading
+import time
+
+import callback as _callback
+
+__doc__ = "adaptive recrawling"
+
+def change_rate(checks, changes, elapsed):
+    """
+    estimate a page's rate of change (per second), by Cho
+    and Garcia-Molina's estimator for a Poisson process
+    checked at regular intervals:
+        -log((checks - changes + 0.5) / (checks + 0.5)) / interval
+    where changes of the checks (over elapsed seconds) found it changed;
+    return None without any checks
+    """
+    if checks < 1 or elapsed <= 0:
+        return None
+    return -math.log((checks - changes + 0.5) / (checks + 0.5)) \
+        / (float(elapsed) / checks)
+
+class RecrawlScheduler:
+    """
+    schedule revisits of the pages in a db.DB by how often they change
+
+    each page's history is kept next to it, as JSON in the entry
+    [URL, "meta"]: its content fingerprint, when it was first fetched,
+    last checked and last changed, and how many revisits (checks)
+    found it changed; the next revisit is due 1 / change_rate after
+    the last check (or, while no change has been seen, twice the average
+    interval so far), clamped to [min_interval, max_interval]
+
+    the due times are loaded (lazily) into memory, and a scheduler
+    is also a rule (see Callback): it passes unknown URLs, and those due,
+    so a recrawl skips pages that aren't; feed puts the due URLs
+    on a queue, most overdue first
+    """
+
+    def __init__(self, db, min_interval = 3600, max_interval = 2592000):
+        self.db = db
+        self._due = None # URL -> time
+        self._lock = threading.RLock()
+        self.max_interval = max_interval
+        self.min_interval = min_interval
+
+    def __call__(self, url):
+        """return whether a URL is unknown, or due"""
+        with self._lock:
+            return self._times().get(url, 0) <= time.time()
+
+    def due(self, now = None):
+        """return the URLs due (by now), most overdue first"""
+        if now is None:
+            now = time.time()
+        return [u for t, u in self.queue() if t <= now] # (in time order)
+
+    def feed(self, url_queue, now = None):
+        """put the URLs due on a queue; return how many"""
+        due = self.due(now)
+
+        for url in due:
+            url_queue.put(url)
+        return len(due)
+
+    def interval(self, meta):
+        """return the revisit interval for a page's history"""
+        elapsed = meta["last"] - meta["first"]
+        rate = change_rate(meta["checks"], meta["changes"], elapsed)
+
+        if rate is None:
+            interval = self.min_interval
+        elif not rate:
+            interval = 2.0 * elapsed / meta["checks"]
+        else:
+            interval = 1 / rate
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def meta(self, url):
+        """return a page's history, or None"""
+        try:
+            return json.loads(self.db[[url, "meta"]])
+        except (IOError, KeyError, ValueError):
+            return None
+
+    def observe(self, url, fingerprint, now = None):
+        """
+        record a fetch of a page (with its content fingerprint),
+        and return when it's next due
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            meta = self.meta(url)
+
+            if meta is None:
+                meta = {"changed": now, "changes": 0, "checks": 0,
+                    "first": now}
+            else:
+                meta["checks"] += 1
+
+                if not meta["fingerprint"] == fingerprint:
+                    meta["changed"] = now
+                    meta["changes"] += 1
+            meta["fingerprint"] = fingerprint
+            meta["last"] = now
+            self.db[[url, "meta"]] = json.dumps(meta)
+            self._times()[url] = now + self.interval(meta)
+            return self._times()[url]
+
+    def queue(self):
+        """generate (due time, URL) for every known page, in time order"""
+        with self._lock:
+            heap = [(t, u) for u, t in self._times().iteritems()]
+        heapq.heapify(heap)
+
+        while heap:
+            yield heapq.heappop(heap)
+
+    def _times(self):
+        """return the due times, loading them first if need be"""
+        with self._lock:
+            if self._due is None:
+                self._due = {}
+
+                for name in self.db.iternames():
+                    if len(name) == 2 and name[1] == "meta":
+                        meta = self.meta(name[0])
+
+                        if meta is not None:
+                            self._due[name[0]] = meta["last"] \
+                                + self.interval(meta)
+            return self._due
+
+class RecrawlCallback(_callback.Callback):
+    """
+    record each response's fingerprint (the SHA-1 of its body)
+    with a RecrawlScheduler; as a sink (see CompositeCallback),
+    it's usually paired with a StorageCallback
+    """
+
+    READS_BODY = True
+
+    def __init__(self, scheduler, *args, **kwargs):
+        _callback.Callback.__init__(self, *args, **kwargs)
+        self.scheduler = scheduler
+
+    def __call__(self, response):
+        _continue = self._descend(response)
+        store = None
+
+        if _continue:
+            store = lambda r: self.store(r, None)
+        return _continue, self._extract(response, store)
+
+    def store(self, response, links):
+        """fingerprint a response's body, and record it"""
+        digest = hashlib.sha1()
+
+        while 1:
+            chunk = response.read(self.chunk_size)
+
+            if not chunk:
+                break
+            digest.update(chunk)
+        self.scheduler.observe(response.url, digest.hexdigest())
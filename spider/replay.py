@@ -0,0 +1,149 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import multiprocessing
+import zlib
+
+import callback as _callback
+from lib import db as _db
+
+__doc__ = "offline replay of stored responses"
+
+class ReplayResponse:
+    """
+    a response read back from a stored entry (e.g. a db.DBEntry),
+    with what callbacks use of a urllib2 response:
+    url, info() and read(), reading the body lazily from offset
+    """
+
+    code = 200
+    msg = "OK"
+
+    def __init__(self, url, header, entry, offset = 0):
+        self.entry = entry
+        self.header = header
+        self.offset = offset
+        self.url = url
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def from_entry(url, entry):
+        """
+        return the ReplayResponse for an entry stored by StorageCallback,
+        or raise a ValueError if it isn't one
+        """
+        header, offset = _callback.read_stored_header(entry)
+        return ReplayResponse(url, header, entry, offset)
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.header
+
+    def read(self, size = -1):
+        """read up to size octets (or the rest) of the body"""
+        data = self.entry.read(self.offset, size)
+        self.offset += len(data)
+        return data
+
+class Replayer:
+    """
+    stream the responses stored by StorageCallback in a database
+    back through callbacks (e.g. storage callbacks with new rules,
+    or for new sinks), without touching the network
+
+    the entries are split between nprocesses processes by a hash
+    of their names; like MultiprocessSpider's spider_factory,
+    callback_factory is called in each process (as is the database,
+    opened read-only, as db_class(directory, readonly = True)),
+    since file locks and connections don't survive a fork
+
+    entries which aren't stored responses (e.g. bodies alone) are skipped;
+    calling a Replayer returns the number of responses replayed
+    (including those dropped or aborted as callback.Unparseable)
+    """
+
+    def __init__(self, directory, callback_factory, nprocesses = 1,
+            db_class = _db.DB):
+        if nprocesses <= 0:
+            raise ValueError("nprocesses must be positive")
+        self.callback_factory = callback_factory
+        self.db_class = db_class
+        self.directory = directory
+        self.nprocesses = nprocesses
+
+    def __call__(self):
+        if self.nprocesses == 1:
+            return self._replay(0)
+        nreplayed = multiprocessing.Value('L', 0)
+        processes = [multiprocessing.Process(target = self._run,
+            args = (i, nreplayed)) for i in range(self.nprocesses)]
+
+        for p in processes:
+            p.start()
+
+        for p in processes:
+            p.join()
+
+        for i, p in enumerate(processes):
+            if p.exitcode:
+                raise RuntimeError("replay process %u failed" % i)
+        return nreplayed.value
+
+    def _replay(self, i):
+        """replay this process's share of the entries"""
+        callback = self.callback_factory()
+        db = self.db_class(self.directory, readonly = True)
+        n = 0
+
+        if hasattr(callback, "__enter__"):
+            callback.__enter__()
+
+        try:
+            for name in db.iternames():
+                url = name[0]
+
+                if self.nprocesses > 1 and not (zlib.crc32(url)
+                        & 0xffffffff) % self.nprocesses == i:
+                    continue
+
+                try:
+                    response = ReplayResponse.from_entry(url, db.entry(name))
+                except (KeyError, ValueError): # gone, or not a response
+                    continue
+
+                try:
+                    callback(response)
+                except _callback.Unparseable: # dropped, but handled
+                    pass
+                n += 1
+        finally:
+            if hasattr(callback, "__exit__"):
+                callback.__exit__()
+            db.__exit__()
+        return n
+
+    def _run(self, i, nreplayed):
+        """replay in a child process, adding to the count"""
+        n = self._replay(i)
+
+        with nreplayed.get_lock():
+            nreplayed.value += n
@@ -31,6 +31,20 @@ class Spider:
     a web spider (by default, single-threaded)
     which gets/puts URLs to/from the url_queue (which should implement the
     native Python Queue API)
+
+    if the url_queue has an ack method (e.g. a leased disque.Disque),
+    each URL is acknowledged once it's been handled
+
+    if seen is set (e.g. to a disque.Seen instance),
+    URLs already in it are skipped (and links to them aren't queued),
+    and handled URLs (including those failing with protocol errors)
+    are added to it
+
+    entering and exiting the spider enters and exits
+    both the url_queue and the callback (where supported)
+
+    requests are opened with urlopen (by default, urllib2.urlopen,
+    though e.g. an httpcache.CachingOpener may be passed as a keyword)
     """
     
     def __init__(self, url_queue = None, callback = callback.DEFAULT_CALLBACK,
@@ -38,8 +52,11 @@ class Spider:
             url_class = url.DEFAULT_URL_CLASS, *urlopen_args,
             **urlopen_kwargs):
         self.callback = callback
+        self.nhandled = threaded.Synchronized(0) # the number of pages crawled
         self.request_factory = request_factory
+        self.seen = None
         self.url_class = url_class # this should be (a subclass of) uri.URL
+        self.urlopen = urlopen_kwargs.pop("urlopen", urllib2.urlopen)
         self.urlopen_args = urlopen_args
         self.urlopen_kwargs = urlopen_kwargs
 
@@ -47,38 +64,59 @@ class Spider:
             url_queue = disque.Disque("queue", chunk_size = 2048) # for speed
         self.url_queue = url_queue
 
+    def _ack(self, url):
+        """acknowledge a handled URL, if the queue supports it"""
+        if hasattr(self.url_queue, "ack"):
+            getattr(self.url_queue, "ack")(url)
+
     def __call__(self):
         """continually crawl until told otherwise"""
         try:
-            while not self.url_queue.empty() \
-                    and self.handle_url(self.url_queue.get()):
-                pass
+            while not self.url_queue.empty():
+                url = self.url_queue.get()
+                _continue = self.handle_url(url)
+                self._ack(url)
+
+                if not _continue:
+                    break
         except KeyboardInterrupt:
             pass
 
     def __enter__(self):
-        if hasattr(self.url_queue, "__enter__"):
-            getattr(self.url_queue, "__enter__")()
+        for o in (self.url_queue, self.callback):
+            if hasattr(o, "__enter__"):
+                getattr(o, "__enter__")()
 
     def __exit__(self, *exception):
-        if hasattr(self.url_queue, "__exit__"):
-            getattr(self.url_queue, "__exit__")()
+        for o in (self.url_queue, self.callback):
+            if hasattr(o, "__exit__"):
+                getattr(o, "__exit__")()
 
     def handle_url(self, url):
         """crawl and return whether to continue"""
-        if not self.callback._enforce_rules(url): # skip
+        if not self.callback._enforce_rules(url) \
+                or (self.seen is not None and url in self.seen): # skip
             return True
         
         try:
-            response = urllib2.urlopen(self.request_factory(url),
+            response = self.urlopen(self.request_factory(url),
                 *self.urlopen_args, **self.urlopen_kwargs)
             _continue, links = self.callback(response)
+        except callback.Unparseable: # dropped or aborted, but handled
+            _continue, links = True, []
         except (socket.error, ssl.SSLError, urllib2.HTTPError,
                 urllib2.URLError): # ignore protocol errors
+            if self.seen is not None: # (don't refetch a dead link)
+                self.seen.add(url)
             return True
         
         for l in links:
-            self.url_queue.put(l)
+            if self.seen is None or not l in self.seen: # save queue space
+                self.url_queue.put(l)
+        
+        if self.seen is not None: # only once handled, in case of a crash
+            self.seen.add(url)
+        self.nhandled.transform(lambda n: n + 1)
         return _continue
 
 class BlockingSpider(Spider):
@@ -107,6 +145,9 @@ class BlockingSpider(Spider):
         crawl and modify the number of tasks
         to signal whether to continue
         """
-        if not self.handle_url(url): # signal exit
-            self.ntasks.set(0) # offset of -1 from 0 accounts for loop
-        self.ntasks.transform(lambda n: n - 1)
+        try:
+            if not self.handle_url(url): # signal exit
+                self.ntasks.set(0) # offset of -1 from 0 accounts for loop
+            self._ack(url)
+        finally:
+            self.ntasks.transform(lambda n: n - 1)
@@ -0,0 +1,400 @@
+# Copyright 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import base64
+import email.utils
+import gzip
+import hashlib
+import heapq
+import multiprocessing
+import os
+import tempfile
+import time
+import urlparse
+import uuid
+
+from lib import db as _db
+import replay
+
+__doc__ = "WARC and CDX export and import"
+
+CDX_HEADER = " CDX N b a m s k r M S V g\n"
+
+class WARCWriter:
+    """
+    a callback writing each response it's called with as a WARC
+    response record, compressed as its own gzip member, to rolling files
+    ("PREFIX-PID-SEQUENCE.warc.gz", rolled after max_size octets)
+    in directory; it extracts no links
+
+    each record's CDX line is buffered, and written (sorted)
+    to a run ("PREFIX-PID-SEQUENCE.cdx.run") every run_size lines
+    and on __exit__, which merge_cdx merges into the final index;
+    a body is spooled to a temporary file beyond spool_size octets,
+    so memory use is bounded
+    """
+
+    def __init__(self, directory, prefix = "crawl", max_size = 1073741824,
+            run_size = 1048576, spool_size = 1048576):
+        self._cdx = []
+        self.directory = directory
+        self._fp = None
+        self.max_size = max_size
+        self._name = None
+        self.prefix = prefix
+        self.run_size = run_size
+        self._runs = 0
+        self._sequence = 0
+        self.spool_size = spool_size
+
+    def __call__(self, response):
+        """write a response, and return (continue?, links)"""
+        self.write(response)
+        return True, []
+
+    def __del__(self):
+        self.__exit__()
+
+    def __enter__(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        return self
+
+    def __exit__(self, *exception):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+        self._flush_cdx()
+
+    def _flush_cdx(self):
+        """write the buffered CDX lines as a sorted run"""
+        if not self._cdx:
+            return
+        path = os.path.join(self.directory, "%s-%u-%05u.cdx.run" % (
+            self.prefix, os.getpid(), self._runs))
+
+        while os.path.exists(path): # (a reused PID)
+            self._runs += 1
+            path = os.path.join(self.directory, "%s-%u-%05u.cdx.run" % (
+                self.prefix, os.getpid(), self._runs))
+
+        with open(path + ".tmp", "wb") as fp:
+            fp.writelines(sorted(self._cdx))
+        os.rename(path + ".tmp", path)
+        self._cdx = []
+        self._runs += 1
+
+    def _roll(self):
+        """start a new WARC file, if there's none (or it's full)"""
+        if self._fp and self._fp.tell() < self.max_size:
+            return
+        elif self._fp:
+            self._fp.close()
+        self.__enter__()
+
+        while 1:
+            self._name = "%s-%u-%05u.warc.gz" % (self.prefix, os.getpid(),
+                self._sequence)
+            self._sequence += 1
+
+            if not os.path.exists(os.path.join(self.directory,
+                    self._name)): # (a reused PID)
+                break
+        self._fp = open(os.path.join(self.directory, self._name), "wb")
+
+    def write(self, response):
+        """write a response (with url, info and read) as a record"""
+        header = response.info()
+        digest = hashlib.sha1()
+        length = 0
+        status = getattr(response, "code", 200) or 200
+        timestamp = time.time()
+
+        if header.getheader("date"):
+            date = email.utils.parsedate_tz(header.getheader("date"))
+
+            if date:
+                timestamp = email.utils.mktime_tz(date)
+        http = "HTTP/1.1 %u %s\r\n%s\r\n" % (status,
+            getattr(response, "msg", "OK") or "OK",
+            "".join((l.rstrip("\r\n") + "\r\n" for l in header.headers)))
+
+        with tempfile.SpooledTemporaryFile(self.spool_size) as body:
+            while 1:
+                chunk = response.read(65536)
+
+                if not chunk:
+                    break
+                body.write(chunk)
+                digest.update(chunk)
+                length += len(chunk)
+            body.seek(0, os.SEEK_SET)
+            digest = base64.b32encode(digest.digest())
+            self._roll()
+            offset = self._fp.tell()
+            member = gzip.GzipFile(fileobj = self._fp, mode = "wb")
+
+            try:
+                member.write("WARC/1.0\r\n"
+                    "WARC-Type: response\r\n"
+                    "WARC-Record-ID: <urn:uuid:%s>\r\n"
+                    "WARC-Date: %s\r\n"
+                    "WARC-Target-URI: %s\r\n"
+                    "WARC-Payload-Digest: sha1:%s\r\n"
+                    "Content-Type: application/http; msgtype=response\r\n"
+                    "Content-Length: %u\r\n"
+                    "\r\n" % (uuid.uuid4(), time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp)),
+                    response.url, digest, len(http) + length))
+                member.write(http)
+
+                while 1:
+                    chunk = body.read(65536)
+
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                member.write("\r\n\r\n")
+            finally:
+                member.close() # (leaving the file open)
+        self._cdx.append(" ".join((_surt(response.url),
+            time.strftime("%Y%m%d%H%M%S", time.gmtime(timestamp)),
+            response.url, header.gettype(), str(status), digest, "-", "-",
+            str(self._fp.tell() - offset), str(offset), self._name)) + "\n")
+
+        if len(self._cdx) >= self.run_size:
+            self._flush_cdx()
+
+class _Limited:
+    """a file-like view of the next length octets of a file"""
+
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.remaining = length
+
+    def read(self, size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self):
+        line = self.fp.readline(self.remaining)
+        self.remaining -= len(line)
+        return line
+
+def export(db_directory, warc_directory, nprocesses = 1, db_class = _db.DB,
+        **kwargs):
+    """
+    export the responses stored by StorageCallback in a database
+    to WARC files in warc_directory, in parallel (via replay.Replayer),
+    then merge the CDX index; return the number of responses exported
+
+    any other keyword arguments are passed to WARCWriter
+    """
+    n = replay.Replayer(db_directory, lambda: WARCWriter(warc_directory,
+        **kwargs), nprocesses, db_class)()
+    merge_cdx(warc_directory)
+    return n
+
+def import_warc(paths, db_directory, nprocesses = 1, db_class = _db.DB):
+    """
+    store the response records in WARC files (gzipped or not)
+    to a database, as StorageCallback would have (so it may be replayed),
+    spreading the files between nprocesses processes;
+    return the number of responses stored
+    """
+    if nprocesses <= 0:
+        raise ValueError("nprocesses must be positive")
+    elif nprocesses == 1:
+        return _import(paths, db_directory, db_class)
+    nimported = multiprocessing.Value('L', 0)
+
+    def run(i):
+        n = _import(paths[i::nprocesses], db_directory, db_class)
+
+        with nimported.get_lock():
+            nimported.value += n
+    processes = [multiprocessing.Process(target = run, args = (i, ))
+        for i in range(nprocesses)]
+
+    for p in processes:
+        p.start()
+
+    for p in processes:
+        p.join()
+
+    for i, p in enumerate(processes):
+        if p.exitcode:
+            raise RuntimeError("import process %u failed" % i)
+    return nimported.value
+
+def _import(paths, db_directory, db_class):
+    """import WARC files in this process"""
+    n = 0
+
+    with db_class(db_directory) as db:
+        for path in paths:
+            with (gzip.open if path.endswith(".gz") else open)(path,
+                    "rb") as fp:
+                for header, block in records(fp):
+                    if not header.get("warc-type") == "response" \
+                            or not header.get("content-type", "") \
+                            .startswith("application/http"):
+                        continue
+                    block.readline() # the status line
+                    lines = []
+
+                    while 1:
+                        line = block.readline()
+
+                        if line in ("", "\n", "\r\n"):
+                            break
+                        lines.append(line)
+
+                    with db.writer(header["warc-target-uri"]) as writer:
+                        writer.write("".join(lines) + "\r\n\r\n")
+
+                        while 1:
+                            chunk = block.read(65536)
+
+                            if not chunk:
+                                break
+                            writer.write(chunk)
+                    n += 1
+    return n
+
+def merge_cdx(directory, path = None):
+    """
+    merge the CDX runs in a directory into one sorted index
+    (by default, "index.cdx" there), then remove them
+    """
+    if path is None:
+        path = os.path.join(directory, "index.cdx")
+    runs = sorted((os.path.join(directory, f) for f in os.listdir(directory)
+        if f.endswith(".cdx.run")))
+    fps = [open(r, "rb") for r in runs]
+
+    try:
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(CDX_HEADER)
+            fp.writelines(heapq.merge(*fps))
+        os.rename(path + ".tmp", path)
+    finally:
+        for fp in fps:
+            fp.close()
+
+    for run in runs:
+        os.remove(run)
+    return path
+
+def records(fp):
+    """
+    generate (header, block) for each record in a WARC file:
+    header maps the lowercase WARC header names to their values,
+    and block is a file-like view of the record's content,
+    valid until the next record is generated
+    """
+    while 1:
+        line = fp.readline()
+
+        if not line:
+            break
+        elif not line.strip(): # between records
+            continue
+        header = {}
+
+        while 1:
+            line = fp.readline()
+
+            if not line.strip():
+                break
+            name, value = line.split(':', 1)
+            header[name.strip().lower()] = value.strip()
+        block = _Limited(fp, int(header.get("content-length", 0)))
+        yield header, block
+
+        while block.read(65536): # skip what wasn't read
+            pass
+
+def _surt(url):
+    """return the sort-friendly URI reordering transform of a URL"""
+    parsed = urlparse.urlsplit(url)
+    host = (parsed.hostname or "").lower()
+
+    if host.startswith("www."):
+        host = host[4:]
+
+    if not host.replace('.', "").isdigit(): # (IP addresses aren't reversed)
+        host = ",".join(reversed(host.split('.')))
+
+    if parsed.port and not (parsed.scheme, parsed.port) in (("http", 80),
+            ("https", 443)):
+        host += ":%u" % parsed.port
+    return "%s)%s%s" % (host, parsed.path or '/',
+        "?" + parsed.query if parsed.query else "")
+
+if __name__ == "__main__":
+    import sys
+
+    def _help():
+        print "WARC export and import\n" \
+              "Usage: python warc.py [OPTIONS] ACTION DATABASE PATHS\n" \
+              "OPTIONS\n" \
+              "\t-h, --help\tshow this text and exit\n" \
+              "\t-p, --processes INT\tthe number of processes\n" \
+              "ACTION\n" \
+              "\texport\texport the responses in DATABASE\n" \
+              "\t\tto the WARC directory PATHS\n" \
+              "\timport\timport the WARC files PATHS to DATABASE\n" \
+              "DATABASE\n" \
+              "\ta database of responses, as stored with -r\n" \
+              "PATHS\n" \
+              "\ta WARC directory, or WARC files"
+
+    args = []
+    i = 1
+    nprocesses = 1
+
+    while i < len(sys.argv):
+        arg = sys.argv[i]
+
+        if arg in ("-h", "--help"):
+            _help()
+            sys.exit()
+        elif arg in ("-p", "--processes"):
+            if i == len(sys.argv) - 1:
+                print "Missing argument."
+                _help()
+                sys.exit()
+
+            try:
+                nprocesses = int(sys.argv[i + 1])
+            except ValueError:
+                pass
+            i += 1
+        else:
+            args.append(arg)
+        i += 1
+
+    if len(args) < 3 or not args[0] in ("export", "import"):
+        _help()
+        sys.exit()
+    elif args[0] == "export":
+        print "%u responses exported" % export(args[1], args[2], nprocesses)
+    else:
+        print "%u responses imported" % import_warc(args[2:], args[1],
+            nprocesses)
@@ -0,0 +1,72 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "spider"))
+
+from lib.db import dedup
+
+__doc__ = "tests for DedupDB"
+
+class DedupDBTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = dedup.DedupDB(self.directory)
+
+    def tearDown(self):
+        self.db.__exit__()
+        shutil.rmtree(self.directory)
+
+    def test_shared_blob(self):
+        self.db["a"] = "same"
+        self.db["b"] = "same"
+        self.assertEqual(self.db.stats()["blobs"], 1)
+        self.db["a"] = "other"
+        del self.db["b"]
+        self.assertEqual(self.db["a"], "other")
+        self.assertEqual(self.db.stats(), {"blobs": 1, "refs": 1,
+            "bytes": 5, "stored-bytes": self.db.stats()["stored-bytes"]})
+
+    def test_concurrent_overwrites(self):
+        self.db["keep"] = "v0" # shares a blob with the overwritten entry
+        errors = []
+
+        def overwrite(n):
+            try:
+                for i in range(100):
+                    self.db["name"] = "v%u" % ((n + i) % 3)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target = overwrite, args = (n, ))
+            for n in range(8)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.db["keep"], "v0")
+        self.assertEqual(self.db.stats()["refs"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "spider"))
+
+from lib.disque import disque
+
+__doc__ = "tests for leased Disques"
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _chunks(self):
+        return [f for f in os.listdir(self.directory) if not f[0] == '.']
+
+    def _disque(self, **kwargs):
+        kwargs.setdefault("chunk_size", 4)
+        kwargs.setdefault("lease_duration", 60)
+        return disque.Disque(self.directory, **kwargs)
+
+    def test_ack(self):
+        q = self._disque()
+
+        for i in range(3):
+            q.put("url%u" % i)
+        leases = [q.get() for i in range(3)]
+        self.assertEqual(leases, ["url0", "url1", "url2"])
+        self.assertEqual(q.stats()["leased"], 3)
+
+        for lease in leases:
+            q.ack(lease)
+        q.sync()
+        self.assertEqual(q.stats()["leased"], 0)
+        self.assertTrue(q.empty())
+
+    def test_ack_flushes_puts(self):
+        q = self._disque(ack_interval = 0)
+        q.put("seed")
+        lease = q.get()
+        q.put("link")
+        q.ack(lease)
+        self.assertEqual(self._disque().get(), "link")
+
+    def test_acks_are_group_committed(self):
+        q = self._disque(chunk_size = 1024, ack_interval = 3600)
+
+        for i in range(100):
+            q.put("seed%u" % i)
+        q.sync()
+        nchunks = len(self._chunks())
+
+        for i in range(100):
+            lease = q.get()
+            q.put("link%u" % i)
+            q.ack(lease)
+        self.assertEqual(len(self._chunks()), nchunks)
+        self.assertEqual(self._disque().stats()["leased"], 100)
+        q.sync()
+        self.assertEqual(self._disque().stats()["leased"], 0)
+        self.assertEqual(q.qsize(), 100)
+
+    def test_idle_consumer_commits(self):
+        q = self._disque(ack_interval = 0.1)
+        q.put("url")
+        q.ack(q.get())
+        self.assertEqual(self._disque().stats()["leased"], 1) # pending
+        time.sleep(0.2)
+        self.assertTrue(q.empty()) # (commits the overdue ack)
+        self.assertEqual(self._disque().stats()["leased"], 0)
+
+    def test_flush_acks(self):
+        q = self._disque(ack_interval = 3600)
+        q.put("url")
+        q.ack(q.get())
+        self.assertEqual(q.stats()["leased"], 1)
+        q.flush_acks()
+        self.assertEqual(self._disque().stats()["leased"], 0)
+
+    def test_expiry(self):
+        q = self._disque(lease_duration = 0.1)
+        q.put("url")
+        lease = q.get()
+        time.sleep(0.2)
+        self.assertFalse(q.empty())
+        reissued = q.get()
+        self.assertEqual(reissued, "url")
+        self.assertNotEqual(reissued.id, lease.id)
+        q.ack(reissued)
+        q.sync()
+        self.assertTrue(q.empty())
+
+    def test_requeue(self):
+        q = self._disque()
+        q.put("a")
+        q.put("b")
+        lease = q.get()
+        q.requeue(lease)
+        self.assertEqual(q.get(), "a")
+
+    def test_shared(self):
+        """leases are seen (and expire) across instances"""
+        a = self._disque(lease_duration = 0.1)
+        b = self._disque(lease_duration = 0.1)
+        a.put("url", True)
+        lease = a.get()
+        self.assertEqual(b.stats()["leased"], 1)
+        time.sleep(0.2)
+        self.assertEqual(b.get(), "url")
+        a.ack(lease)
+        a.sync()
+        self.assertEqual(b.stats()["leased"], 1) # b's lease remains
+
+    def test_compaction(self):
+        q = self._disque(ack_interval = 0)
+
+        for i in range(200):
+            q.put("url%u" % i)
+
+        for i in range(200):
+            q.ack(q.get())
+        q.sync()
+        self.assertLess(os.path.getsize(os.path.join(self.directory,
+            disque.Disque.LEASES)), 200 * 20)
+        self.assertEqual(self._disque().stats()["leased"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
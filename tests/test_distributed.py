@@ -0,0 +1,71 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "spider"))
+
+import distributed
+
+__doc__ = "tests for distributed termination"
+
+class TerminationTest(unittest.TestCase):
+    def setUp(self):
+        self.termination = distributed.Termination(3)
+
+    def _round(self, reports):
+        return [self.termination.report(i, *r)
+            for i, r in enumerate(reports)]
+
+    def test_finishes_after_a_stable_round(self):
+        idle = [(True, 1, 0), (True, 0, 1), (True, 0, 0)]
+        self.assertEqual(self._round(idle), [False] * 3)
+        self.assertEqual(self._round(idle), [False, False, True])
+        self.assertFalse(self.termination.all_told())
+        self.assertTrue(self.termination.report(0, False, 5, 5))
+        self.assertFalse(self.termination.all_told()) # (node 1 wasn't)
+        self.assertTrue(self.termination.report(1, *idle[1]))
+        self.assertTrue(self.termination.all_told())
+
+    def test_unreceived_batch(self):
+        reports = [(True, 1, 0), (True, 0, 0), (True, 0, 0)]
+        self._round(reports)
+        self.assertEqual(self._round(reports), [False] * 3)
+
+    def test_changed_report(self):
+        idle = [(True, 1, 0), (True, 0, 1), (True, 0, 0)]
+        self._round(idle)
+        self.termination.report(0, *idle[0])
+        self.termination.report(1, True, 1, 2) # received (and sent) again
+        self.termination.report(2, True, 1, 0)
+        self.assertEqual(self._round(idle[:2] + [(True, 1, 0)]),
+            [False] * 3) # (a new stable round only began)
+
+    def test_missing_node(self):
+        for i in range(2):
+            self.termination.report(0, True, 0, 0)
+            self.termination.report(1, True, 0, 0)
+        self.assertFalse(self.termination.report(0, True, 0, 0))
+
+    def test_idle_timeout(self):
+        termination = distributed.Termination(1, 3600)
+        termination.report(0, True, 0, 0)
+        self.assertFalse(termination.report(0, True, 0, 0))
+
+if __name__ == "__main__":
+    unittest.main()
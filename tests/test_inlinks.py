@@ -0,0 +1,94 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "spider"))
+
+from lib.db import inlinks
+from lib.db import webgraph
+
+__doc__ = "tests for InlinkIndex and Webgraph's inlinks"
+
+class InlinkIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = inlinks.InlinkIndex(self.directory)
+
+    def tearDown(self):
+        self.index.__exit__()
+        shutil.rmtree(self.directory)
+
+    def test_remove(self):
+        self.index.update(((1, 0), (1, 2), (3, 0)))
+        self.index.flush()
+        self.index.remove(((1, 0), ))
+        self.assertEqual(list(self.index.sources(1)), [2])
+        self.index.flush()
+        self.assertEqual(list(self.index.sources(1)), [2])
+        self.assertEqual(self.index.count(1), 1)
+        self.index.add(1, 0) # re-added after its tombstone
+        self.index.flush()
+        self.assertEqual(list(self.index.sources(1)), [0, 2])
+
+    def test_merge_drops_tombstones(self):
+        self.index.update(((1, 0), (1, 2)))
+        self.index.flush()
+        self.index.remove(((1, 2), (5, 5)))
+        self.index.flush()
+        self.index.merge()
+        runs = [f for f in os.listdir(self.directory) if f.endswith(".run")]
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(os.path.getsize(os.path.join(self.directory,
+            runs[0])), inlinks.InlinkIndex.ENTRY.size)
+        self.assertEqual(list(self.index.sources(1)), [0])
+        self.assertEqual(self.index.count(1), 1)
+
+class WebgraphInlinksTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.graph = webgraph.Webgraph(self.directory)
+
+    def tearDown(self):
+        self.graph.__exit__()
+        shutil.rmtree(self.directory)
+
+    def test_replaced_record(self):
+        self.graph.add("a", ["b", "c"])
+        self.graph.add("a", ["b"])
+        a = self.graph.ids(["a"])[0]
+        self.assertEqual(list(self.graph.inlinks("c")), [])
+        self.assertEqual(list(self.graph.inlinks("b")), [a])
+        self.graph.__exit__()
+        self.graph = webgraph.Webgraph(self.directory)
+        self.assertEqual(list(self.graph.inlinks("c")), [])
+        self.assertEqual(self.graph.inlink_count("c"), 0)
+        self.graph.inlink_index.merge()
+        self.assertEqual(list(self.graph.inlinks("c")), [])
+        self.assertEqual(list(self.graph.inlinks("b")), [a])
+
+    def test_replaced_in_one_update(self):
+        self.graph.add("a", ["c"])
+        self.graph.update((("a", ["b", "c"]), ("a", ["b"])))
+        self.assertEqual(list(self.graph.inlinks("c")), [])
+        self.assertEqual(self.graph.inlink_count("b"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import BaseHTTPServer
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "spider"))
+
+import callback
+from lib.disque import disque
+import multiprocess
+import spider
+
+__doc__ = "end-to-end tests for MultiprocessSpider"
+
+NPAGES = 30
+
+class _Site(BaseHTTPServer.BaseHTTPRequestHandler):
+    """page i links to pages i + 1 and i + 2"""
+
+    def do_GET(self):
+        i = int(self.path.strip("/.html") or 0)
+        body = "<html><body>%s</body></html>" % "".join((
+            "<a href=\"http://%s:%u/%u.html\">x</a>"
+            % (self.server.server_address + ((i + k) % NPAGES, ))
+            for k in (1, 2)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MultiprocessSpiderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Site)
+        server_thread = threading.Thread(target = self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def _crawl(self, nprocesses):
+        queue_directory = os.path.join(self.directory, "queue")
+
+        with disque.Disque(queue_directory, chunk_size = 2048) as url_queue:
+            url_queue.put("http://%s:%u/0.html" % self.server.server_address)
+        crawl = multiprocess.MultiprocessSpider(nprocesses,
+            lambda q: spider.Spider(q, callback.Callback()),
+            queue_directory, progress = None, progress_interval = 0.1)
+        alarm = signal.signal(signal.SIGALRM, crawl._stop) # (if it hangs)
+        signal.alarm(30)
+
+        try:
+            crawl()
+        finally:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, alarm)
+        self.assertTrue(crawl._done.value) # finished, rather than stopped
+        self.assertEqual(sum(crawl._nhandled), NPAGES)
+
+    def test_one_process(self):
+        self._crawl(1)
+
+    def test_two_processes(self):
+        self._crawl(2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+# Copyright (C) 2018 Bailey Defino
+# <https://bdefino.github.io>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "spider"))
+
+from lib.db import segment
+
+__doc__ = "tests for SegmentDB"
+
+class SegmentDBTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = segment.SegmentDB(self.directory, segment_size = 4096)
+
+    def tearDown(self):
+        self.db.__exit__()
+        shutil.rmtree(self.directory)
+
+    def _reopen(self):
+        return segment.SegmentDB(self.directory, segment_size = 4096)
+
+    def _segments(self):
+        return sorted((f for f in os.listdir(self.directory)
+            if f.endswith(".seg")))
+
+    def test_set(self):
+        self.db["a"] = "1"
+        self.db[["b", "c"]] = "2"
+        self.db["a"] = "3"
+        self.assertEqual(self.db["a"], "3")
+        self.assertEqual(self.db[["b", "c"]], "2")
+        self.assertEqual(len(self.db), 2)
+        self.db.__exit__()
+        other = self._reopen()
+        self.assertEqual(other["a"], "3")
+        self.assertEqual(other.list(), [["a"], ["b", "c"]])
+        other.__exit__()
+
+    def test_set_is_seen_by_another_instance(self):
+        other = self._reopen()
+        self.assertFalse("a" in other)
+        self.db["a"] = "1"
+        self.assertEqual(other["a"], "1")
+        other["a"] = "2"
+        self.assertEqual(self.db["a"], "2")
+        other.__exit__()
+
+    def test_append(self):
+        self.db["a"] = "abc"
+        self.db.append("a", "def", 0, os.SEEK_END)
+        self.assertEqual(self.db["a"], "abcdef")
+        self.assertEqual(len(self.db._index[("a", )]), 2) # a true append
+        self.db.append("a", "XY", 1) # (relative to the start)
+        self.assertEqual(self.db["a"], "aXYdef")
+        self.db.append("a", "!", 0, os.SEEK_END)
+        self.assertEqual(self.db["a"], "aXYdef!")
+        self.db.append("a", "Z", 2, truncate = True)
+        self.assertEqual(self.db["a"], "aXZ")
+        self.db.append("new", "x")
+        self.assertEqual(self.db["new"], "x")
+        self.assertEqual(self.db.entry("a").read(1, 1), "X")
+
+    def test_delete(self):
+        self.db["a"] = "1"
+        del self.db["a"]
+        self.assertFalse("a" in self.db)
+        self.assertRaises(KeyError, lambda: self.db["a"])
+
+    def test_rollover(self):
+        for i in range(100):
+            self.db["k%u" % i] = "v" * 100
+        self.assertTrue(len(self._segments()) > 1)
+        other = self._reopen()
+        self.assertEqual([other["k%u" % i] for i in range(100)],
+            ["v" * 100] * 100)
+        other.__exit__()
+
+    def test_torn_record(self):
+        self.db["a"] = "1"
+        self.db.sync()
+        path = os.path.join(self.directory, self._segments()[-1])
+        size = os.path.getsize(path)
+
+        with open(path, "ab") as fp: # a record cut short by a crash
+            fp.write(segment.SegmentDB.HEADER.pack(segment.SegmentDB.SET, 1,
+                1000) + "b" + "partial")
+        other = self._reopen()
+        self.assertFalse("b" in other)
+        other["c"] = "3" # truncates the torn record first
+        self.assertEqual(os.path.getsize(path), size
+            + segment.SegmentDB.HEADER.size + len("c") + len("3"))
+        other.__exit__()
+        self.db.__exit__()
+        self.db = self._reopen()
+        self.assertEqual(self.db["a"], "1")
+        self.assertEqual(self.db["c"], "3")
+        self.assertFalse("b" in self.db)
+
+    def test_compaction(self):
+        other = self._reopen()
+
+        for i in range(50):
+            self.db["k%u" % (i % 5)] = str(i) * 100
+        del self.db["k0"]
+        old = self._segments()
+        self.assertTrue(self.db.garbage() > 0.5)
+        self.db.compact()
+        self.assertTrue(self.db.garbage() < 0.1)
+        self.assertFalse(set(old) & set(self._segments()))
+        expected = {"k%u" % i: str(45 + i) * 100 for i in range(1, 5)}
+
+        for db in (self.db, other): # (other sees the new generation)
+            self.assertEqual(sorted((n[0] for n in db.list())),
+                sorted(expected))
+
+            for name, data in expected.iteritems():
+                self.assertEqual(db[name], data)
+        other["k1"] = "new"
+        self.assertEqual(self.db["k1"], "new")
+        other.__exit__()
+
+    def test_sync_interval(self):
+        db = segment.SegmentDB(self.directory, sync_interval = 3600)
+        db["a"] = "1"
+        synced = db._synced
+        db["b"] = "2"
+        self.assertEqual(db._synced, synced) # not synced per record
+        db.sync()
+        self.assertTrue(db._synced > synced)
+        db.__exit__()
+
+if __name__ == "__main__":
+    unittest.main()